@@ -26,15 +26,19 @@ with keepassc.  If not, see <http://www.gnu.org/licenses/>.
 import logging
 import signal
 import socket
-import ssl
 import sys
-from hashlib import sha256
+import threading
+import time
 from os import chdir
-from os.path import expanduser, realpath, isfile, join
+from os.path import expanduser, realpath, join
 
 from keepassc.conn import *
-from keepassc.client import Client
+from keepassc.client import (Client, check_pin, get_tls_context,
+                             keep_tls_session, tls_connect)
 from keepassc.daemon import Daemon
+from keepassc.logqueue import dropped_messages, setup_logging
+from keepassc.stats import MetricsServer, Stats, Timer
+from keepassc.trace import Tracer, new_id, split_trace, trace_part
 
 
 class Agent(Daemon):
@@ -43,7 +47,8 @@ class Agent(Daemon):
     def __init__(self, pidfile, loglevel, logfile,
                  server_address = 'localhost', server_port = 50000,
                  agent_port = 50001, password = None, keyfile = None,
-                 tls = False, tls_dir = None):
+                 tls = False, tls_dir = None, metrics_port = None,
+                 trace = False):
         Daemon.__init__(self, pidfile)
 
         try:
@@ -53,17 +58,26 @@ class Agent(Daemon):
         finally:
             logfile = join(logdir, 'keepassc', logfile)
 
-        logging.basicConfig(format='[%(levelname)s] in %(filename)s:'
-                                   '%(funcName)s at %(asctime)s\n%(message)s',
-                            level=loglevel, filename=logfile,
-                            filemode='a')
+        setup_logging(loglevel, logfile)
 
         self.lookup = {
             b'FIND': self.find,
             b'GET': self.get_db,
+            b'GETE': self.get_entry,
+            b'GETF': self.get_field,
             b'GETC': self.get_credentials}
 
         self.server_address = (server_address, server_port)
+        self.stats = Stats()
+        # The Timer and trace ID of the request in progress
+        self.timer = None
+        self.trace_id = None
+        if trace is True:
+            self.tracer = Tracer(join(logdir, 'keepassc', 'trace.log'),
+                                 'agent')
+        else:
+            self.tracer = None
+        self.metrics = None
         try:
             # Listen for commands
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -74,8 +88,18 @@ class Agent(Daemon):
             logging.error(err.__str__())
             sys.exit(1)
         else:
-            logging.info('Agent socket created on localhost:'+
-                         str(agent_port))
+            logging.info('Agent socket created on localhost:%d', agent_port)
+
+        if metrics_port is not None:
+            try:
+                self.metrics = MetricsServer(metrics_port,
+                                             self.render_metrics)
+            except OSError as err:
+                print(err)
+                logging.error(err.__str__())
+                sys.exit(1)
+            else:
+                logging.info('Metrics served on localhost:%d', metrics_port)
 
         if tls_dir is not None:
             self.tls_dir = realpath(expanduser(tls_dir)).encode()
@@ -94,9 +118,7 @@ class Agent(Daemon):
             self.keyfile = b''
 
         if tls is True:
-            self.context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-            self.context.verify_mode = ssl.CERT_REQUIRED
-            self.context.load_verify_locations(tls_dir + "/cacert.pem")
+            self.context = get_tls_context(tls_dir)
         else:
             self.context = None
 
@@ -113,84 +135,168 @@ class Agent(Daemon):
 
         tmp = [password, self.keyfile]
         tmp.extend(cmd)
+        if self.trace_id is not None:
+            tmp.append(trace_part(self.trace_id))
         cmd_chain = build_message(tmp)
+        start = time.time()
 
         try:
-            tmp_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             if self.context is not None:
-                conn = self.context.wrap_socket(tmp_conn)
+                conn = tls_connect(self.context, self.server_address)
+                self.stats.cache('tls_session', conn.session_reused is True)
             else:
-                conn = tmp_conn
-            conn.connect(self.server_address)
+                conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                conn.connect(self.server_address)
         except:
             raise
         else:
-            logging.info('Connected to '+self.server_address[0]+':'+
-                         str(self.server_address[1]))
+            logging.info('Connected to %s:%d', self.server_address[0],
+                         self.server_address[1])
 
         try:
             conn.settimeout(60)
             if self.context is not None:
-                if not isfile(self.tls_dir.decode() + '/pin'):
-                    sha = sha256()
-                    sha.update(conn.getpeercert(True))
-                    with open(self.tls_dir.decode() + '/pin', 'wb') as pin:
-                        pin.write(sha.digest())
-                else:
-                    with open(self.tls_dir.decode() + '/pin', 'rb') as pin:
-                        pinned_key = pin.read()
-                    sha = sha256()
-                    sha.update(conn.getpeercert(True))
-                    if pinned_key != sha.digest():
-                        return (b'FAIL: Server certificate differs from '
-                                b'pinned certificate')
-                cert = conn.getpeercert()
                 try:
-                    ssl.match_hostname(cert, "KeePassC Server")
-                except:
-                    return b'FAIL: TLS - Hostname does not match'
+                    check_pin(self.tls_dir.decode(), conn)
+                except OSError as err:
+                    if str(err)[:4] != 'FAIL':
+                        raise
+                    return str(err).encode()
             sendmsg(conn, cmd_chain)
             answer = receive(conn)
+            if self.context is not None:
+                keep_tls_session(self.context, self.server_address, conn)
         except:
             raise
         finally:
             conn.shutdown(socket.SHUT_RDWR)
             conn.close()
+            if self.tracer is not None:
+                self.tracer.since(self.trace_id, 'upstream ' + cmd[0].decode(),
+                                  start)
 
         return answer
 
     def run(self):
         """Overide Daemon.run() and provide sockets"""
 
+        if self.metrics is not None:
+            self.metrics.start()
+
         while True:
             try:
                 conn, client = self.sock.accept()
             except OSError:
                 break
 
-            logging.info('Connected to '+client[0]+':'+str(client[1]))
+            logging.info('Connected to %s:%d', client[0], client[1])
             conn.settimeout(60)
+            self.stats.connection_opened()
+            self.timer = Timer()
+            self.trace_id = None
+            cmd = None
+            begin = time.time()
+            busy = False
 
             try:
-                parts = receive(conn).split(b'\xB2\xEA\xC0')
+                start = time.perf_counter()
+                msg = receive(conn)
+                self.timer.add('receive', start)
+                # The agent handles one request at a time, so 1 means
+                # that further clients wait in the backlog
+                self.stats.request_started()
+                busy = True
+                self.timer.bytes_in = len(msg)
+                parts = msg.split(b'\xB2\xEA\xC0')
+                # The ID of a traced client is passed on to the server
+                self.trace_id = split_trace(parts)
+                if self.trace_id is None and self.tracer is not None:
+                    self.trace_id = new_id()
                 cmd = parts.pop(0)
-                if cmd in self.lookup:
-                    self.lookup[cmd](conn, parts)
-                else:
-                    logging.error('Received a wrong command')
-                    sendmsg(conn, b'FAIL: Command isn\'t available')
+                start = time.perf_counter()
+                try:
+                    if cmd in self.lookup:
+                        self.lookup[cmd](conn, parts)
+                    else:
+                        logging.error('Received a wrong command')
+                        self.send(conn, b'FAIL: Command isn\'t available')
+                finally:
+                    self.timer.phases['handler'] = (
+                        time.perf_counter() - start -
+                        self.timer.phases.get('send', 0.0))
             except OSError as err:
+                self.timer.error = True
                 logging.error(err.__str__())
             finally:
+                if busy is True:
+                    self.stats.request_finished()
+                if cmd in self.lookup:
+                    name = cmd.decode()
+                else:
+                    name = 'INVALID'
+                self.stats.record(name, self.timer)
+                if self.tracer is not None:
+                    self.tracer.request(self.trace_id, name, begin,
+                                        time.time(), self.timer)
+                self.timer = None
+                self.trace_id = None
+                self.stats.connection_closed()
                 conn.shutdown(socket.SHUT_RDWR)
                 conn.close()
 
+    def send(self, conn, msg):
+        """Send a message and account it to the current request"""
+
+        start = time.perf_counter()
+        sendmsg(conn, msg)
+        if self.timer is not None:
+            self.timer.add('send', start)
+            self.timer.bytes_out += len(msg)
+            if msg[:4] == b'FAIL':
+                self.timer.error = True
+
+    def render_metrics(self):
+        """Return the metrics of the agent in the Prometheus format"""
+
+        return self.stats.prometheus('keepassc_agent', (
+            ('threads', 'Running threads.', threading.active_count()),), (
+            ('log_dropped_total', 'Log messages dropped because the log '
+             'queue was full.', dropped_messages()),))
+
     def find(self, conn, cmd_misc):
         """Find Entries"""
 
         try:
             answer = self.send_cmd(b'FIND', cmd_misc[0])
-            sendmsg(conn, answer)
+            self.send(conn, answer)
+            if answer[:4] == b'FAIL':
+                raise OSError(answer.decode())
+        except (OSError, TypeError) as err:
+            logging.error(err.__str__())
+
+    def get_entry(self, conn, cmd_misc):
+        """Get one entry by its uuid"""
+
+        if len(cmd_misc) != 1:
+            self.send(conn, b'FAIL: GETE needs a uuid')
+            return
+        try:
+            answer = self.send_cmd(b'GETE', cmd_misc[0])
+            self.send(conn, answer)
+            if answer[:4] == b'FAIL':
+                raise OSError(answer.decode())
+        except (OSError, TypeError) as err:
+            logging.error(err.__str__())
+
+    def get_field(self, conn, cmd_misc):
+        """Get one attribute of an entry by its uuid"""
+
+        if len(cmd_misc) != 2:
+            self.send(conn, b'FAIL: GETF needs a uuid and a field')
+            return
+        try:
+            answer = self.send_cmd(b'GETF', cmd_misc[0], cmd_misc[1])
+            self.send(conn, answer)
             if answer[:4] == b'FAIL':
                 raise OSError(answer.decode())
         except (OSError, TypeError) as err:
@@ -201,7 +307,7 @@ class Agent(Daemon):
 
         try:
             answer = self.send_cmd(b'GET')
-            sendmsg(conn, answer)
+            self.send(conn, answer)
             if answer[:4] == b'FAIL':
                 raise OSError(answer.decode())
         except (OSError, TypeError) as err:
@@ -224,13 +330,15 @@ class Agent(Daemon):
                self.tls_dir]
         chain = build_message(tmp)
         try:
-            sendmsg(conn, chain)
+            self.send(conn, chain)
         except (OSError, TypeError) as err:
             logging.error(err.__str__())
 
     def handle_sigterm(self, signum, frame):
         """Handle SIGTERM"""
 
+        if self.metrics is not None:
+            self.metrics.stop()
         self.sock.shutdown(socket.SHUT_RDWR)
         self.sock.close()
         del self.keyfile
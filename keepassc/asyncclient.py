@@ -0,0 +1,388 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+"""This module implements the AsyncClient class for asyncio programs.
+
+AsyncClient has the methods of Client, but they are coroutines and
+use asyncio streams instead of blocking sockets. Many requests may be
+in flight at once, each on its own connection of the pool:
+
+    client = AsyncClient(logging.ERROR, 'client.log', password='...')
+    answers = await asyncio.gather(*[client.find(i) for i in titles])
+    await client.close()
+
+Every request is limited by the timeout of the client, a single call
+can be limited further with asyncio.wait_for(). A request which is
+cancelled or times out closes its connection since the answer may
+still arrive on it.
+
+Functions:
+    read_message(reader)
+    read_messages(reader)
+    write_message(writer, msg)
+    open_connection(address, context, tls_dir)
+
+Classes:
+    AsyncConnectionPool(object)
+    AsyncClient(Client)
+"""
+
+import asyncio
+import logging
+import time
+from functools import partial
+
+from keepassc.client import (Client, POOL_SIZE, IDLE_TIMEOUT, check_pin,
+                             field_value, may_retry)
+from keepassc.conn import ConnectionClosed, build_message
+from keepassc.trace import new_id, trace_part
+
+# Seconds a request may take, like the socket timeout of Client
+TIMEOUT = 60
+# Connections an AsyncClient opens at most at the same time. The server
+# answers one request per connection at a time, so this is the number
+# of requests in flight.
+ASYNC_POOL_SIZE = 4 * POOL_SIZE
+
+END = b'\xDE\xAD\xE1\x1D'
+
+
+async def read_message(reader):
+    """Read a message from reader, an asyncio.StreamReader"""
+
+    data = bytearray()
+    while True:
+        received = await reader.read(65536)
+        if not received:
+            raise ConnectionClosed(len(data))
+        # The end may have been split between two reads
+        pos = max(len(data) - 3, 0)
+        data += received
+        end = data.find(END, pos)
+        if end != -1:
+            return bytes(data[:end])
+
+
+async def read_messages(reader):
+    """Read messages until the connection is closed
+
+    This is an asynchronous generator, see conn.receive_messages().
+
+    """
+
+    data = bytearray()
+    while True:
+        received = await reader.read(65536)
+        if not received:
+            return
+        pos = max(len(data) - 3, 0)
+        data += received
+        while True:
+            end = data.find(END, pos)
+            if end == -1:
+                break
+            yield bytes(data[:end])
+            del data[:end + 4]
+            pos = 0
+
+
+async def write_message(writer, msg):
+    """Send msg through writer, an asyncio.StreamWriter"""
+
+    writer.write(msg + END)
+    await writer.drain()
+
+
+async def open_connection(address, context = None, tls_dir = None):
+    """Return a new connection to the server as (reader, writer)
+
+    See client.open_connection().
+
+    """
+
+    reader, writer = await asyncio.open_connection(address[0], address[1],
+                                                   ssl=context)
+    logging.info('Connected to %s:%d', address[0], address[1])
+    if context is None:
+        return reader, writer
+
+    try:
+        check_pin(tls_dir, writer.get_extra_info('ssl_object'))
+    except:
+        writer.close()
+        raise
+    return reader, writer
+
+
+class AsyncConnectionPool(object):
+    """Keep asyncio connections to a server open for the next request
+
+    It works like client.ConnectionPool, a connection is a (reader,
+    writer) tuple and connect is a coroutine function.
+
+    """
+
+    def __init__(self, connect, size = ASYNC_POOL_SIZE,
+                 idle_timeout = IDLE_TIMEOUT):
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self.slots = asyncio.BoundedSemaphore(size)
+        # (connection, time it was released), the newest last
+        self.idle = []
+        self.closed = False
+
+    async def acquire(self):
+        """Return a connection and whether it was used before"""
+
+        await self.slots.acquire()
+        try:
+            while self.idle:
+                conn, released = self.idle.pop()
+                if (time.monotonic() - released < self.idle_timeout and
+                        self.healthy(conn)):
+                    return conn, True
+                self.close_conn(conn)
+            return await self.connect(), False
+        except:
+            self.slots.release()
+            raise
+
+    def release(self, conn, reuse = True):
+        """Give back a connection from acquire()
+
+        It is closed if reuse is False, e.g. after an error.
+
+        """
+
+        try:
+            if reuse is True and self.closed is False:
+                self.idle.append((conn, time.monotonic()))
+                self.evict()
+            else:
+                self.close_conn(conn)
+        finally:
+            self.slots.release()
+
+    async def replace(self, conn):
+        """Close a connection from acquire() and return a new one"""
+
+        self.close_conn(conn)
+        return await self.connect()
+
+    def healthy(self, conn):
+        """Return whether an idle connection can be used
+
+        The server never sends anything unasked, so a connection at its
+        end was closed by it.
+
+        """
+
+        reader, writer = conn
+        return not reader.at_eof() and not writer.is_closing()
+
+    def evict(self):
+        """Close the connections idle for longer than idle_timeout"""
+
+        now = time.monotonic()
+        idle = []
+        for conn, released in self.idle:
+            if now - released < self.idle_timeout:
+                idle.append((conn, released))
+            else:
+                self.close_conn(conn)
+        self.idle = idle
+
+    async def close(self):
+        """Close all idle connections and those in use once released"""
+
+        self.closed = True
+        idle = self.idle
+        self.idle = []
+        for conn, released in idle:
+            self.close_conn(conn)
+        for (reader, writer), released in idle:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    def close_conn(self, conn):
+        conn[1].close()
+
+
+class AsyncClient(Client):
+    """The KeePassC client for asyncio
+
+    The arguments are those of Client, timeout is the number of seconds
+    a request may take and pool_size the number of requests in flight.
+    The command methods are coroutines which return the same answers as
+    those of Client. close() is a coroutine, too.
+
+    """
+
+    def __init__(self, loglevel, logfile, server_address = 'localhost',
+                 server_port = 50000, password = None, keyfile = None,
+                 tls = False, tls_dir = None, tracer = None,
+                 pool_size = ASYNC_POOL_SIZE, idle_timeout = IDLE_TIMEOUT,
+                 timeout = TIMEOUT):
+        Client.__init__(self, loglevel, logfile, server_address,
+                        server_port, password, keyfile, tls, tls_dir, tracer,
+                        pool_size, idle_timeout)
+        self.timeout = timeout
+        self.pool = AsyncConnectionPool(
+            partial(open_connection, self.server_address, self.context,
+                    tls_dir), pool_size, idle_timeout)
+
+    async def close(self):
+        """Close the connections kept open"""
+
+        await self.pool.close()
+
+    async def connect(self):
+        """Return a new connection to the server as (reader, writer)
+
+        OSError is raised if a TLS server can't be trusted.
+
+        """
+
+        return await open_connection(self.server_address, self.context,
+                                     self.tls_dir)
+
+    async def send_cmd(self, *cmd, timeout = None):
+        """Send a command to server
+
+        *cmd are arbitary byte strings, timeout overrides the timeout
+        of the client for this request. OSError is raised if there is
+        no answer in time.
+
+        """
+
+        tmp = self.credentials()
+        tmp.extend(cmd)
+        trace_id = None
+        if self.tracer is not None:
+            trace_id = self.trace_id = new_id()
+            tmp.append(trace_part(trace_id))
+        cmd_chain = build_message(tmp)
+
+        if timeout is None:
+            timeout = self.timeout
+        start = time.time()
+        try:
+            return await asyncio.wait_for(self.request(cmd_chain, cmd[0]),
+                                          timeout)
+        except asyncio.TimeoutError:
+            raise OSError('FAIL: No answer from the server within {0} '
+                          'seconds'.format(timeout))
+        finally:
+            if self.tracer is not None:
+                self.tracer.since(trace_id, cmd[0].decode(), start)
+
+    async def request(self, msg, cmd):
+        """Send msg over a pooled connection and return the answer
+
+        cmd is the command of msg, see client.may_retry().
+
+        """
+
+        conn, reused = await self.pool.acquire()
+        reuse = False
+        try:
+            sent = False
+            try:
+                await write_message(conn[1], msg)
+                sent = True
+                answer = await read_message(conn[0])
+            except (ConnectionClosed, ConnectionResetError, BrokenPipeError):
+                if reused is False or may_retry(cmd, sent) is False:
+                    raise
+                conn = await self.pool.replace(conn)
+                answer = await self.exchange(conn, msg)
+            reuse = True
+        finally:
+            self.pool.release(conn, reuse)
+        return answer
+
+    async def exchange(self, conn, msg):
+        """Send a message over conn and return the answer"""
+
+        reader, writer = conn
+        await write_message(writer, msg)
+        return await read_message(reader)
+
+    async def subscribe(self):
+        """Follow the changes of the remote database
+
+        This is an asynchronous generator, see Client.subscribe(). The
+        timeout of the client doesn't apply.
+
+        """
+
+        tmp = self.credentials()
+        tmp.append(b'SUBSCRIBE')
+        reader, writer = await self.connect()
+        try:
+            await write_message(writer, build_message(tmp))
+            async for msg in read_messages(reader):
+                if msg[:4] == b'FAIL':
+                    raise OSError(msg.decode())
+                # The last part is the database and may contain anything
+                yield msg.split(b'\xB2\xEA\xC0', 3)
+        finally:
+            writer.close()
+
+    async def get_bytes(self, cmd, *misc, timeout = None):
+        """Send a command and get the answer as bytes
+
+        cmd is a bytestring with the command
+        *misc are arbitary bytestring needed for the command
+
+        """
+
+        try:
+            db_buf = await self.send_cmd(cmd, *misc, timeout=timeout)
+            if db_buf[:4] == b'FAIL':
+                raise OSError(db_buf.decode())
+            return db_buf
+        except (OSError, TypeError) as err:
+            logging.error(err.__str__())
+            return err.__str__()
+
+    async def get_string(self, cmd, *misc, timeout = None):
+        """Send a command and get the answer decoded"""
+
+        try:
+            answer = (await self.send_cmd(cmd, *misc,
+                                          timeout=timeout)).decode()
+            if answer[:4] == 'FAIL':
+                raise OSError(answer)
+            return answer
+        except (OSError, TypeError) as err:
+            logging.error(err.__str__())
+            return err.__str__()
+
+    async def get_field(self, uuid, field):
+        """Get one attribute of an entry, see Client.get_field()"""
+
+        try:
+            return field_value(await self.send_cmd(b'GETF', uuid,
+                                                   field)).decode()
+        except (OSError, TypeError) as err:
+            logging.error(err.__str__())
+            return err.__str__()
@@ -0,0 +1,430 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+"""This module implements the load generator behind keepassc-bench.
+
+A number of simulated clients send a mix of requests to a server or an
+agent as fast as they can. Every request is timed; the results are
+summed up as throughput, latency percentiles, errors and the CPU time
+the server process used meanwhile.
+
+Functions:
+    parse_mix(text)
+    percentile(values, fraction)
+    process_cpu(pid)
+
+Classes:
+    Bench(object)
+"""
+
+import bisect
+import itertools
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime
+
+from keepassc.conn import *
+from keepassc.client import Client
+
+# The operations a mix may contain, changes are only possible with a
+# server
+OPERATIONS = ('find', 'get', 'change')
+AGENT_OPERATIONS = ('find', 'get')
+
+# Distinct error messages kept per operation
+MAX_ERROR_SAMPLES = 5
+
+
+def parse_mix(text):
+    """Parse a mix like 'find=70,get=20,change=10' into a dict of weights
+
+    ValueError is raised for unknown operations or bad weights.
+
+    """
+
+    mix = {}
+    for item in text.split(','):
+        name, sep, weight = item.strip().partition('=')
+        if sep == '' or name not in OPERATIONS:
+            raise ValueError('Bad mix entry: ' + item)
+        mix[name] = float(weight)
+        if mix[name] < 0:
+            raise ValueError('Negative weight: ' + item)
+    if sum(mix.values()) <= 0:
+        raise ValueError('The mix needs a positive weight')
+    return mix
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of the sorted list values"""
+
+    if not values:
+        return None
+    index = max(0, int(round(fraction * len(values) + 0.5)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def process_cpu(pid):
+    """Return the CPU seconds used by pid and its child processes
+
+    The children are counted to cover the workers of a prefork server.
+    None is returned if /proc can't tell.
+
+    """
+
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0
+    found = False
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return None
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/' + name + '/stat') as handler:
+                stat = handler.read()
+        except OSError:
+            continue
+        # The command name may contain spaces, the fields follow it
+        fields = stat[stat.rindex(')') + 2:].split()
+        if int(name) == pid or int(fields[1]) == pid:
+            total += int(fields[11]) + int(fields[12])
+            found = True
+    if found is False:
+        return None
+    return total / ticks
+
+
+class Bench(object):
+    """Run simulated clients against a server or an agent
+
+    Without agent_port the clients talk to the server with Client, with
+    agent_port they send their requests to the agent on localhost like
+    'keepassc -a' does. pid is the process whose CPU time is measured.
+
+    """
+
+    def __init__(self, address = 'localhost', port = 50000, password = None,
+                 keyfile = None, tls = False, tls_dir = None, clients = 10,
+                 duration = 10, mix = None, agent_port = None, pid = None,
+                 seed = None):
+        if mix is None:
+            mix = {'find': 70, 'get': 20, 'change': 10}
+        if agent_port is not None:
+            for i in mix:
+                if mix[i] > 0 and i not in AGENT_OPERATIONS:
+                    raise ValueError('The agent doesn\'t forward ' + i)
+
+        self.address = address
+        self.port = port
+        self.password = password
+        self.keyfile = keyfile
+        self.tls = tls
+        self.tls_dir = tls_dir
+        self.clients = clients
+        self.duration = duration
+        self.mix = mix
+        self.agent_port = agent_port
+        self.pid = pid
+        self.seed = seed
+        self.titles = []
+        self.group_id = None
+        self.results = []
+        self.lock = threading.Lock()
+        self.ready = None
+        self.done = None
+        self.deadline = None
+        self.started = None
+        self.wall = None
+        self.cpu_start = None
+
+    def client(self):
+        return Client(logging.ERROR, 'bench.log', self.address, self.port,
+                      self.password, self.keyfile, self.tls, self.tls_dir)
+
+    def ask_agent(self, *cmd):
+        """Send a command to the agent and return the answer"""
+
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.settimeout(60)
+        try:
+            conn.connect(('localhost', self.agent_port))
+            sendmsg(conn, build_message(cmd))
+            return receive(conn)
+        finally:
+            conn.close()
+
+    def prepare(self):
+        """Learn the entry titles to search for and the group for
+        changes
+
+        OSError is raised if the server can't be used.
+
+        """
+
+        if self.agent_port is None:
+            answer = self.client().find(b'')
+        else:
+            answer = self.ask_agent(b'FIND', b'').decode()
+        if answer != '' and answer[:7] != 'Title: ':
+            raise OSError(answer)
+        self.titles = [i[7:] for i in answer.split('\n')
+                       if i[:7] == 'Title: ']
+        if not self.titles:
+            raise OSError('The database has no entries to search for')
+
+        if self.mix.get('change', 0) > 0:
+            answer = self.client().list_groups(0)
+            if type(answer) is str:
+                raise OSError(answer)
+            if answer == b'':
+                raise OSError('The database has no group for changes')
+            self.group_id = answer.split(b'\xB2\xEA\xC0', 1)[0]
+
+    def create_entry(self, client, title):
+        """Create the entry a simulated client changes and return its
+        uuid"""
+
+        answer = client.create_entry(title.encode(), b'', b'', b'', b'',
+                                     b'2999', b'12', b'28', self.group_id)
+        if type(answer) is str:
+            raise OSError(answer)
+        answer = client.list_found(title.encode())
+        if type(answer) is str or answer == b'':
+            raise OSError('The entry for changes wasn\'t created')
+        # group id, group title, uuid, ...
+        return bytes.fromhex(answer.split(b'\xB2\xEA\xC0')[2].decode())
+
+    def request(self, client, name, rand, uuid):
+        """Send one request and return None or an error message"""
+
+        if name == 'find':
+            title = rand.choice(self.titles)
+            start = rand.randrange(len(title) + 1)
+            search = title[start:start + 4].lower().encode()
+            if self.agent_port is None:
+                answer = client.find(search)
+            else:
+                answer = self.ask_agent(b'FIND', search).decode()
+            if answer != '' and answer[:7] != 'Title: ':
+                return answer
+        elif name == 'get':
+            if self.agent_port is None:
+                answer = client.get_db()
+            else:
+                answer = self.ask_agent(b'GET')
+            if type(answer) is str:
+                return answer
+            elif answer[:4] == b'FAIL':
+                return answer.decode()
+        else:
+            # The entry is only changed by this client, so the current
+            # time is never older than its modification time
+            now = datetime.now().timetuple()[:6]
+            answer = client.set_e_comment(str(rand.random()).encode(), uuid,
+                                          now)
+            if type(answer) is str:
+                return answer
+        return None
+
+    def simulate(self, number):
+        """Run one simulated client
+
+        Every client sets up its entry for changes, waits for the others
+        at self.ready and sends requests until self.deadline. The entry
+        is deleted again after all clients passed self.done, so the
+        cleanup isn't measured.
+
+        """
+
+        rand = random.Random(None if self.seed is None else
+                             self.seed + number)
+        names = [i for i in sorted(self.mix) if self.mix[i] > 0]
+        cumulative = list(itertools.accumulate(self.mix[i] for i in names))
+        samples = {i: [] for i in names}
+        errors = {i: 0 for i in names}
+        messages = {i: [] for i in names}
+
+        client = None
+        uuid = None
+        try:
+            if self.agent_port is None:
+                client = self.client()
+            if 'change' in names:
+                uuid = self.create_entry(client, 'keepassc-bench {0} {1}'
+                                         .format(os.getpid(), number))
+        except OSError as err:
+            logging.error(err.__str__())
+            messages['setup'] = [err.__str__()]
+            names = []
+
+        self.ready.wait()
+        while names and time.monotonic() < self.deadline:
+            name = names[bisect.bisect(cumulative,
+                                       rand.random() * cumulative[-1])]
+            start = time.perf_counter()
+            try:
+                error = self.request(client, name, rand, uuid)
+            except OSError as err:
+                error = err.__str__()
+            samples[name].append(time.perf_counter() - start)
+            if error is not None:
+                errors[name] += 1
+                if (error not in messages[name] and
+                        len(messages[name]) < MAX_ERROR_SAMPLES):
+                    messages[name].append(error)
+        with self.lock:
+            self.results.append((samples, errors, messages))
+        self.done.wait()
+
+        if uuid is not None:
+            client.delete_entry(uuid, datetime.now().timetuple()[:6])
+
+    def start_clock(self):
+        """Start the measurement, called once all clients are ready"""
+
+        self.deadline = time.monotonic() + self.duration
+        if self.pid is not None:
+            self.cpu_start = process_cpu(self.pid)
+        self.started = time.time()
+        self.wall = time.perf_counter()
+
+    def run(self):
+        """Run the benchmark and return the report as a dict"""
+
+        self.prepare()
+        self.results = []
+        self.cpu_start = None
+        self.ready = threading.Barrier(self.clients + 1,
+                                       action=self.start_clock)
+        self.done = threading.Barrier(self.clients + 1)
+        threads = [threading.Thread(target=self.simulate, args=(i,))
+                   for i in range(self.clients)]
+        for i in threads:
+            i.daemon = True
+            i.start()
+
+        self.ready.wait()
+        self.done.wait()
+        wall = time.perf_counter() - self.wall
+        if self.cpu_start is not None:
+            cpu_end = process_cpu(self.pid)
+        else:
+            cpu_end = None
+        for i in threads:
+            i.join()
+        return self.report(self.started, wall, self.cpu_start, cpu_end)
+
+    def report(self, started, wall, cpu_start, cpu_end):
+        """Sum up the results of all simulated clients"""
+
+        operations = {}
+        total = 0
+        total_errors = 0
+        setup_errors = []
+        for samples, errors, messages in self.results:
+            setup_errors.extend(messages.get('setup', []))
+            for name in samples:
+                op = operations.setdefault(name, {'latencies': [],
+                                                  'errors': 0,
+                                                  'messages': []})
+                op['latencies'].extend(samples[name])
+                op['errors'] += errors[name]
+                for i in messages[name]:
+                    if (i not in op['messages'] and
+                            len(op['messages']) < MAX_ERROR_SAMPLES):
+                        op['messages'].append(i)
+
+        for name, op in operations.items():
+            latencies = sorted(op.pop('latencies'))
+            total += len(latencies)
+            total_errors += op['errors']
+            op['requests'] = len(latencies)
+            op['throughput'] = len(latencies) / wall
+            if latencies:
+                op['mean'] = sum(latencies) / len(latencies)
+                op['max'] = latencies[-1]
+            else:
+                op['mean'] = op['max'] = None
+            op['p50'] = percentile(latencies, 0.50)
+            op['p95'] = percentile(latencies, 0.95)
+            op['p99'] = percentile(latencies, 0.99)
+
+        if cpu_start is not None and cpu_end is not None:
+            cpu = cpu_end - cpu_start
+            cpu_share = cpu / wall
+        else:
+            cpu = cpu_share = None
+
+        return {'started': datetime.fromtimestamp(started).isoformat(),
+                'target': 'agent' if self.agent_port is not None else
+                          'server',
+                'address': self.address,
+                'port': self.agent_port if self.agent_port is not None
+                        else self.port,
+                'tls': self.tls,
+                'clients': self.clients,
+                'duration': wall,
+                'mix': self.mix,
+                'seed': self.seed,
+                'requests': total,
+                'errors': total_errors,
+                'setup_errors': setup_errors,
+                'throughput': total / wall,
+                'server_cpu': cpu,
+                'server_cpu_share': cpu_share,
+                'operations': operations}
+
+    @staticmethod
+    def format(report):
+        """Return a report as text for the terminal"""
+
+        lines = ['{0} clients against the {1} for {2:.1f}s{3}: '
+                 '{4} requests, {5} errors, {6:.1f} req/s'.format(
+                     report['clients'], report['target'],
+                     report['duration'],
+                     ' with TLS' if report['tls'] is True else '',
+                     report['requests'], report['errors'],
+                     report['throughput'])]
+        lines.append('{0:<8}{1:>9}{2:>8}{3:>10}{4:>10}{5:>10}{6:>10}'.format(
+            'op', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+            'p99 ms'))
+        for name in sorted(report['operations']):
+            op = report['operations'][name]
+            ms = ['{0:.2f}'.format(op[i] * 1000) if op[i] is not None
+                  else '-' for i in ('p50', 'p95', 'p99')]
+            lines.append('{0:<8}{1:>9}{2:>8}{3:>10.1f}{4:>10}{5:>10}'
+                         '{6:>10}'.format(name, op['requests'], op['errors'],
+                                          op['throughput'], *ms))
+            for i in op['messages']:
+                lines.append('    ' + i)
+        for i in report['setup_errors']:
+            lines.append('setup failed: ' + i)
+        if report['server_cpu'] is not None:
+            lines.append('Server CPU: {0:.2f}s ({1:.0%} of one core)'.format(
+                report['server_cpu'], report['server_cpu_share']))
+        else:
+            lines.append('Server CPU: unknown')
+        return '\n'.join(lines)
@@ -19,24 +19,341 @@ with keepassc.  If not, see <http://www.gnu.org/licenses/>.
 
 """This module implements the Client class for KeePassC.
 
+Functions:
+    get_tls_context(tls_dir)
+    tls_connect(context, address)
+    keep_tls_session(context, address, conn)
+    check_pin(tls_dir, conn)
+    forget_pin(tls_dir)
+    open_connection(address, context, tls_dir)
+    field_value(answer)
+    may_retry(cmd, sent)
+
 Classes:
+    ConnectionPool(object)
     Client(Connection)
 """
 
 import logging
+import select
 import socket
 import ssl
+import threading
+import time
+from functools import partial
 from os.path import join, expanduser, realpath, isfile
 from hashlib import sha256
 
 from keepassc.conn import *
+from keepassc.logqueue import setup_logging
+from keepassc.trace import new_id, trace_part
+
+# The TLS contexts by CA file and the last TLS session by context and
+# server address. They are shared by all clients of the process, so a
+# new Client (DBBrowser creates one per change) neither loads the CA
+# again nor needs a full handshake.
+_tls_lock = threading.Lock()
+_tls_contexts = {}
+_tls_sessions = {}
+# The pinned certificate hash by TLS directory and the certificate
+# last found to match it, so neither the pin file is read nor the
+# certificate hashed again for every connection
+_tls_pins = {}
+
+# Connections a Client opens at most at the same time
+POOL_SIZE = 4
+# Seconds an unused connection is kept, less than the keepalive of the
+# server so that the server rarely closes it first
+IDLE_TIMEOUT = 20
+
+
+def get_tls_context(tls_dir):
+    """Return the process wide client SSLContext for tls_dir/cacert.pem"""
+
+    cafile = realpath(join(tls_dir, 'cacert.pem'))
+    with _tls_lock:
+        context = _tls_contexts.get(cafile)
+        if context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.load_verify_locations(cafile)
+            _tls_contexts[cafile] = context
+    return context
+
+
+def tls_connect(context, address):
+    """Return a TLS connection to address
+
+    The last session with the server is offered for resumption. If the
+    server doesn't know it anymore, a full handshake is done.
+
+    """
+
+    with _tls_lock:
+        session = _tls_sessions.get((id(context), address))
+    conn = context.wrap_socket(socket.socket(socket.AF_INET,
+                                             socket.SOCK_STREAM),
+                               session = session)
+    try:
+        conn.connect(address)
+    except:
+        conn.close()
+        raise
+    if conn.session_reused is True:
+        logging.info('Resumed TLS session with %s:%d', address[0], address[1])
+    return conn
+
+
+def keep_tls_session(context, address, conn):
+    """Remember the session of conn for the next tls_connect()
+
+    This has to be called after the answer was received because
+    session tickets may be sent after the handshake.
+
+    """
+
+    session = conn.session
+    if session is not None:
+        with _tls_lock:
+            _tls_sessions[(id(context), address)] = session
+
+
+def check_pin(tls_dir, conn):
+    """Check the certificate of conn against the pin in tls_dir
+
+    The first certificate seen is pinned. OSError is raised if it
+    differs from the pinned one or if its hostname doesn't match.
+
+    """
+
+    path = realpath(join(tls_dir, 'pin'))
+    cert = conn.getpeercert(True)
+    with _tls_lock:
+        pin = _tls_pins.get(path)
+    if pin is not None and pin[1] == cert:
+        return
+
+    digest = sha256(cert).digest()
+    if pin is None:
+        if not isfile(path):
+            with open(path, 'wb') as handler:
+                handler.write(digest)
+            pinned = digest
+        else:
+            with open(path, 'rb') as handler:
+                pinned = handler.read()
+    else:
+        pinned = pin[0]
+    if pinned != digest:
+        raise OSError('FAIL: Server certificate differs from pinned '
+                      'certificate')
+    try:
+        ssl.match_hostname(conn.getpeercert(), "KeePassC Server")
+    except:
+        raise OSError('FAIL: TLS - Hostname does not match')
+    with _tls_lock:
+        _tls_pins[path] = (pinned, cert)
+
+
+def forget_pin(tls_dir = None):
+    """Read the pin of tls_dir, or of all directories, again next time
+
+    Call it after the pin file was changed or removed.
+
+    """
+
+    with _tls_lock:
+        if tls_dir is None:
+            _tls_pins.clear()
+        else:
+            _tls_pins.pop(realpath(join(tls_dir, 'pin')), None)
+
+
+def open_connection(address, context = None, tls_dir = None):
+    """Return a new connection to the server at address
+
+    With an SSLContext the connection uses TLS and the certificate is
+    checked against the pin in tls_dir. OSError is raised if a TLS
+    server can't be trusted.
+
+    """
+
+    if context is not None:
+        conn = tls_connect(context, address)
+    else:
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            conn.connect(address)
+        except:
+            conn.close()
+            raise
+    logging.info('Connected to %s:%d', address[0], address[1])
+    conn.settimeout(60)
+    if context is None:
+        return conn
+
+    try:
+        check_pin(tls_dir, conn)
+    except:
+        conn.close()
+        raise
+    return conn
+
+
+def field_value(answer):
+    """Return the value of a GETF answer
+
+    OSError is raised if the server answered with an error.
+
+    """
+
+    status, sep, value = answer.partition(b'\xB2\xEA\xC0')
+    if status != b'OK' or not sep:
+        raise OSError(answer.decode(errors='replace'))
+    return value
+
+
+def may_retry(cmd, sent):
+    """Return whether a request failed on a reused connection is resent
+
+    The server may have closed the idle connection just before the
+    request arrived. If sending failed the server didn't get it, else
+    it may have made a change and failed afterwards, so only commands
+    in READ_COMMANDS are sent again.
+
+    """
+
+    return sent is False or cmd in READ_COMMANDS
+
+
+class ConnectionPool(object):
+    """Keep connections to a server open for the next request
+
+    connect is called to open a new connection. It shouldn't refer to
+    the owner of the pool, e.g. be one of its methods, else the owner
+    and its idle connections are only freed by the garbage collector.
+    At most size connections are in use at the same time, acquire()
+    waits for a free one. Connections unused for idle_timeout seconds
+    or closed by the server are not reused.
+
+    """
+
+    def __init__(self, connect, size = POOL_SIZE,
+                 idle_timeout = IDLE_TIMEOUT):
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        # (connection, time it was released), the newest last
+        self.idle = []
+        self.closed = False
+
+    def acquire(self, timeout = 60):
+        """Return a connection and whether it was used before
+
+        OSError is raised if no connection is free after timeout
+        seconds.
+
+        """
+
+        if self.slots.acquire(timeout=timeout) is False:
+            raise OSError('FAIL: No free connection to the server')
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    conn, released = self.idle.pop()
+                if (time.monotonic() - released < self.idle_timeout and
+                        self.healthy(conn)):
+                    return conn, True
+                self.close_conn(conn)
+            return self.connect(), False
+        except:
+            self.slots.release()
+            raise
+
+    def release(self, conn, reuse = True):
+        """Give back a connection from acquire()
+
+        It is closed if reuse is False, e.g. after an error.
+
+        """
+
+        try:
+            with self.lock:
+                # Connections in use when the pool was closed
+                reuse = reuse is True and self.closed is False
+                if reuse is True:
+                    self.idle.append((conn, time.monotonic()))
+            if reuse is True:
+                self.evict()
+            else:
+                self.close_conn(conn)
+        finally:
+            self.slots.release()
+
+    def replace(self, conn):
+        """Close a connection from acquire() and return a new one"""
+
+        self.close_conn(conn)
+        return self.connect()
+
+    def healthy(self, conn):
+        """Return whether an idle connection can be used
+
+        The server never sends anything unasked, so a readable
+        connection was closed by it.
+
+        """
+
+        try:
+            return not select.select([conn], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+
+    def evict(self):
+        """Close the connections idle for longer than idle_timeout"""
+
+        now = time.monotonic()
+        with self.lock:
+            expired = [i for i in self.idle
+                       if now - i[1] >= self.idle_timeout]
+            self.idle = [i for i in self.idle
+                         if now - i[1] < self.idle_timeout]
+        for conn, released in expired:
+            self.close_conn(conn)
+
+    def close(self):
+        """Close all idle connections and those in use once released"""
+
+        with self.lock:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+        for conn, released in idle:
+            self.close_conn(conn)
+
+    def close_conn(self, conn):
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+
 
 class Client(object):
-    """The KeePassC client"""
+    """The KeePassC client
+
+    The connections to the server are kept open and reused by the
+    following requests, also by other threads. close() closes them.
+
+    """
 
     def __init__(self, loglevel, logfile, server_address = 'localhost',
                  server_port = 50000, password = None, keyfile = None,
-                 tls = False, tls_dir = None):
+                 tls = False, tls_dir = None, tracer = None,
+                 pool_size = POOL_SIZE, idle_timeout = IDLE_TIMEOUT):
         try:
             logdir = realpath(expanduser(getenv('XDG_DATA_HOME')))
         except:
@@ -44,31 +361,47 @@ class Client(object):
         finally:
             logfile = join(logdir, 'keepassc', logfile)
 
-        logging.basicConfig(format='[%(levelname)s] in %(filename)s:'
-                                   '%(funcName)s at %(asctime)s\n%(message)s',
-                            level=loglevel, filename=logfile,
-                            filemode='a')
+        setup_logging(loglevel, logfile)
 
         self.password = password
         self.keyfile = keyfile
+        # The password, the keyfile path and the message parts built
+        # from them, see credentials()
+        self.cached_credentials = None
         self.server_address = (server_address, server_port)
 
         self.tls_dir = tls_dir
+        # A trace.Tracer to trace every request with a new ID, the ID
+        # of the last one is kept
+        self.tracer = tracer
+        self.trace_id = None
 
         if tls is True:
-            self.context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-            self.context.verify_mode = ssl.CERT_REQUIRED
-            logging.error(tls_dir)
-            self.context.load_verify_locations(tls_dir + "/cacert.pem")
+            self.context = get_tls_context(tls_dir)
         else:
             self.context = None
+        self.pool = ConnectionPool(
+            partial(open_connection, self.server_address, self.context,
+                    tls_dir), pool_size, idle_timeout)
 
-    def send_cmd(self, *cmd):
-        """Send a command to server
+    def close(self):
+        """Close the connections kept open"""
 
-        *cmd are arbitary byte strings
+        self.pool.close()
+
+    def credentials(self):
+        """Return the password and keyfile parts of a message
+
+        The keyfile is read once and kept until password or keyfile
+        are set to something else or reload() is called.
 
         """
+
+        cached = self.cached_credentials
+        if (cached is not None and cached[0] == self.password and
+                cached[1] == self.keyfile):
+            return list(cached[2])
+
         if self.keyfile is not None:
             with open(self.keyfile, 'rb') as keyfile:
                 key = keyfile.read()
@@ -78,54 +411,99 @@ class Client(object):
             password = b''
         else:
             password = self.password.encode()
+        self.cached_credentials = (self.password, self.keyfile,
+                                   (password, key))
+        return [password, key]
+
+    def reload(self):
+        """Read the keyfile and the TLS pin again for the next request"""
+
+        self.cached_credentials = None
+        if self.tls_dir is not None:
+            forget_pin(self.tls_dir)
+
+    def connect(self):
+        """Return a new connection to the server
+
+        OSError is raised if a TLS server can't be trusted.
+
+        """
+
+        return open_connection(self.server_address, self.context,
+                               self.tls_dir)
+
+    def send_cmd(self, *cmd):
+        """Send a command to server
+
+        *cmd are arbitary byte strings
+
+        """
 
-        tmp = [password, key]
+        tmp = self.credentials()
         tmp.extend(cmd)
+        if self.tracer is not None:
+            self.trace_id = new_id()
+            tmp.append(trace_part(self.trace_id))
         cmd_chain = build_message(tmp)
 
+        start = time.time()
+        conn, reused = self.pool.acquire()
+        reuse = False
         try:
-            tmp_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            if self.context is not None:
-                conn = self.context.wrap_socket(tmp_conn)
-            else:
-                conn = tmp_conn
-            conn.connect(self.server_address)
-        except:
-            raise
-        else:
-            logging.info('Connected to '+self.server_address[0]+':'+
-                         str(self.server_address[1]))
-        try:
-            conn.settimeout(60)
-            if self.context is not None:
-                if not isfile(self.tls_dir + '/pin'):
-                    sha = sha256()
-                    sha.update(conn.getpeercert(True))
-                    with open(self.tls_dir + '/pin', 'wb') as pin:
-                        pin.write(sha.digest())
-                else:
-                    with open(self.tls_dir + '/pin', 'rb') as pin:
-                        pinned_key = pin.read()
-                    sha = sha256()
-                    sha.update(conn.getpeercert(True))
-                    if pinned_key != sha.digest():
-                        return (b'FAIL: Server certificate differs from '
-                                b'pinned certificate')
-                cert = conn.getpeercert()
-                try:
-                    ssl.match_hostname(cert, "KeePassC Server")
-                except:
-                    return b'FAIL: TLS - Hostname does not match'
-            sendmsg(conn, cmd_chain)
-            answer = receive(conn)
-        except:
-            raise
+            sent = False
+            try:
+                sendmsg(conn, cmd_chain)
+                sent = True
+                answer = self.receive_answer(conn)
+            except (ConnectionClosed, ConnectionResetError, BrokenPipeError):
+                if reused is False or may_retry(cmd[0], sent) is False:
+                    raise
+                conn = self.pool.replace(conn)
+                answer = self.exchange(conn, cmd_chain)
+            reuse = True
         finally:
-            conn.shutdown(socket.SHUT_RDWR)
-            conn.close()
+            self.pool.release(conn, reuse)
+            if self.tracer is not None:
+                self.tracer.since(self.trace_id, cmd[0].decode(), start)
 
         return answer
 
+    def exchange(self, conn, msg):
+        """Send a message over conn and return the answer"""
+
+        sendmsg(conn, msg)
+        return self.receive_answer(conn)
+
+    def receive_answer(self, conn):
+        """Return the answer to the message sent over conn"""
+
+        answer = receive(conn)
+        if self.context is not None:
+            keep_tls_session(self.context, self.server_address, conn)
+        return answer
+
+    def subscribe(self):
+        """Follow the changes of the remote database
+
+        This is a generator which yields the messages the server streams
+        as lists of their parts, starting with the current database. It
+        ends when the server closes the connection.
+
+        """
+
+        tmp = self.credentials()
+        tmp.append(b'SUBSCRIBE')
+        conn = self.connect()
+        try:
+            sendmsg(conn, build_message(tmp))
+            for msg in receive_messages(conn):
+                if msg[:4] == b'FAIL':
+                    raise OSError(msg.decode())
+                # The last part is the database and may contain anything
+                yield msg.split(b'\xB2\xEA\xC0', 3)
+        finally:
+            conn.close()
+
     def get_bytes(self, cmd, *misc):
         """Send a command and get the answer as bytes
 
@@ -165,6 +543,54 @@ class Client(object):
 
         return self.get_bytes(b'GET')
 
+    def get_version(self):
+        """Get the version of the database image get_db() returns"""
+
+        return self.get_string(b'VER')
+
+    def get_entry(self, uuid):
+        """Get one entry by its uuid (raw or as hex string)"""
+
+        return self.get_string(b'GETE', uuid)
+
+    def get_field(self, uuid, field):
+        """Get one attribute of an entry, e.g. b'password'
+
+        Like get_string() an error is returned as string, use
+        send_cmd() and field_value() to tell errors and values apart.
+
+        """
+
+        try:
+            return field_value(self.send_cmd(b'GETF', uuid, field)).decode()
+        except (OSError, TypeError) as err:
+            logging.error(err.__str__())
+            return err.__str__()
+
+    def list_groups(self, group_id):
+        """List the child groups of a group, 0 is the root"""
+
+        return self.get_bytes(b'LSG', str(group_id).encode())
+
+    def list_entries(self, group_id):
+        """List the entries of a group without their passwords"""
+
+        return self.get_bytes(b'LSE', str(group_id).encode())
+
+    def list_found(self, title):
+        """List the entries whose title contains title"""
+
+        return self.get_bytes(b'LSF', title)
+
+    def stats(self):
+        """Get the request statistics of the server
+
+        This is only allowed from localhost (127.0.0.1)
+
+        """
+
+        return self.get_string(b'STATS')
+
     def change_password(self, password, keyfile):
         """Change the password of the remote database
 
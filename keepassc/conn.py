@@ -22,11 +22,32 @@ with keepassc.  If not, see <http://www.gnu.org/licenses/>.
 Functions:
     build_message(parts)
     receive(conn)
+    receive_messages(conn)
     sendmsg(sock, msg)
+
+Classes:
+    ConnectionClosed(ConnectionError)
 """
 
 import logging
 
+# Commands which don't change the database. A follower serves only
+# these and a client may send them again after a connection failed.
+READ_COMMANDS = (b'FIND', b'GET', b'GETE', b'GETF', b'LSG', b'LSE', b'LSF',
+                 b'STATS', b'SUBSCRIBE', b'VER')
+
+
+class ConnectionClosed(ConnectionError):
+    """The peer closed the connection before a message was complete
+
+    received is the number of bytes of the message which arrived.
+
+    """
+
+    def __init__(self, received = 0):
+        ConnectionError.__init__(self, 'Connection closed by peer')
+        self.received = received
+
 
 def build_message(parts):
     """Join many parts to one message with a seperator
@@ -41,13 +62,7 @@ def build_message(parts):
 
     """
 
-    msg = b''
-    for i in parts[:-1]:
-        msg += i
-        msg += b'\xB2\xEA\xC0' # \xB2\xEA\xC0 = BREAK
-    msg += parts[-1]
-
-    return msg
+    return b'\xB2\xEA\xC0'.join(parts) # \xB2\xEA\xC0 = BREAK
 
 def receive(conn):
     """Receive a message
@@ -59,22 +74,43 @@ def receive(conn):
     """
 
     ip, port = conn.getpeername()
-    logging.info('Receiving a message from '+ip+':'+str(port))
-    data = b''
+    logging.info('Receiving a message from %s:%d', ip, port)
+    data = bytearray()
+    while True:
+        received = conn.recv(65536)
+        if not received:
+            raise ConnectionClosed(len(data))
+        # The end may have been split between two reads
+        pos = max(len(data) - 3, 0)
+        data += received
+        end = data.find(b'\xDE\xAD\xE1\x1D', pos)
+        if end != -1:
+            return bytes(data[:end])
+
+def receive_messages(conn):
+    """Receive messages until the connection is closed
+
+    This is a generator for connections which carry a stream of
+    messages. Unlike receive() it keeps the data following the end of a
+    message for the next one.
+
+    """
+
+    data = bytearray()
     while True:
-        try:
-            received = conn.recv(16)
-        except:
-            raise
-        if b'\xDE\xAD\xE1\x1D' in received:
-            data += received[:received.find(b'\xDE\xAD\xE1\x1D')]
-            break
-        else:
-            data += received
-            if data[-4:] == b'\xDE\xAD\xE1\x1D':
-                data = data[:-4]
+        received = conn.recv(65536)
+        if not received:
+            return
+        # The end may have been split between two reads
+        pos = max(len(data) - 3, 0)
+        data += received
+        while True:
+            end = data.find(b'\xDE\xAD\xE1\x1D', pos)
+            if end == -1:
                 break
-    return data
+            yield bytes(data[:end])
+            del data[:end + 4]
+            pos = 0
 
 def sendmsg(sock, msg):
     """Send message
@@ -87,7 +123,7 @@ def sendmsg(sock, msg):
 
     ip, port = sock.getpeername()
     try:
-        logging.info('Send a message to '+ip+':'+str(port))
+        logging.info('Send a message to %s:%d', ip, port)
         # \xDE\xAD\xE1\x1D = DEAD END
         sock.sendall(msg + b'\xDE\xAD\xE1\x1D')
     except:
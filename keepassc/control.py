@@ -19,7 +19,6 @@ with keepassc.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 import curses as cur
-import logging
 from curses.ascii import NL, DEL, SP
 from datetime import date
 from os import chdir, getcwd, getenv, geteuid, makedirs, remove
@@ -33,11 +32,12 @@ from kppy.database import KPDBv1
 from kppy.exceptions import KPError
 
 from keepassc.conn import *
-from keepassc.client import Client
+from keepassc.dbcache import DBCache
 from keepassc.editor import Editor
 from keepassc.helper import parse_config, write_config
 from keepassc.filebrowser import FileBrowser
 from keepassc.dbbrowser import DBBrowser
+from keepassc.remote import RemoteDB
 
 
 class Control(object):
@@ -1161,18 +1161,20 @@ class Control(object):
             else:
                 tls_dir = None
 
-            client = Client(logging.INFO, 'client.log', server, port,
-                            password, keyfile, ssl, tls_dir)
-            db_buf = client.get_db()
-            if db_buf[:4] == 'FAIL' or db_buf[:4] == "[Err":
-                self.draw_text(False,
-                               (1, 0, db_buf),
-                               (3, 0, 'Press any key.'))
-                if self.any_key() == -1:
-                    self.close()
-                return False
-        self.db = KPDBv1(None, password, keyfile)
-        self.db.load(db_buf)
+        # Only the groups and entries shown are fetched from the server,
+        # unless an image of the database is cached from the last time
+        self.db = RemoteDB(server, port, ssl, tls_dir,
+                           DBCache(self.data_home, server, port))
+        try:
+            self.db.unlock(password, keyfile)
+        except KPError as err:
+            self.db = None
+            self.draw_text(False,
+                           (1, 0, err.__str__()),
+                           (3, 0, 'Press any key.'))
+            if self.any_key() == -1:
+                self.close()
+            return False
         db = DBBrowser(self, True, server, port, ssl, tls_dir)
         del db
         return True
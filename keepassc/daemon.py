@@ -23,12 +23,16 @@ import time
 import atexit
 import signal
 
+from keepassc.profiling import Profiler
+
 class Daemon(object):
     """A generic daemon class.
 
     Usage: subclass the daemon class and override the run() method."""
 
-    def __init__(self, pidfile): self.pidfile = pidfile
+    def __init__(self, pidfile):
+        self.pidfile = pidfile
+        self.profiler = None
 
     def daemonize(self):
         """Deamonize class. UNIX double fork mechanism."""
@@ -74,6 +78,11 @@ class Daemon(object):
         pid = str(os.getpid())
         with open(self.pidfile,'w+') as f:
             f.write(pid + '\n')
+
+        # SIGUSR1 and SIGUSR2 profile the detached process, the results
+        # go next to the pidfile
+        self.profiler = Profiler(os.path.dirname(self.pidfile))
+        self.profiler.install()
         
     def delpid(self):
         os.remove(self.pidfile)
@@ -19,7 +19,6 @@ with keepassc.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 import curses as cur
-import logging
 import os
 import threading
 import webbrowser
@@ -27,10 +26,8 @@ from curses.ascii import NL, DEL, ESC
 from os.path import isfile, isdir
 from subprocess import Popen, PIPE
 
-from kppy.database import KPDBv1
 from kppy.exceptions import KPError
 
-from keepassc.client import Client
 from keepassc.editor import Editor
 from keepassc.filebrowser import FileBrowser
 
@@ -253,7 +250,10 @@ class DBBrowser(object):
     def db_close(self):
         '''Close the database correctly.'''
 
-        if self.db.filepath is not None:
+        if self.remote is True:
+            # Closes the connections to the server
+            self.db.close()
+        elif self.db.filepath is not None:
             try:
                 self.db.close()
             except KPError as err:
@@ -313,9 +313,36 @@ class DBBrowser(object):
                                     (2, 0, 'Use a keyfile (2)'),
                                     (3, 0, 'Use both (3)'))
 
+    def refuse_change(self):
+        '''Tell that the cached remote database can't be changed'''
+
+        self.control.draw_text(self.changed,
+                               (1, 0, 'The server can\'t be reached, the '
+                                      'cached database is read-only.'),
+                               (4, 0, 'Press any key.'))
+        if self.control.any_key() == -1:
+            self.close()
+        self.control.show_groups(self.g_highlight, self.groups,
+                                 self.cur_win, self.g_offset,
+                                 self.changed, self.cur_root)
+        self.control.show_entries(self.e_highlight, self.entries,
+                                  self.cur_win, self.e_offset)
+
     def reload_remote_db(self, db_buf = None):
+        """Fetch the shown groups again after a change
+
+        The answer of the server to a change (db_buf) isn't needed
+        because only the groups on the way to the current one are listed
+        again.
+
+        """
+
         if self.remote is True:
-            old_root = self.cur_root
+            old_path = []
+            group = self.cur_root
+            while group is not None and group is not self.db.root_group:
+                old_path.insert(0, group.id_)
+                group = group.parent
             if self.groups:
                 old_group_id = self.groups[self.g_highlight].id_
             else:
@@ -325,21 +352,20 @@ class DBBrowser(object):
             else:
                 old_entry_uuid = None
 
-            if db_buf == None:
-                db_buf = self.client().get_db()
-                if self.check_answer(db_buf) is False:
-                    return False
-            self.db = KPDBv1(None, self.db.password, self.db.keyfile)
-            self.db.load(db_buf)
-            self.control.db = self.db
-
-            # This loop has to be executed _before_ sort_tables is called
-            for i in self.db.groups:
-                if i.id_ == old_root.id_:
-                    self.cur_root = i
-                    break
+            try:
+                self.db.refresh()
+            except KPError as err:
+                self.check_answer(err.__str__())
+                return False
+
+            self.cur_root = self.db.root_group
+            for group_id in old_path:
+                for i in self.cur_root.children:
+                    if i.id_ == group_id:
+                        self.cur_root = i
+                        break
                 else:
-                    self.cur_root = self.db.root_group
+                    break
 
             self.sort_tables(True, True)
 
@@ -352,6 +378,7 @@ class DBBrowser(object):
                         self.g_highlight = 0
             else:
                 self.g_highlight = 0
+            self.sort_tables(False, True)
 
             if self.entries and old_entry_uuid:
                 for i in self.entries:
@@ -419,15 +446,9 @@ class DBBrowser(object):
             if self.lock_highlight != 3:  # Only keyfile needed
                 password = None
 
-        if self.remote is True:
-            db_buf = self.client().get_db()
-            if self.check_answer(db_buf) is False:
-                return False
-        else:
-            db_buf = None
-
         try:
-            self.db.unlock(password, keyfile, db_buf)
+            # A remote database checks the credentials with the server
+            self.db.unlock(password, keyfile)
         except KPError as err:
             self.control.draw_text(self.changed,
                                    (1, 0, err.__str__()),
@@ -994,7 +1015,7 @@ class DBBrowser(object):
     def find_entries(self):
         '''Find entries by title'''
 
-        if self.db.entries:
+        if self.remote is True or self.db.entries:
             title = Editor(self.control.stdscr, max_text_size=1,
                            win_location=(0, 1),
                            win_size=(1, 80), title="Title Search: ")()
@@ -1006,10 +1027,18 @@ class DBBrowser(object):
                 result_group = self.db.groups[-1]
                 result_group.id_ = 0
 
-                for i in self.db.entries:
-                    if title.lower() in i.title.lower():
-                        result_group.entries.append(i)
-                        self.cur_win = 1
+                if self.remote is True:
+                    try:
+                        found = self.db.find(title)
+                    except KPError as err:
+                        found = []
+                        self.check_answer(err.__str__())
+                else:
+                    found = [i for i in self.db.entries
+                             if title.lower() in i.title.lower()]
+                for i in found:
+                    result_group.entries.append(i)
+                    self.cur_win = 1
                 self.cur_root = self.db.root_group
                 self.sort_tables(True, True, True)
                 self.e_highlight = 0
@@ -1237,11 +1266,8 @@ class DBBrowser(object):
                 self.changed = True
 
     def client(self):
-        return Client(logging.ERROR, 'client.log', 
-                      self.address, 
-                      self.port, self.db.password, 
-                      self.db.keyfile, self.ssl, 
-                      self.tls_dir)
+        # Shares the connections of the remote database
+        return self.db.client()
 
     def check_answer(self, answer):
         if answer[:4] == 'FAIL' or answer[:4] == "[Err":
@@ -1480,6 +1506,11 @@ class DBBrowser(object):
             ESC: self.move_abort,
             cur.KEY_F1: self.control.move_help}
 
+        # Refused while a cached remote database can't be changed
+        changes = (ord('g'), ord('G'), ord('y'), ord('d'), ord('t'),
+                   ord('u'), ord('U'), ord('C'), ord('p'), ord('E'),
+                   ord('m'))
+
         exceptions = (ord('s'), ord('S'), ord('P'), ord('t'), ord('p'), 
                       ord('u'), ord('U'), ord('C'), ord('E'), ord('H'), 
                       ord('g'), ord('d'), ord('y'), ord('f'), ord('/'),
@@ -1503,7 +1534,15 @@ class DBBrowser(object):
                 c = 4
             if type(self.lock_timer) is threading.Timer:
                 self.lock_timer.cancel()
+            if (self.state == 0 and self.remote is True and
+                    self.db.has_update() is True):
+                # A newer image of the server arrived in the background
+                self.reload_remote_db()
             if self.state == 0:
+                if (self.remote is True and self.db.read_only is True and
+                        c in changes):
+                    self.refuse_change()
+                    continue
                 if c == ord('\t'):  # Switch group/entry view with tab.
                     if self.cur_win == 0:
                         c = cur.KEY_RIGHT
@@ -0,0 +1,96 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+"""This module implements the local cache of remote databases.
+
+The last database image downloaded from a server is kept in the cache
+directory of the keepassc data directory. The image is the database
+file as the server stores it, so it stays encrypted with the master key
+and is only readable by the user.
+
+The version of an image is its SHA-256 as hex string, which is what
+the server answers to VER. A client compares it with the version of its
+cached image to find out whether the cache is current without
+downloading the database.
+
+Functions:
+    image_version(buf)
+
+Classes:
+    DBCache(object)
+"""
+
+import logging
+import os
+from hashlib import sha256
+from os.path import join
+
+
+def image_version(buf):
+    """Return the version of the database image buf"""
+
+    return sha256(buf).hexdigest()
+
+
+class DBCache(object):
+    """The cached database image of the server at address:port
+
+    directory is the keepassc data directory.
+
+    """
+
+    def __init__(self, directory, address, port):
+        self.directory = join(directory, 'cache')
+        # Only '/' can't be part of a file name
+        self.path = join(self.directory, '{0}_{1}.kdb'.format(
+            address.replace('/', '_'), port))
+
+    def load(self):
+        """Return the cached image or None if there is none"""
+
+        try:
+            with open(self.path, 'rb') as handler:
+                return handler.read()
+        except OSError:
+            return None
+
+    def store(self, buf):
+        """Replace the cached image with buf"""
+
+        try:
+            os.makedirs(self.directory, 0o700, exist_ok=True)
+            tmp = self.path + '.tmp'
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as handler:
+                handler.write(buf)
+                handler.flush()
+                os.fsync(handler.fileno())
+            os.replace(tmp, self.path)
+        except OSError as err:
+            logging.error('Could not cache the database: %s', err)
+
+    def remove(self):
+        """Forget the cached image"""
+
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            logging.error('Could not remove the cached database: %s', err)
@@ -0,0 +1,226 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+"""This module implements the compact entry index of the server.
+
+FIND, LSF and uuid lookups only need the uuid, title and group of an
+entry. EntryIndex keeps those in flat lists and arrays, so a scan
+doesn't touch the kppy entries. The remaining fields of every entry
+(URL, username, password, comment, attachment and dates) are packed
+into one buffer for all entries and unpacked into an IndexedEntry only
+for the entries a response contains.
+
+The kppy entries are left as they are, so the database can be changed
+and saved without the index. The index is a snapshot, readers which
+still use it afterwards see the database as it was. An entry has to be
+passed to mark_changed() before one of its PACKED fields changes, then
+a new index of the same database takes the packed fields of all other
+entries from the previous one and only packs the changed entries again.
+
+Functions:
+    pack(entry)
+    unpack(packed, offset)
+
+Classes:
+    IndexedEntry(object)
+    EntryIndex(object)
+"""
+
+import struct
+from array import array
+from datetime import datetime, timedelta
+
+STRINGS = ('url', 'username', 'password', 'comment', 'binary_desc')
+DATES = ('creation', 'last_mod', 'last_access', 'expire')
+# The fields which are packed
+PACKED = STRINGS + ('binary',) + DATES
+
+# Byte lengths of the strings and the binary, then the dates in
+# microseconds since EPOCH; -1 stands for None
+HEADER = struct.Struct('<6i4q')
+EPOCH = datetime(1, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def pack(entry):
+    """Return the PACKED fields of a kppy entry as bytes"""
+
+    lengths = []
+    values = []
+    for name in STRINGS:
+        value = getattr(entry, name)
+        if value is None:
+            lengths.append(-1)
+        else:
+            value = value.encode()
+            lengths.append(len(value))
+            values.append(value)
+    if entry.binary is None:
+        lengths.append(-1)
+    else:
+        lengths.append(len(entry.binary))
+        values.append(entry.binary)
+    for name in DATES:
+        value = getattr(entry, name)
+        if value is None:
+            lengths.append(-1)
+        else:
+            lengths.append((value - EPOCH) // MICROSECOND)
+    return HEADER.pack(*lengths) + b''.join(values)
+
+
+def unpack(packed, offset = 0):
+    """Return the PACKED fields at offset as tuple in their order"""
+
+    header = HEADER.unpack_from(packed, offset)
+    fields = []
+    pos = offset + HEADER.size
+    for length in header[:len(STRINGS)]:
+        if length == -1:
+            fields.append(None)
+        else:
+            fields.append(packed[pos:pos + length].decode())
+            pos += length
+    length = header[len(STRINGS)]
+    if length == -1:
+        fields.append(None)
+    else:
+        fields.append(packed[pos:pos + length])
+    for value in header[len(STRINGS) + 1:]:
+        if value == -1:
+            fields.append(None)
+        else:
+            fields.append(EPOCH + timedelta(microseconds=value))
+    return tuple(fields)
+
+
+class IndexedEntry(object):
+    """All fields of one entry, unpacked for a response
+
+    It has the attributes of a kppy entry the server formats, the
+    group as group_id only.
+
+    """
+
+    __slots__ = ('uuid', 'title', 'image', 'group_id') + PACKED
+
+    def __init__(self, uuid, title, image, group_id, packed, offset = 0):
+        self.uuid = uuid
+        self.title = title
+        self.image = image
+        self.group_id = group_id
+        for name, value in zip(PACKED, unpack(packed, offset)):
+            setattr(self, name, value)
+
+
+class EntryIndex(object):
+    """The searchable columns of a database and its packed entries
+
+    previous is the last index of db, if any. stale is set when db
+    changes, so that the next read builds a new index.
+
+    """
+
+    __slots__ = ('db', 'entries', 'uuids', 'titles', 'folded', 'group_ids',
+                 'images', 'packed', 'offsets', 'positions', 'groups',
+                 'changed', 'stale')
+
+    def __init__(self, db, previous = None):
+        if previous is not None and previous.db is not db:
+            previous = None
+        self.db = db
+        self.entries = entries = list(db.entries)
+        self.uuids = [i.uuid for i in entries]
+        self.titles = [i.title for i in entries]
+        self.folded = []
+        for title in self.titles:
+            if title is None:
+                title = ''
+            folded = title.lower()
+            # Most titles are already lower case, so share the string
+            self.folded.append(title if folded == title else folded)
+        self.group_ids = array('I', (i.group_id or 0 for i in entries))
+        self.images = array('I', (i.image or 0 for i in entries))
+        self.positions = {uuid: pos for pos, uuid in enumerate(self.uuids)
+                          if uuid is not None}
+        self.groups = {i.id_: i.title for i in db.groups}
+        # The fields of the entry at pos are packed[offsets[pos]:
+        # offsets[pos + 1]]
+        packed = []
+        self.offsets = array('Q', [0])
+        size = 0
+        for entry in entries:
+            data = None
+            if previous is not None:
+                data = previous.unchanged(entry)
+            if data is None:
+                data = pack(entry)
+            packed.append(data)
+            size += len(data)
+            self.offsets.append(size)
+        self.packed = b''.join(packed)
+        # Positions of entries passed to mark_changed()
+        self.changed = set()
+        self.stale = False
+
+    def __len__(self):
+        return len(self.uuids)
+
+    def search(self, text):
+        """Return the positions of the entries whose title contains text
+
+        text has to be lower case.
+
+        """
+
+        return [pos for pos, title in enumerate(self.folded)
+                if text in title]
+
+    def position(self, uuid):
+        """Return the position of the entry with uuid or None"""
+
+        return self.positions.get(uuid)
+
+    def entry(self, pos):
+        """Return the entry at pos as IndexedEntry"""
+
+        return IndexedEntry(self.uuids[pos], self.titles[pos],
+                            self.images[pos], self.group_ids[pos],
+                            self.packed, self.offsets[pos])
+
+    def group_title(self, pos):
+        """Return the title of the group of the entry at pos"""
+
+        return self.groups.get(self.group_ids[pos])
+
+    def unchanged(self, entry):
+        """Return the packed fields of entry if it didn't change since"""
+
+        pos = self.positions.get(entry.uuid)
+        if (pos is None or self.entries[pos] is not entry or
+                pos in self.changed):
+            return None
+        return self.packed[self.offsets[pos]:self.offsets[pos + 1]]
+
+    def mark_changed(self, entry):
+        """Pack entry again in the next index, it is about to change"""
+
+        pos = self.positions.get(entry.uuid)
+        if pos is not None and self.entries[pos] is entry:
+            self.changed.add(pos)
@@ -0,0 +1,324 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+"""This module implements generating large databases for testing.
+
+The groups, entries, field values, dates and uuids are drawn from a
+random generator seeded with seed, so the same options give the same
+database contents. The times are relative to a fixed date unless
+--base is given. The files still differ byte for byte because kppy
+draws a new final seed and IV on every save. Run it with
+
+    python -m keepassc.gendb -n 5000 --seed 1 large.kdb
+
+Functions:
+    parse_distribution(text)
+    generate(seed, groups, depth, entries, sizes, expired, expiring,
+             expire_days, rounds, base)
+    main()
+
+Classes:
+    Distribution(object)
+"""
+
+import argparse
+import random
+import string
+import sys
+from datetime import date, datetime, timedelta
+from getpass import getpass
+
+from kppy.database import KPDBv1
+from kppy.exceptions import KPError
+
+# kppy saves at least this many key transformation rounds
+MIN_ROUNDS = 150000
+
+# The date kppy uses for entries which never expire
+NEVER = datetime(2999, 12, 28, 23, 59, 59)
+
+# The default date all times are relative to. It is fixed so that a seed
+# gives the same database on every day.
+BASE = date(2013, 1, 1)
+
+SYLLABLES = ('ka', 'ne', 'mo', 'ri', 'tu', 'sa', 'le', 'po', 'vi', 'da',
+             'gor', 'lin', 'mar', 'tes', 'qua', 'zel', 'bro', 'fin')
+PASSWORD_CHARS = string.ascii_letters + string.digits + string.punctuation
+
+# Lengths of the generated fields
+SIZES = {'title': '8-24',
+         'url': '15-60',
+         'username': '4-16',
+         'password': '12-32',
+         'comment': '0-200'}
+
+
+class Distribution(object):
+    """A distribution of non-negative integers
+
+    It is either a fixed value, uniform between low and high or normal
+    with mean and deviation (cut off at 0).
+
+    """
+
+    def __init__(self, kind, first, second = None):
+        self.kind = kind
+        self.first = first
+        self.second = second
+
+    def draw(self, rand):
+        if self.kind == 'fixed':
+            return self.first
+        elif self.kind == 'uniform':
+            return rand.randint(self.first, self.second)
+        return max(0, int(round(rand.gauss(self.first, self.second))))
+
+    def __str__(self):
+        if self.kind == 'fixed':
+            return str(self.first)
+        elif self.kind == 'uniform':
+            return '{0}-{1}'.format(self.first, self.second)
+        return '{0}~{1}'.format(self.first, self.second)
+
+
+def parse_distribution(text):
+    """Parse 'N', 'LOW-HIGH' or 'MEAN~DEVIATION' into a Distribution
+
+    ValueError is raised for anything else.
+
+    """
+
+    if '-' in text:
+        low, high = (int(i) for i in text.split('-', 1))
+        if low < 0 or high < low:
+            raise ValueError('Bad range: ' + text)
+        return Distribution('uniform', low, high)
+    elif '~' in text:
+        mean, deviation = (float(i) for i in text.split('~', 1))
+        if mean < 0 or deviation < 0:
+            raise ValueError('Bad normal distribution: ' + text)
+        return Distribution('normal', mean, deviation)
+    value = int(text)
+    if value < 0:
+        raise ValueError('Negative value: ' + text)
+    return Distribution('fixed', value)
+
+
+def _words(rand, length):
+    """Return pronounceable words of about length characters"""
+
+    words = []
+    size = 0
+    while size < length:
+        word = ''.join(rand.choice(SYLLABLES)
+                       for i in range(rand.randint(1, 3)))
+        words.append(word)
+        size += len(word) + 1
+    return ' '.join(words)[:length].strip()
+
+
+def _url(rand, length):
+    host = _words(rand, 12).replace(' ', '')
+    url = 'https://' + host + '.example/'
+    if len(url) < length:
+        url += _words(rand, length - len(url)).replace(' ', '/')
+    return url
+
+
+def _times(rand, base):
+    """Return creation, last modification and last access before base"""
+
+    creation = base - timedelta(seconds=rand.randrange(5 * 365 * 86400))
+    span = int((base - creation).total_seconds()) + 1
+    last_mod = creation + timedelta(seconds=rand.randrange(span))
+    span = int((base - last_mod).total_seconds()) + 1
+    last_access = last_mod + timedelta(seconds=rand.randrange(span))
+    return creation, last_mod, last_access
+
+
+def _expire(rand, base, expired, expiring, expire_days):
+    """Return an expiration date, NEVER for most entries"""
+
+    draw = rand.random()
+    if draw < expired:
+        return base - timedelta(seconds=rand.randrange(1, expire_days *
+                                                       86400))
+    elif draw < expired + expiring:
+        expire = base + timedelta(seconds=rand.randrange(1, expire_days *
+                                                         86400))
+        # kppy doesn't know February 29th
+        if expire.month == 2 and expire.day == 29:
+            expire -= timedelta(days=1)
+        return expire
+    return NEVER
+
+
+def generate(seed, groups = 10, depth = 2, entries = None, sizes = None,
+             expired = 0.05, expiring = 0.1, expire_days = 365,
+             rounds = MIN_ROUNDS, base = None):
+    """Return a new KPDBv1 filled with random groups and entries
+
+    groups is the number of groups and depth the maximal nesting level,
+    1 gives only top level groups. entries is a Distribution of the
+    number of entries per group and sizes a dict of Distributions of
+    the field lengths, missing fields use SIZES. Of the entries the
+    share expired has expired before base and expiring expires within
+    expire_days after it, the others never expire. base is the date all
+    times are relative to, BASE by default.
+
+    """
+
+    if groups < 1 or depth < 1:
+        raise ValueError('At least one group and level are needed')
+    if entries is None:
+        entries = parse_distribution('10')
+    lengths = {i: parse_distribution(SIZES[i]) for i in SIZES}
+    if sizes is not None:
+        lengths.update(sizes)
+    if base is None:
+        base = BASE
+    base = datetime(base.year, base.month, base.day)
+
+    rand = random.Random(seed)
+    db = KPDBv1(new=True)
+    db._transf_randomseed = bytes(rand.getrandbits(8) for i in range(32))
+    db._key_transf_rounds = max(rounds, MIN_ROUNDS)
+
+    # KPDBv1(new=True) starts with an 'Internet' group, the first
+    # generated group replaces its title
+    nested = []
+    for number in range(groups):
+        title = _words(rand, lengths['title'].draw(rand)) or str(number)
+        parent = None
+        candidates = [i for i in nested if i.level < depth - 1]
+        if candidates and rand.random() < 0.5:
+            parent = rand.choice(candidates)
+        if number == 0:
+            group = db.groups[0]
+            group.set_title(title)
+        else:
+            db.create_group(title, parent)
+            if parent is None:
+                group = db.root_group.children[-1]
+            else:
+                group = parent.children[-1]
+        group.creation, group.last_mod, group.last_access = _times(rand,
+                                                                   base)
+        nested.append(group)
+
+    for group in nested:
+        for i in range(entries.draw(rand)):
+            expire = _expire(rand, base, expired, expiring, expire_days)
+            db.create_entry(
+                group, _words(rand, lengths['title'].draw(rand)), 1,
+                _url(rand, lengths['url'].draw(rand)),
+                _words(rand, lengths['username'].draw(rand)).replace(' ',
+                                                                     '.'),
+                ''.join(rand.choice(PASSWORD_CHARS) for i in
+                        range(lengths['password'].draw(rand))),
+                _words(rand, lengths['comment'].draw(rand)),
+                expire.year, expire.month, expire.day, expire.hour,
+                expire.minute, expire.second)
+            entry = db.entries[-1]
+            entry.uuid = bytes(rand.getrandbits(8) for i in range(16))
+            entry.image = rand.randint(1, 68)
+            entry.creation, entry.last_mod, entry.last_access = _times(
+                rand, base)
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a KeePass 1.x database for testing')
+    parser.add_argument('path', help='Path of the new database.', type=str)
+    parser.add_argument('-k', '--keyfile', default=None,
+                        help='Path to keyfile.', type=str)
+    parser.add_argument('--seed', default=0,
+                        help='Seed of the random generator.', type=int)
+    parser.add_argument('-g', '--groups', default=10,
+                        help='Number of groups.', type=int)
+    parser.add_argument('--depth', default=2,
+                        help='Maximal nesting level of the groups.',
+                        type=int)
+    parser.add_argument('-n', '--entries', default='10',
+                        help='Entries per group as N, LOW-HIGH or '
+                             'MEAN~DEVIATION.', type=str)
+    for field in sorted(SIZES):
+        parser.add_argument('--' + field, default=SIZES[field],
+                            help='Length of the {0} as N, LOW-HIGH or '
+                                 'MEAN~DEVIATION.'.format(field), type=str)
+    parser.add_argument('--expired', default=0.05,
+                        help='Share of expired entries.', type=float)
+    parser.add_argument('--expiring', default=0.1,
+                        help='Share of entries expiring within '
+                             '--expire_days.', type=float)
+    parser.add_argument('--expire_days', default=365,
+                        help='Days around the base date the expiration '
+                             'dates are spread over.', type=int)
+    parser.add_argument('-r', '--rounds', default=MIN_ROUNDS,
+                        help='Key transformation rounds, at least '
+                             '{0}.'.format(MIN_ROUNDS), type=int)
+    parser.add_argument('--base', default=BASE.isoformat(),
+                        help='Date (YYYY-MM-DD) all times are relative to '
+                             'or \'today\', default is {0}.'.format(
+                                 BASE.isoformat()), type=str)
+    parser.add_argument('-a', '--ask', default=False,
+                        help='Ask for a password, otherwise it is '
+                             '\'password\'.', action='store_true')
+    args = parser.parse_args()
+
+    try:
+        entries = parse_distribution(args.entries)
+        sizes = {i: parse_distribution(getattr(args, i)) for i in SIZES}
+        if args.base == 'today':
+            base = date.today()
+        else:
+            base = datetime.strptime(args.base, '%Y-%m-%d').date()
+        if args.expired + args.expiring > 1 or args.expire_days < 1:
+            raise ValueError('Bad expiration options')
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+    if args.rounds < MIN_ROUNDS:
+        print('kppy saves at least {0} rounds'.format(MIN_ROUNDS))
+
+    if args.ask is True:
+        print("Leave blank if you use a keyfile only")
+        password = getpass()
+        if password == '':
+            password = None
+    else:
+        password = 'password'
+
+    try:
+        db = generate(args.seed, args.groups, args.depth, entries, sizes,
+                      args.expired, args.expiring, args.expire_days,
+                      args.rounds, base)
+        counts = (len(db.groups), len(db.entries))
+        db.save(args.path, password, args.keyfile)
+        db.close()
+    except (KPError, ValueError, OSError) as err:
+        print(err)
+        sys.exit(1)
+    print('{0} groups and {1} entries written to {2}'.format(
+        counts[0], counts[1], args.path))
+
+
+if __name__ == '__main__':
+    main()
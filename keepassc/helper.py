@@ -132,13 +132,7 @@ def get_filekey(keyfile):
         sha.update(struct.unpack('<65s', buf)[0].decode())
         return sha.digest()
     else:
-        while buf:
-            if len(buf) <= 2049:
-                sha.update(buf)
-                buf = []
-            else:
-                sha.update(buf[:2048])
-                buf = buf[2048:]
+        sha.update(buf)
         return sha.digest()
 
 def get_remote_filekey(buf):
@@ -152,13 +146,7 @@ def get_remote_filekey(buf):
         sha.update(struct.unpack('<65s', buf)[0].decode())
         return sha.digest()
     else:
-        while buf:
-            if len(buf) <= 2049:
-                sha.update(buf)
-                buf = []
-            else:
-                sha.update(buf[:2048])
-                buf = buf[2048:]
+        sha.update(buf)
         return sha.digest()
 
 def get_key(password, keyfile, remote = False):
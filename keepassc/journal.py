@@ -0,0 +1,178 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+"""This module implements the write-ahead journal of the server.
+
+The journal lives next to the database. It starts with a header
+
+    magic (5 bytes) | salt (16 bytes) | base (32 bytes) | MAC (32 bytes)
+
+where base is the contents hash of the database the journal applies to.
+Every change is appended as
+
+    length (4 bytes) | IV (16 bytes) | AES-CBC ciphertext | MAC (32 bytes)
+
+The plaintext is a list of parts, each prefixed with its length. The
+server writes the uuid and the times of the group or entry a request
+changed followed by the parts of the request. The MACs are HMAC-SHA256 over everything before them, so a
+record torn by a crash is detected and ignored together with everything
+after it.
+
+Classes:
+    Journal(object)
+"""
+
+import hmac
+import os
+import struct
+from hashlib import sha256
+from os.path import dirname
+
+from Crypto.Cipher import AES
+
+MAGIC = b'KPCJ\x02'
+HEADER_SIZE = len(MAGIC) + 16 + 32 + 32
+LENGTH = struct.Struct('<I')
+
+
+def _fsync_dir(path):
+    """Make a rename or creation inside the directory of path durable"""
+
+    fd = os.open(dirname(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal(object):
+    """An append-only, encrypted and fsync'd journal of database changes
+
+    masterkey is the key derived from the database password and keyfile
+    (see helper.get_key), the journal keys are derived from it and a
+    random salt.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.handler = None
+        self.enc_key = None
+        self.mac_key = None
+        # The records written since the last reset
+        self.records = []
+
+    def derive_keys(self, masterkey, salt):
+        self.enc_key = sha256(b'keepassc journal enc' + salt +
+                              masterkey).digest()
+        self.mac_key = sha256(b'keepassc journal mac' + salt +
+                              masterkey).digest()
+
+    def mac(self, data):
+        return hmac.new(self.mac_key, data, sha256).digest()
+
+    def read(self, masterkey, base):
+        """Return the records a previous run left for the database
+
+        base is the contents hash of the loaded database. A journal for
+        another base was already folded into the database and is
+        ignored.
+
+        """
+
+        try:
+            with open(self.path, 'rb') as handler:
+                buf = handler.read()
+        except OSError:
+            return []
+
+        if len(buf) < HEADER_SIZE or buf[:len(MAGIC)] != MAGIC:
+            return []
+        salt = buf[len(MAGIC):len(MAGIC) + 16]
+        self.derive_keys(masterkey, salt)
+        header = buf[:HEADER_SIZE - 32]
+        if not hmac.compare_digest(self.mac(header), buf[HEADER_SIZE - 32:
+                                                         HEADER_SIZE]):
+            return []
+        if header[len(MAGIC) + 16:] != base:
+            return []
+
+        records = []
+        pos = HEADER_SIZE
+        while pos + LENGTH.size <= len(buf):
+            length = LENGTH.unpack_from(buf, pos)[0]
+            end = pos + LENGTH.size + length
+            if length < 32 or end + 32 > len(buf):
+                break
+            if not hmac.compare_digest(self.mac(buf[pos:end]),
+                                       buf[end:end + 32]):
+                break
+            records.append(self.decrypt(buf[pos + LENGTH.size:end]))
+            pos = end + 32
+        return records
+
+    def reset(self, masterkey, base):
+        """Start an empty journal for the database with contents hash base"""
+
+        self.close()
+        salt = os.urandom(16)
+        self.derive_keys(masterkey, salt)
+        header = MAGIC + salt + base
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as handler:
+            handler.write(header + self.mac(header))
+            handler.flush()
+            os.fsync(handler.fileno())
+        os.chmod(tmp, 0o600)
+        os.replace(tmp, self.path)
+        _fsync_dir(self.path)
+        self.handler = open(self.path, 'ab')
+        self.records = []
+
+    def append(self, parts):
+        """Durably append a record made of the bytestrings in parts"""
+
+        plain = b''.join(LENGTH.pack(len(i)) + i for i in parts)
+        iv = os.urandom(16)
+        padding = 16 - len(plain) % 16
+        plain += bytes([padding]) * padding
+        data = iv + AES.new(self.enc_key, AES.MODE_CBC, iv).encrypt(plain)
+        record = LENGTH.pack(len(data)) + data
+        self.handler.write(record + self.mac(record))
+        self.handler.flush()
+        os.fsync(self.handler.fileno())
+        self.records.append(list(parts))
+
+    def decrypt(self, data):
+        iv = data[:16]
+        plain = AES.new(self.enc_key, AES.MODE_CBC, iv).decrypt(data[16:])
+        plain = plain[:-plain[-1]]
+        parts = []
+        pos = 0
+        while pos < len(plain):
+            length = LENGTH.unpack_from(plain, pos)[0]
+            pos += LENGTH.size
+            parts.append(plain[pos:pos + length])
+            pos += length
+        return parts
+
+    def close(self):
+        if self.handler is not None:
+            self.handler.close()
+            self.handler = None
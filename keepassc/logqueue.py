@@ -0,0 +1,167 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+"""This module implements the logging setup of the daemons and clients.
+
+A logging call only puts the record into a bounded queue, one writer
+thread formats it and appends it to the log file. The message is
+formatted with its arguments by the writer, so pass them separately
+like logging.info('Connection from %s:%d', ip, port) instead of
+building the string. If the queue is full because the disk is slow,
+records are dropped instead of blocking the request and the drops are
+counted and reported once the queue has room again.
+
+After a fork, e.g. when a daemon detaches or spawns workers, the child
+gets a new queue and writer thread of its own.
+
+Functions:
+    setup_logging(loglevel, logfile, queue_size)
+    stop_logging()
+    dropped_messages()
+
+Classes:
+    DroppingQueueHandler(QueueHandler)
+    Listener(QueueListener)
+"""
+
+import atexit
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+FORMAT = '[%(levelname)s] in %(filename)s:%(funcName)s at %(asctime)s\n' \
+         '%(message)s'
+
+# Records waiting for the writer before new ones are dropped
+QUEUE_SIZE = 10000
+
+_handler = None
+_listener = None
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Put records into a bounded queue, drop them if it is full"""
+
+    def __init__(self, queue_):
+        QueueHandler.__init__(self, queue_)
+        self.formatter = logging.Formatter(FORMAT)
+        self.dropped = 0
+        self.unreported = 0
+
+    def prepare(self, record):
+        # The traceback references frames of the logging thread, so it
+        # is rendered here. The message is left to the writer.
+        if record.exc_info:
+            record.exc_text = self.formatter.formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        # Handler.handle() holds self.lock, the counters need no other
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.unreported += 1
+            return
+        if self.unreported > 0:
+            warning = logging.LogRecord(
+                'keepassc.logqueue', logging.WARNING, __file__, 0,
+                'Dropped %d log messages, the log queue was full',
+                (self.unreported,), None, 'enqueue')
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                return
+            self.unreported = 0
+
+
+class Listener(QueueListener):
+    """A QueueListener which waits for room for its stop sentinel"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def setup_logging(loglevel, logfile, queue_size = QUEUE_SIZE):
+    """Log to logfile through a queue and a writer thread
+
+    Like logging.basicConfig() it does nothing if logging is already
+    set up in this process.
+
+    """
+
+    global _handler, _listener
+
+    root = logging.getLogger()
+    if _listener is not None or root.handlers:
+        return
+
+    file_handler = logging.FileHandler(logfile, 'a')
+    file_handler.setFormatter(logging.Formatter(FORMAT))
+    _handler = DroppingQueueHandler(queue.Queue(queue_size))
+    _listener = Listener(_handler.queue, file_handler)
+    root.addHandler(_handler)
+    root.setLevel(loglevel)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Write the queued records and stop the writer thread"""
+
+    global _listener
+
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_handler)
+    listener = _listener
+    _listener = None
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+def dropped_messages():
+    """Return the number of records dropped in this process"""
+
+    if _handler is None:
+        return 0
+    return _handler.dropped
+
+
+def _after_fork():
+    """Give the child its own queue and writer thread
+
+    The writer thread doesn't survive the fork and it may have held the
+    lock of the old queue, the records in it are written by the parent.
+
+    """
+
+    if _listener is None:
+        return
+    _handler.queue = queue.Queue(_handler.queue.maxsize)
+    _listener.queue = _handler.queue
+    _listener._thread = None
+    _listener.start()
+
+
+os.register_at_fork(after_in_child=_after_fork)
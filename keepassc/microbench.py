@@ -0,0 +1,282 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+"""This module implements micro benchmarks of the hot code paths.
+
+Every benchmark times one primitive in isolation a number of times and
+returns a result dict per parameter. Run it with
+
+    python -m keepassc.microbench [-o results.json]
+
+to get the timings as JSON lines, so runs can be compared before a
+release.
+
+Functions:
+    tcp_pair()
+    measure(name, params, func, repeat)
+    bench_build_message(sizes, repeat)
+    bench_transfer(sizes, repeat)
+    bench_transform_key(rounds, repeat)
+    bench_get_filekey(sizes, repeat)
+    bench_find(counts, repeat)
+    run(quick, repeat, only)
+    main()
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from keepassc.conn import *
+from keepassc.gendb import generate, parse_distribution
+from keepassc.helper import get_filekey, transform_key
+from keepassc.server import Server
+
+KB = 1024
+MB = 1024 * KB
+
+PAYLOAD_SIZES = (KB, 64 * KB, MB, 10 * MB, 50 * MB)
+ROUNDS = (1000, 10000, 100000)
+KEYFILE_SIZES = (KB, 64 * KB, MB, 16 * MB)
+ENTRY_COUNTS = (100, 1000, 10000)
+
+# Parameters too slow for a quick run
+QUICK_MAX_SIZE = MB
+QUICK_MAX_ROUNDS = 10000
+QUICK_MAX_ENTRIES = 1000
+
+
+def tcp_pair():
+    """Return two connected TCP sockets on the loopback interface
+
+    socketpair() gives AF_UNIX sockets, but receive() and sendmsg() ask
+    for the peer address and port, so real TCP sockets are used.
+
+    """
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        server = listener.accept()[0]
+    finally:
+        listener.close()
+    return client, server
+
+
+def measure(name, params, func, repeat):
+    """Call func repeat times and return the timings as a dict
+
+    func may return the number of bytes it processed to get a
+    throughput.
+
+    """
+
+    timings = []
+    processed = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        processed = func()
+        timings.append(time.perf_counter() - start)
+    result = {'name': name,
+              'params': params,
+              'repeat': repeat,
+              'min': min(timings),
+              'median': statistics.median(timings),
+              'mean': statistics.mean(timings),
+              'max': max(timings)}
+    if processed is not None:
+        result['bytes_per_second'] = processed / result['median']
+    return result
+
+
+def bench_build_message(sizes, repeat):
+    """Time joining a request like a client sends it"""
+
+    results = []
+    for size in sizes:
+        parts = (b'password', b'', b'GET', os.urandom(size))
+
+        def build():
+            build_message(parts)
+            return size
+
+        results.append(measure('build_message', {'size': size}, build,
+                               repeat))
+    return results
+
+
+def bench_transfer(sizes, repeat):
+    """Time sendmsg() and receive() of one message over TCP"""
+
+    results = []
+    for size in sizes:
+        msg = os.urandom(size).replace(b'\xDE\xAD\xE1\x1D', b'')
+        sender, receiver = tcp_pair()
+        errors = []
+
+        def send():
+            try:
+                sendmsg(sender, msg)
+            except OSError as err:
+                errors.append(err)
+
+        def transfer():
+            thread = threading.Thread(target=send)
+            thread.start()
+            received = receive(receiver)
+            thread.join()
+            if errors or len(received) != len(msg):
+                raise OSError('Transfer failed')
+            return len(msg)
+
+        try:
+            results.append(measure('sendmsg_receive', {'size': size},
+                                   transfer, repeat))
+        finally:
+            sender.close()
+            receiver.close()
+    return results
+
+
+def bench_transform_key(rounds, repeat):
+    """Time the key transformation of a password check"""
+
+    results = []
+    masterkey = os.urandom(32)
+    seed1 = os.urandom(32)
+    seed2 = os.urandom(16)
+    for count in rounds:
+        def transform(count=count):
+            transform_key(masterkey, seed1, seed2, count)
+
+        results.append(measure('transform_key', {'rounds': count}, transform,
+                               repeat))
+    return results
+
+
+def bench_get_filekey(sizes, repeat):
+    """Time hashing keyfiles"""
+
+    results = []
+    for size in sizes:
+        with tempfile.NamedTemporaryFile(delete=False) as handler:
+            handler.write(os.urandom(size))
+        try:
+            def filekey(path=handler.name):
+                get_filekey(path)
+                return size
+
+            results.append(measure('get_filekey', {'size': size}, filekey,
+                                   repeat))
+        finally:
+            os.remove(handler.name)
+    return results
+
+
+def bench_find(counts, repeat):
+    """Time Server.find on databases made by gendb
+
+    Only the search and the formatting are timed, the answer isn't sent.
+
+    """
+
+    results = []
+    for count in counts:
+        db = generate(0, 10, 2, parse_distribution(str(count // 10)))
+
+        # Only the attributes find() needs
+        server = Server.__new__(Server)
+        server.db = db
+        server.local = threading.local()
+        server.db_lock = threading.RLock()
+        server.entry_index = None
+
+        for title, matching in ((db.entries[0].title[:5].encode(), 'some'),
+                                (b'nothing', 'none')):
+            results.append(measure(
+                'server_find', {'entries': count, 'matching': matching},
+                lambda: server.find(None, [title]), repeat))
+    return results
+
+
+def run(quick = False, repeat = 5, only = None):
+    """Run the benchmarks and return all results
+
+    only is a list of benchmark names to run, quick leaves out the
+    slowest parameters.
+
+    """
+
+    sizes = PAYLOAD_SIZES
+    rounds = ROUNDS
+    keyfiles = KEYFILE_SIZES
+    entries = ENTRY_COUNTS
+    if quick is True:
+        sizes = [i for i in sizes if i <= QUICK_MAX_SIZE]
+        rounds = [i for i in rounds if i <= QUICK_MAX_ROUNDS]
+        keyfiles = [i for i in keyfiles if i <= QUICK_MAX_SIZE]
+        entries = [i for i in entries if i <= QUICK_MAX_ENTRIES]
+
+    benchmarks = (('build_message', bench_build_message, sizes),
+                  ('sendmsg_receive', bench_transfer, sizes),
+                  ('transform_key', bench_transform_key, rounds),
+                  ('get_filekey', bench_get_filekey, keyfiles),
+                  ('server_find', bench_find, entries))
+    results = []
+    for name, func, params in benchmarks:
+        if only is None or name in only:
+            results.extend(func(params, repeat))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Micro benchmarks of keepassc')
+    parser.add_argument('-r', '--repeat', default=5,
+                        help='Runs per benchmark and parameter.', type=int)
+    parser.add_argument('-q', '--quick', default=False,
+                        help='Leave out the slowest parameters.',
+                        action='store_true')
+    parser.add_argument('-b', '--bench', default=None, action='append',
+                        help='Only run this benchmark, may be given more '
+                             'than once.', type=str)
+    parser.add_argument('-o', '--output', default=None,
+                        help='Write the results to this file instead of '
+                             'stdout.', type=str)
+    args = parser.parse_args()
+
+    results = run(args.quick, args.repeat, args.bench)
+    lines = [json.dumps(i, sort_keys=True) for i in results]
+    if args.output is not None:
+        with open(args.output, 'w') as handler:
+            handler.write('\n'.join(lines) + '\n')
+    else:
+        sys.stdout.write('\n'.join(lines) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+"""This module implements profiling a running daemon on signals.
+
+SIGUSR1 starts a sampling profiler and the next SIGUSR1 stops it and
+writes the samples as folded stacks, one 'frame;frame;frame count' line
+per stack, which flamegraph.pl or speedscope read. The stacks of all
+threads are sampled, a cProfile session would only see the main thread
+while the requests are handled by others.
+
+SIGUSR2 starts tracemalloc and the next SIGUSR2 writes a snapshot (load
+it with tracemalloc.Snapshot.load) and the biggest allocations as text
+and stops tracing again. Tracing makes every allocation several times
+slower, key transformations included, so it shouldn't stay on.
+
+The files are named after the process id and the time and are only
+readable by the user.
+
+Classes:
+    Profiler(object)
+"""
+
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from os.path import basename, join
+
+# Seconds between two samples
+INTERVAL = 0.01
+# Frames tracemalloc keeps per allocation
+TRACE_FRAMES = 10
+# Lines of the text report of a snapshot
+TOP_ALLOCATIONS = 30
+
+
+class Profiler(object):
+    """Sample stacks and snapshot allocations when signaled
+
+    directory is where the results are written to.
+
+    """
+
+    def __init__(self, directory, interval = INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.thread = None
+        self.running = False
+        self.samples = Counter()
+        self.started = None
+
+    def install(self):
+        """Handle SIGUSR1 and SIGUSR2 in this process"""
+
+        signal.signal(signal.SIGUSR1, self.toggle_sampling)
+        signal.signal(signal.SIGUSR2, self.snapshot_memory)
+
+    def path(self, kind, suffix):
+        return join(self.directory, '{0}-{1}-{2}.{3}'.format(
+            kind, os.getpid(), time.strftime('%Y%m%d-%H%M%S'), suffix))
+
+    def open(self, path, mode = 'w'):
+        """Open a new file only the user can read"""
+
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        return os.fdopen(fd, mode)
+
+    def toggle_sampling(self, signum = None, frame = None):
+        if self.running is False:
+            self.start_sampling()
+        else:
+            self.stop_sampling()
+
+    def start_sampling(self):
+        self.samples = Counter()
+        self.started = time.time()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info('Sampling profiler started')
+
+    def stop_sampling(self):
+        """Stop sampling and write the folded stacks"""
+
+        self.running = False
+        self.thread.join()
+        self.thread = None
+        path = self.path('profile', 'folded')
+        try:
+            with self.open(path) as handler:
+                for stack, count in self.samples.most_common():
+                    handler.write('{0} {1}\n'.format(stack, count))
+        except OSError as err:
+            logging.error('Could not write the profile: %s', err)
+            return
+        logging.info('Sampled %d stacks in %.1fs to %s',
+                     sum(self.samples.values()), time.time() - self.started,
+                     path)
+
+    def sample(self):
+        own = threading.get_ident()
+        while self.running is True:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{0}:{1}'.format(
+                        basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.reverse()
+                self.samples[';'.join(stack)] += 1
+            time.sleep(self.interval)
+
+    def snapshot_memory(self, signum = None, frame = None):
+        """Start tracemalloc or write a snapshot and stop it"""
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+            logging.info('Tracing memory allocations')
+            return
+
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        path = self.path('memory', 'snapshot')
+        try:
+            with self.open(path, 'wb') as handler:
+                # Snapshot.dump() would create the file world-readable
+                # since the daemon runs with umask 0
+                handler.write(b'')
+            snapshot.dump(path)
+            with self.open(path[:-len('snapshot')] + 'txt') as handler:
+                handler.write('Traced: {0} bytes, peak {1} bytes\n\n'.format(
+                    current, peak))
+                for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                    handler.write(str(stat) + '\n')
+        except OSError as err:
+            logging.error('Could not write the memory snapshot: %s', err)
+            return
+        logging.info('Memory snapshot written to %s', path)
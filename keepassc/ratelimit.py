@@ -0,0 +1,156 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+"""This module implements limiting password checks per client address.
+
+Every password check costs a full key transformation, so the server
+decides before it whether an address may try at all. All local clients,
+the agent included, share the loopback addresses, so one wrong local
+password slows down all of them. The limiter can skip loopback
+addresses, but only if no proxy on the host forwards remote clients,
+they would look local and not be limited at all.
+
+Functions:
+    is_loopback(address)
+
+Classes:
+    AuthLimiter(object)
+"""
+
+import ipaddress
+import threading
+import time
+
+# Addresses tracked before idle ones are forgotten
+MAX_ADDRESSES = 10000
+
+
+def is_loopback(address):
+    """Return whether the client address is a loopback address"""
+
+    if address == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+
+class _Address(object):
+    """The state of one client address"""
+
+    __slots__ = ('tokens', 'updated', 'failures', 'blocked_until')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.failures = 0
+        self.blocked_until = 0.0
+
+
+class AuthLimiter(object):
+    """Token buckets and failure backoff per client address
+
+    Every address may check a password rate times per second with
+    bursts of up to burst checks. After n failed checks in a row it has
+    to wait 2**(n-1) * base seconds, at most max_backoff seconds, before
+    the next check. A successful check resets the backoff. Loopback
+    addresses aren't limited if skip_loopback is True.
+
+    """
+
+    def __init__(self, rate, burst, max_backoff, base = 0.5,
+                 skip_loopback = False):
+        self.rate = rate
+        self.burst = burst
+        self.max_backoff = max_backoff
+        self.base = base
+        self.skip_loopback = skip_loopback
+        self.lock = threading.Lock()
+        self.addresses = {}
+        # Rejected checks by reason
+        self.rejected = {'rate': 0, 'backoff': 0}
+
+    def limits(self, address):
+        """Return whether the password checks of address are limited"""
+
+        return self.skip_loopback is False or is_loopback(address) is False
+
+    def allow(self, address):
+        """Take a token for a password check of address
+
+        Return None if the check may run, otherwise the seconds after
+        which the address may try again.
+
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            state = self.addresses.get(address)
+            if state is None:
+                if len(self.addresses) >= MAX_ADDRESSES:
+                    self.prune(now)
+                state = self.addresses[address] = _Address(self.burst, now)
+            else:
+                state.tokens = min(self.burst, state.tokens +
+                                   (now - state.updated) * self.rate)
+                state.updated = now
+
+            if state.blocked_until > now:
+                self.rejected['backoff'] += 1
+                return state.blocked_until - now
+            if state.tokens < 1:
+                self.rejected['rate'] += 1
+                return (1 - state.tokens) / self.rate
+            state.tokens -= 1
+            return None
+
+    def result(self, address, success):
+        """Account the outcome of a password check of address"""
+
+        now = time.monotonic()
+        with self.lock:
+            state = self.addresses.get(address)
+            if state is None:
+                return
+            if success is True:
+                state.failures = 0
+                state.blocked_until = 0.0
+            else:
+                state.failures += 1
+                delay = min(self.base * 2 ** min(state.failures - 1, 32),
+                            self.max_backoff)
+                state.blocked_until = now + delay
+
+    def blocked(self):
+        """Return the number of addresses currently backing off"""
+
+        now = time.monotonic()
+        with self.lock:
+            return sum(1 for i in self.addresses.values()
+                       if i.blocked_until > now)
+
+    def prune(self, now):
+        """Forget addresses with a full bucket and no backoff; the lock
+        must be held"""
+
+        for address, state in list(self.addresses.items()):
+            if (state.blocked_until <= now and state.tokens +
+                    (now - state.updated) * self.rate >= self.burst):
+                del self.addresses[address]
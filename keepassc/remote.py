@@ -0,0 +1,429 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+"""This module implements browsing a database on a server lazily.
+
+Instead of downloading and decrypting the whole database the groups are
+listed as the user navigates (LSG, LSE) and passwords are fetched when
+they are shown or copied (GETF). The classes provide the parts of the
+kppy interface the database browser uses.
+
+With a cache the last downloaded image of the database is opened
+instead, so browsing starts without a single request. It is replaced
+by the current image of the server in the background, see RemoteDB.
+
+Classes:
+    LazyList(object)
+    RemoteGroup(object)
+    RemoteEntry(object)
+    RemoteDB(object)
+"""
+
+import logging
+import threading
+from datetime import datetime
+
+from kppy.database import KPDBv1
+from kppy.exceptions import KPError
+
+from keepassc.client import Client, field_value
+from keepassc.dbcache import image_version
+
+# The number of parts of a row of LSG and LSE
+GROUP_FIELDS = 6
+ENTRY_FIELDS = 10
+
+
+def _rows(answer, fields):
+    """Split an answer of LSG, LSE or LSF into rows of fields strings"""
+
+    if type(answer) is str:
+        raise KPError(answer)
+    if answer == b'':
+        return []
+    parts = [i.decode() for i in answer.split(b'\xB2\xEA\xC0')]
+    return [parts[i:i + fields] for i in range(0, len(parts), fields)]
+
+
+def _date(text):
+    if text == '':
+        return None
+    return datetime.strptime(text, '%Y-%m-%d %H:%M:%S')
+
+
+class LazyList(object):
+    """A list which is fetched on first access
+
+    Its length is known in advance, so checking whether a group has
+    children doesn't fetch them.
+
+    """
+
+    def __init__(self, count, loader):
+        self.count = count
+        self.loader = loader
+        self.items = None
+
+    def load(self):
+        if self.items is None:
+            try:
+                self.items = self.loader()
+            except KPError as err:
+                # Shown as empty, a refresh tries again
+                logging.error(err.__str__())
+                self.items = []
+            self.count = len(self.items)
+        return self.items
+
+    def __len__(self):
+        if self.items is None:
+            return self.count
+        return len(self.items)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __getitem__(self, index):
+        return self.load()[index]
+
+    def __delitem__(self, index):
+        del self.load()[index]
+
+    def append(self, item):
+        self.load().append(item)
+
+    def remove(self, item):
+        self.load().remove(item)
+
+    def index(self, item):
+        return self.load().index(item)
+
+    def clear(self):
+        self.items = []
+        self.count = 0
+
+
+class RemoteGroup(object):
+    """A group of a RemoteDB, its children and entries are fetched on
+    first access"""
+
+    def __init__(self, db, id_, title, image = 1, last_mod = None,
+                 parent = None, children = 0, entries = 0):
+        self.db = db
+        self.id_ = id_
+        self.title = title
+        self.image = image
+        self.last_mod = last_mod
+        self.parent = parent
+        self.children = LazyList(children, self.load_children)
+        self.entries = LazyList(entries, self.load_entries)
+
+    def load_children(self):
+        groups = []
+        for row in _rows(self.db.client().list_groups(self.id_),
+                         GROUP_FIELDS):
+            group = RemoteGroup(self.db, int(row[0]), row[1], int(row[2]),
+                                _date(row[3]), self, int(row[4]),
+                                int(row[5]))
+            groups.append(group)
+            self.db.groups.append(group)
+        return groups
+
+    def load_entries(self):
+        return [RemoteEntry(self, row) for row in
+                _rows(self.db.client().list_entries(self.id_),
+                      ENTRY_FIELDS)]
+
+    def remove_group(self):
+        """Remove a group which only exists locally (search results)"""
+
+        if self.parent is not None:
+            self.parent.children.remove(self)
+        self.db.groups.remove(self)
+
+
+class RemoteEntry(object):
+    """An entry of a RemoteDB, the password is fetched on first access"""
+
+    def __init__(self, group, row):
+        self.group = group
+        self.uuid = bytes.fromhex(row[0])
+        self.title = row[1]
+        self.image = int(row[2])
+        self.url = row[3]
+        self.username = row[4]
+        self.comment = row[5]
+        self.creation = _date(row[6])
+        self.last_access = _date(row[7])
+        self.last_mod = _date(row[8])
+        self.expire = _date(row[9])
+        self._password = None
+
+    @property
+    def password(self):
+        if self._password is None:
+            try:
+                answer = self.group.db.client().send_cmd(b'GETF', self.uuid,
+                                                         b'password')
+                self._password = field_value(answer).decode()
+            except OSError as err:
+                logging.error(err.__str__())
+                return None
+        return self._password
+
+
+class RemoteDB(object):
+    """A database on a keepassc-server, browsed without downloading it
+
+    Like KPDBv1 it has to be unlocked with the credentials before use.
+
+    cache is a dbcache.DBCache. If the credentials decrypt its image,
+    the cached database is shown right away and a background thread
+    asks the server for the version of its image. A newer image is
+    downloaded, cached and shown by the next refresh(). While the server
+    can't be reached the database is read-only. Without a cached image
+    the database is browsed lazily until the background thread has
+    cached one.
+
+    """
+
+    def __init__(self, address, port, ssl = False, tls_dir = None,
+                 cache = None):
+        self.address = address
+        self.port = port
+        self.ssl = ssl
+        self.tls_dir = tls_dir
+        self.password = None
+        self.keyfile = None
+        self.filepath = None
+        self.read_only = False
+        self.groups = []
+        self.root_group = None
+        self.cache = cache
+        # The KPDBv1 of the cached image which is shown
+        self.cached = None
+        # A newer KPDBv1 from the background thread for refresh()
+        self.pending = None
+        self.pending_lock = threading.Lock()
+        # Increased by lock(), a background thread of an earlier unlock
+        # discards its database
+        self.generation = 0
+        # The Client of the session, see client()
+        self.connection = None
+
+    def client(self):
+        """Return the Client of this session
+
+        It keeps its connections to the server open until lock().
+
+        """
+
+        with self.pending_lock:
+            if self.connection is None:
+                self.connection = Client(logging.ERROR, 'client.log',
+                                         self.address, self.port,
+                                         self.password, self.keyfile,
+                                         self.ssl, self.tls_dir)
+            else:
+                # DBBrowser sets them after changing the password
+                self.connection.password = self.password
+                self.connection.keyfile = self.keyfile
+            return self.connection
+
+    def unlock(self, password = None, keyfile = None, buf = None):
+        """Check the credentials by listing the top level groups
+
+        A cached image which the credentials decrypt is opened instead.
+        buf is only accepted for compatibility with KPDBv1.
+
+        """
+
+        self.password = password
+        self.keyfile = keyfile
+        if self.cache is None:
+            self.refresh()
+            return
+
+        version = None
+        image = self.cache.load()
+        if image is not None:
+            try:
+                self.show(self.open_image(image))
+                version = image_version(image)
+            except KPError as err:
+                # E.g. the password was changed, the server decides
+                logging.error('Could not open the cached database: %s',
+                              err)
+        if version is None:
+            self.refresh()
+        thread = threading.Thread(target=self.revalidate,
+                                  args=(version, self.generation))
+        thread.daemon = True
+        thread.start()
+
+    def open_image(self, buf):
+        """Return the database image buf decrypted as KPDBv1"""
+
+        db = KPDBv1(None, self.password or None, self.keyfile or None, True)
+        db.load(buf)
+        return db
+
+    def show(self, db):
+        """Browse the KPDBv1 db of an image from now on"""
+
+        old = self.cached
+        self.cached = db
+        self.groups = db.groups
+        self.root_group = db.root_group
+        if old is not None:
+            old.lock()
+
+    def has_update(self):
+        """Return whether refresh() would show a newer image"""
+
+        return self.pending is not None
+
+    def revalidate(self, version, generation):
+        """Download and cache the image of the server unless it has the
+        version of the one shown
+
+        This runs in the background after unlock(). The image is shown
+        by the next refresh().
+
+        """
+
+        client = self.client()
+        if version is not None:
+            try:
+                current = client.send_cmd(b'VER')
+            except OSError as err:
+                logging.error('Could not revalidate the cached database: '
+                              '%s', err)
+                self.read_only = True
+                return
+            if current == version.encode():
+                self.read_only = False
+                return
+            # A newer image or a FAIL, e.g. of a server without VER,
+            # which GET explains
+
+        buf = client.get_db()
+        if type(buf) is str:
+            self.read_only = self.cached is not None
+            return
+        try:
+            db = self.open_image(buf)
+        except KPError as err:
+            logging.error('Could not open the database of the server: %s',
+                          err)
+            return
+        self.cache.store(buf)
+        with self.pending_lock:
+            if generation == self.generation:
+                self.pending = db
+                self.read_only = False
+                return
+        db.lock()
+
+    def refresh(self):
+        """Forget everything fetched so far and list the top level
+        groups again
+
+        A cached database is replaced by the newer one found in the
+        background, otherwise by the current image of the server.
+
+        """
+
+        with self.pending_lock:
+            pending = self.pending
+            self.pending = None
+        if pending is not None:
+            self.show(pending)
+            return
+        if self.cached is not None:
+            buf = self.client().get_db()
+            if type(buf) is str:
+                self.read_only = True
+                raise KPError(buf)
+            self.read_only = False
+            self.show(self.open_image(buf))
+            self.cache.store(buf)
+            return
+
+        self.groups = []
+        root = RemoteGroup(self, 0, '_ROOT_')
+        # Not through the LazyList to let unlock() fail
+        root.children.items = root.load_children()
+        self.root_group = root
+
+    def lock(self):
+        with self.pending_lock:
+            self.generation += 1
+            pending = self.pending
+            self.pending = None
+            connection = self.connection
+            self.connection = None
+        if connection is not None:
+            connection.close()
+        for db in (pending, self.cached):
+            if db is not None:
+                db.lock()
+        self.cached = None
+        self.read_only = False
+        self.groups = []
+        self.root_group = None
+        self.password = None
+        self.keyfile = None
+
+    def close(self):
+        self.lock()
+
+    def create_group(self, title, parent = None):
+        """Create a group which only exists locally, e.g. for search
+        results"""
+
+        if parent is None:
+            parent = self.root_group
+        group = RemoteGroup(self, len(self.groups) + 1, title, parent = parent)
+        group.children.clear()
+        group.entries.clear()
+        parent.children.append(group)
+        self.groups.append(group)
+        return True
+
+    def find(self, title):
+        """Return the entries whose title contains title"""
+
+        if self.cached is not None:
+            return [i for i in self.cached.entries
+                    if title.lower() in i.title.lower()]
+
+        answer = self.client().list_found(title.encode())
+        found = []
+        groups = {i.id_: i for i in self.groups}
+        for row in _rows(answer, ENTRY_FIELDS + 2):
+            group = groups.get(int(row[0]))
+            if group is None:
+                # The group wasn't browsed yet
+                group = RemoteGroup(self, int(row[0]), row[1])
+            found.append(RemoteEntry(group, row[2:]))
+        return found
@@ -26,7 +26,12 @@ Classes:
     class Server(Connection, Daemon)
 """
 
+import fcntl
 import logging
+import os
+import select
+import selectors
+import shutil
 import signal
 import socket
 import ssl
@@ -34,42 +39,88 @@ import sys
 import time
 import threading
 from datetime import datetime
+from hashlib import sha256
 from os import chdir
-from os.path import join, expanduser, realpath
+from os.path import join, expanduser, getsize, realpath
 
 from kppy.database import KPDBv1
 from kppy.exceptions import KPError
 
+from keepassc.client import Client
 from keepassc.conn import *
 from keepassc.daemon import Daemon
+from keepassc.dbcache import image_version
+from keepassc.entryindex import EntryIndex
 from keepassc.helper import get_key, transform_key
+from keepassc.journal import Journal
+from keepassc.logqueue import dropped_messages, setup_logging
+from keepassc.ratelimit import AuthLimiter
+from keepassc.stats import PHASES, MetricsServer, Stats, Timer
+from keepassc.trace import Tracer, new_id, split_trace
+from keepassc.watch import FileWatcher, file_ident
+
+# Slow requests are logged even if the log level is set to ERROR
+slow_log = logging.getLogger('keepassc.slow')
+slow_log.setLevel(logging.WARNING)
+
+# Connections accepted from one listening socket before the others get
+# their turn
+ACCEPT_BATCH = 32
+
+# The entry attributes GETF can return
+FIELDS = ('title', 'url', 'username', 'password', 'comment', 'creation',
+          'last_access', 'last_mod', 'expire')
+
+# Seconds between two messages to a follower if nothing changed
+HEARTBEAT = 5
+
+# The times kppy sets to now when a group or entry changes, journaled
+# so that a replay keeps them
+STAMPS = ('creation', 'last_mod', 'last_access')
 
 class waitDecorator(object):
-    def __init__(self, func):
+    """Serialize the methods which change the database
+
+    The time a request waits for the database lock is recorded as its
+    lock phase.
+
+    """
+
+    def __init__(self, func, obj = None):
         self.func = func
-        self.lock = False
+        self.obj = obj
 
     def __get__(self, obj, type=None):
-        return self.__class__(self.func.__get__(obj, type))
+        return self.__class__(self.func.__get__(obj, type), obj)
 
     def __call__(self, *args):
-        while True:
-            if self.lock == True:
-                time.sleep(1)
-                continue
-            else:
-                self.lock = True
+        start = time.perf_counter()
+        with self.obj.db_lock:
+            if self.obj.write_lock is not None:
+                fcntl.flock(self.obj.write_lock, fcntl.LOCK_EX)
+            try:
+                self.obj.add_time('lock', start)
+                self.obj.sync_db()
+                # Reads wait for the change and build a new index
+                if self.obj.entry_index is not None:
+                    self.obj.entry_index.stale = True
                 self.func(args[0], args[1])
-                self.lock = False
-                break
-        
+            finally:
+                if self.obj.write_lock is not None:
+                    fcntl.flock(self.obj.write_lock, fcntl.LOCK_UN)
+
 class Server(Daemon):
     """The KeePassC server daemon"""
 
     def __init__(self, pidfile, loglevel, logfile, address = None,
                  port = 50002, db = None, password = None, keyfile = None,
                  tls = False, tls_dir = None, tls_port = 50003, 
-                 tls_req = False):
+                 tls_req = False, metrics_port = None, slow_log = None,
+                 journal = False, checkpoint_interval = 60, workers = 1,
+                 handshake_timeout = 10, backlog = 128, drain_timeout = 30,
+                 auth_rate = 10, auth_burst = 30, auth_backoff = 60,
+                 follow = None, follow_tls = False, trace = False,
+                 keepalive = 30, auth_skip_loopback = False):
         Daemon.__init__(self, pidfile)
 
         try:
@@ -79,10 +130,7 @@ class Server(Daemon):
         finally:
             logfile = join(logdir, 'keepassc', logfile)
 
-        logging.basicConfig(format='[%(levelname)s] in %(filename)s:'
-                                   '%(funcName)s at %(asctime)s\n%(message)s',
-                            level=loglevel, filename=logfile,
-                            filemode='a')
+        setup_logging(loglevel, logfile)
 
         if db is None:
             print('Need a database path')
@@ -99,6 +147,26 @@ class Server(Daemon):
 
         chdir("/var/empty")
 
+        # A follower replaces its database file with the one of the
+        # primary and serves it read-only
+        self.follow = follow
+        self.upstream = None
+        self.image_hash = None
+        self.replication_lag = None
+        self.last_contact = None
+        if follow is not None:
+            if workers > 1 or journal is True:
+                print('A follower can\'t use workers or a journal')
+                sys.exit(1)
+            self.upstream = Client(loglevel, logfile, follow[0], follow[1],
+                                   password, keyfile, follow_tls, tls_dir)
+            buf = self.upstream.get_db()
+            if type(buf) is str:
+                print('Could not get the database from the primary: ' + buf)
+                logging.error(buf)
+                sys.exit(1)
+            self.write_image(buf)
+
         try:
             self.db = KPDBv1(self.db_path, password, keyfile)
             self.db.load()
@@ -106,10 +174,29 @@ class Server(Daemon):
             print(err)
             logging.error(err.__str__())
             sys.exit(1)
+        self.db_ident = file_ident(self.db_path)
+        self.watcher = FileWatcher(self.db_path, self.reload_db)
+        # Notified with an increased db_version whenever the database
+        # file changed, wakes up the subscriptions of followers
+        self.db_changed = threading.Condition()
+        self.db_version = 0
+        # EntryIndex of self.db, built by the first read after a change
+        self.entry_index = None
+        # The file_ident of the database file and the version of the
+        # image, see send_version()
+        self.image_version = None
 
         self.lookup = {
             b'FIND': self.find,
             b'GET': self.send_db,
+            b'VER': self.send_version,
+            b'GETE': self.send_entry,
+            b'GETF': self.send_field,
+            b'LSG': self.list_groups,
+            b'LSE': self.list_entries,
+            b'LSF': self.list_found,
+            b'STATS': self.send_stats,
+            b'SUBSCRIBE': self.subscribe,
             b'CHANGESECRET': self.change_password,
             b'NEWG': self.create_group,
             b'NEWE': self.create_entry,
@@ -124,25 +211,163 @@ class Server(Daemon):
             b'COMM': self.set_e_comment,
             b'PASS': self.set_e_pass,
             b'DATE': self.set_e_exp}
+        if follow is not None:
+            for cmd in self.lookup:
+                if cmd not in READ_COMMANDS:
+                    self.lookup[cmd] = self.read_only
+
+        self.stats = Stats()
+        # Spans of the requests are appended to the trace file
+        if trace is True:
+            self.tracer = Tracer(join(logdir, 'keepassc', 'trace.log'),
+                                 'server')
+        else:
+            self.tracer = None
+        # Requests taking longer than slow_log milliseconds are logged
+        # with their phase timings
+        if slow_log is not None:
+            self.slow_threshold = slow_log / 1000
+        else:
+            self.slow_threshold = None
+        # Holds the Timer of the request handled by the current thread
+        self.local = threading.local()
+        # Reentrant because replaying the journal runs the decorated
+        # handlers while the lock is already held
+        self.db_lock = threading.RLock()
+        self.running = True
+        # Seconds running requests get to finish on SIGTERM
+        self.drain_timeout = drain_timeout
+        # Password checks are limited per address before the key is
+        # transformed; auth_rate 0 disables this
+        if auth_rate > 0:
+            self.limiter = AuthLimiter(auth_rate, auth_burst, auth_backoff,
+                                       skip_loopback=auth_skip_loopback)
+        else:
+            self.limiter = None
+        # (database, seed, password, keyfile, key) of the last server
+        # side key transformation
+        self.final_key = None
+
+        # With more than one worker every worker process binds its own
+        # sockets with SO_REUSEPORT and the kernel distributes the
+        # connections. Writes are serialized between the workers by an
+        # exclusive lock on a lock file. Set before the journal is
+        # replayed, the replay runs through waitDecorator.
+        self.workers = workers
+        self.worker = None
+        self.children = {}
+        self.write_lock = None
+        if workers > 1 and journal is True:
+            print('A journal can\'t be used with more than one worker')
+            sys.exit(1)
+
+        # Changes are only appended to the journal and folded into the
+        # database file by checkpoint()
+        self.replaying = False
+        # The journal record being replayed
+        self.replayed = None
+        self.checkpoint_interval = checkpoint_interval
+        if journal is True:
+            self.journal = Journal(self.db_path + '.journal')
+            try:
+                records = self.journal.read(self.master_key(),
+                                            self.db._contents_hash)
+                if records:
+                    logging.info('Replaying %d journal records',
+                                 len(records))
+                    self.apply_journal(records)
+                    self.checkpoint(True)
+                else:
+                    self.journal.reset(self.master_key(),
+                                       self.db._contents_hash)
+            except (KPError, OSError) as err:
+                print(err)
+                logging.error(err.__str__())
+                sys.exit(1)
+        else:
+            self.journal = None
 
         self.sock = None
         self.net_sock = None
         self.tls_sock = None
+        self.metrics = None
+        self.metrics_port = metrics_port
         self.tls_req = tls_req
-        
+
         if tls is True or tls_req is True:
             self.context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
             cert = join(tls_dir, "servercert.pem")
             key = join(tls_dir, "serverkey.pem")
             self.context.load_cert_chain(certfile=cert, keyfile=key)
+            # Let clients resume sessions by tickets. The context is
+            # created before forking, so all workers share the ticket
+            # key and accept each other's tickets.
+            self.context.options &= ~ssl.OP_NO_TICKET
         else:
             self.context = None
+        # Seconds a client may take for the TLS handshake
+        self.handshake_timeout = handshake_timeout
+        # Seconds a connection is kept open for the next request
+        self.keepalive = keepalive
+
+        self.address = address
+        self.port = port
+        self.tls_port = tls_port
+        self.backlog = backlog
+        self.create_sockets()
+
+        if metrics_port is not None:
+            try:
+                self.metrics = MetricsServer(metrics_port,
+                                             self.render_metrics)
+            except OSError as err:
+                print(err)
+                logging.error(err.__str__())
+                sys.exit(1)
+            else:
+                logging.info('Metrics served on localhost:%d', metrics_port)
+
+        #Handle SIGTERM
+        signal.signal(signal.SIGTERM, self.handle_sigterm)
+
+    def check_password(self, password, keyfile):
+        """Check received password"""
+        
+        # The database may be swapped by a reload meanwhile and a save
+        # draws new seeds, so both keys are made with the same ones
+        db = self.db
+        seeds = (db._transf_randomseed, db._final_randomseed,
+                 db._key_transf_rounds)
+        master = get_key(password, keyfile, True)
+        remote_final =  transform_key(master, *seeds)
+        return (remote_final == self.server_key(db, seeds))
+
+    def server_key(self, db, seeds):
+        """Return the transformed key of db for seeds
+
+        It only changes when the database is saved or gets a new
+        password, so the last one is reused.
+
+        """
+
+        cached = self.final_key
+        if (cached is not None and cached[0] is db and
+                cached[1] == seeds and cached[2] == db.password and
+                cached[3] == db.keyfile):
+            self.stats.cache('key', True)
+            return cached[4]
+        self.stats.cache('key', False)
+        master = get_key(db.password, db.keyfile)
+        final =  transform_key(master, *seeds)
+        self.final_key = (db, seeds, db.password, db.keyfile, final)
+        return final
+
+    def create_sockets(self):
+        """Create the listening sockets"""
 
         try:
             # Listen for commands
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.bind(("localhost", 50000))
-            self.sock.listen(5)
+            self.sock = self.listen("localhost", 50000)
         except OSError as err:
             print(err)
             logging.error(err.__str__())
@@ -150,112 +375,328 @@ class Server(Daemon):
         else:
             logging.info('Server socket created on localhost:50000')
 
-        if self.tls_req is False and address is not None:
+        if self.tls_req is False and self.address is not None:
             try:
                 # Listen for commands
-                self.net_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.net_sock.bind((address, port))
-                self.net_sock.listen(5)
+                self.net_sock = self.listen(self.address, self.port)
             except OSError as err:
                 print(err)
                 logging.error(err.__str__())
                 sys.exit(1)
             else:
-                logging.info('Server socket created on '+address+':'+
-                             str(port))
+                logging.info('Server socket created on %s:%d', self.address,
+                             self.port)
 
-        if self.context is not None and address is not None:
+        if self.context is not None and self.address is not None:
             try:
                 # Listen for commands
-                self.tls_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.tls_sock.bind((address, tls_port))
-                self.tls_sock.listen(5)
+                self.tls_sock = self.listen(self.address, self.tls_port)
             except OSError as err:
                 print(err)
                 logging.error(err.__str__())
                 sys.exit(1)
             else:
-                logging.info('TLS-Server socket created on '+address+':'+
-                             str(tls_port))
+                logging.info('TLS-Server socket created on %s:%d',
+                             self.address, self.tls_port)
+
+    def listen(self, address, port):
+        """Return a socket listening on address and port"""
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # The server closes idle kept open connections itself, which
+        # leaves them in TIME_WAIT and would keep a restarted server
+        # from binding the port for a minute
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.workers > 1:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((address, port))
+        sock.listen(self.backlog)
+        return sock
+
+    def close_sockets(self):
+        """Close the listening sockets"""
+
+        for sock in (self.sock, self.net_sock, self.tls_sock):
+            if sock is not None:
+                sock.close()
+        self.sock = None
+        self.net_sock = None
+        self.tls_sock = None
 
+    def run(self):
+        """Overide Daemon.run() and provide socets"""
 
-        #Handle SIGTERM
-        signal.signal(signal.SIGTERM, self.handle_sigterm)
+        if self.workers > 1:
+            self.run_workers()
+        else:
+            self.serve()
+
+    def run_workers(self):
+        """Fork the worker processes and restart them if they die"""
+
+        # Only the workers accept connections
+        self.close_sockets()
+        if self.metrics is not None:
+            self.metrics.stop()
+            self.metrics = None
+        # Profiling the parent is useless, the workers do the work
+        signal.signal(signal.SIGUSR1, self.forward_signal)
+        signal.signal(signal.SIGUSR2, self.forward_signal)
+        for i in range(self.workers):
+            self.spawn_worker(i)
+
+        while self.children:
+            try:
+                pid = os.wait()[0]
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            worker = self.children.pop(pid, None)
+            if worker is not None and self.running is True:
+                logging.error('Worker %d died, restarting it', worker)
+                time.sleep(1)
+                self.spawn_worker(worker)
 
-    def check_password(self, password, keyfile):
-        """Check received password"""
-        
-        master = get_key(password, keyfile, True)
-        remote_final =  transform_key(master, self.db._transf_randomseed,
-                                      self.db._final_randomseed, 
-                                      self.db._key_transf_rounds)
-        master = get_key(self.db.password, self.db.keyfile)
-        final =  transform_key(master, self.db._transf_randomseed,
-                               self.db._final_randomseed, 
-                               self.db._key_transf_rounds)
-        return (remote_final == final)
+    def forward_signal(self, signum, frame):
+        """Pass a profiling signal on to the workers"""
 
-    def run(self):
-        """Overide Daemon.run() and provide socets"""
-        
+        for pid in self.children:
+            os.kill(pid, signum)
+
+    def spawn_worker(self, worker):
+        """Fork a worker process which serves until SIGTERM"""
+
+        pid = os.fork()
+        if pid > 0:
+            self.children[pid] = worker
+            return
+
+        code = 1
+        try:
+            self.worker = worker
+            self.children = {}
+            if self.profiler is not None:
+                self.profiler.install()
+            # The lock has to be opened after the fork, flock locks are
+            # shared by all descriptors of the same open file. Whoever
+            # can open it can hold the lock, so only the user may.
+            fd = os.open(self.db_path + '.wlock',
+                         os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            os.fchmod(fd, 0o600)
+            self.write_lock = os.fdopen(fd, 'a')
+            self.create_sockets()
+            if self.metrics_port is not None:
+                self.metrics = MetricsServer(self.metrics_port + worker,
+                                             self.render_metrics)
+            threads = self.serve()
+            for thread in threads:
+                thread.join()
+            code = 0
+        except BaseException as err:
+            logging.error('Worker %d failed: %s', worker, err)
+        finally:
+            # Never run the atexit handlers of the parent
+            os._exit(code)
+
+    def serve(self):
+        """Start serving in background threads and return the threads
+        accepting connections"""
+
+        self.watcher.start()
+        threads = []
         try:
-            local_thread = threading.Thread(target=self.handle_non_tls,
-                                            args=(self.sock,))
-            local_thread.start()
-            if self.tls_req is False:
-                non_tls_thread = threading.Thread(target=self.handle_non_tls,
-                                                  args=(self.net_sock,))
-                non_tls_thread.start()
-            if self.context is not None:
-                tls_thread = threading.Thread(target=self.handle_tls)
-                tls_thread.start()
+            accept_thread = threading.Thread(target=self.accept_loop)
+            accept_thread.start()
+            threads.append(accept_thread)
+            if self.metrics is not None:
+                self.metrics.start()
+            if self.journal is not None:
+                checkpoint_thread = threading.Thread(
+                    target=self.run_checkpoints)
+                checkpoint_thread.daemon = True
+                checkpoint_thread.start()
+            if self.upstream is not None:
+                follow_thread = threading.Thread(target=self.run_follower)
+                follow_thread.daemon = True
+                follow_thread.start()
         except OSError as err:
             logging.error(err.__str__())
             self.stop()
+        return threads
 
-    def handle_non_tls(self, sock):
-        while True:
+    def accept_loop(self):
+        """Accept the connections of all listening sockets in one thread
+
+        Every connection is served by a new thread, the TLS handshake is
+        done there, too.
+
+        """
+
+        selector = selectors.DefaultSelector()
+        for sock, handler in ((self.sock, self.handle_client),
+                              (self.net_sock, self.handle_client),
+                              (self.tls_sock, self.handle_tls_client)):
+            if sock is not None:
+                sock.setblocking(False)
+                selector.register(sock, selectors.EVENT_READ, handler)
+
+        try:
+            while self.running is True:
+                try:
+                    # The timeout lets the loop notice a shutdown
+                    events = selector.select(1)
+                except (OSError, ValueError) as err:
+                    if self.running is False:
+                        break
+                    logging.error(err.__str__())
+                    continue
+                for key, mask in events:
+                    self.accept(key.fileobj, key.data)
+        finally:
+            selector.close()
+
+    def accept(self, sock, handler):
+        """Accept up to ACCEPT_BATCH pending connections of sock"""
+
+        for i in range(ACCEPT_BATCH):
             try:
                 conn, client = sock.accept()
+            except BlockingIOError:
+                return
             except OSError as err:
-                # For correct closing
-                if "Bad file descriptor" in err.__str__():
+                # The socket was closed for shutdown
+                if self.running is True:
+                    logging.error(err.__str__())
+                return
+            logging.info('Connection from %s:%d', client[0], client[1])
+            conn.setblocking(True)
+            client_thread = threading.Thread(target=handler,
+                                             args=(conn, client,))
+            client_thread.daemon = True
+            client_thread.start()
+
+    def handle_tls_client(self, conn_tmp, client):
+        """Do the TLS handshake with a new client and serve it
+
+        This runs in the thread of the connection, so a client stalling
+        the handshake doesn't block accepting others.
+
+        """
+
+        timer = Timer()
+        start = time.perf_counter()
+        conn_tmp.settimeout(self.handshake_timeout)
+        try:
+            conn = self.context.wrap_socket(conn_tmp, server_side = True)
+        except (ssl.SSLError, OSError) as err:
+            timer.add('handshake', start)
+            timer.error = True
+            self.stats.record('HANDSHAKE', timer)
+            logging.error('TLS handshake with %s:%d failed: %s', client[0],
+                          client[1], err)
+            conn_tmp.close()
+        else:
+            timer.add('handshake', start)
+            self.handle_client(conn, client, timer)
+
+    def handle_client(self, conn, client, timer = None):
+        """Serve the requests of a client until it closes the connection
+
+        timer is the Timer of the connection if the TLS handshake was
+        already timed, it is accounted to the first request. Between two
+        requests the connection is kept open for keepalive seconds.
+
+        """
+
+        conn.settimeout(60)
+        self.stats.connection_opened()
+        try:
+            first = True
+            while self.running is True:
+                if first is False and self.wait_request(conn) is False:
                     break
-                logging.error(err.__str__())
-            else:
-                logging.info('Connection from '+client[0]+':'+str(client[1]))
-                client_thread = threading.Thread(target=self.handle_client, 
-                                                 args=(conn,client,))
-                client_thread.daemon = True
-                client_thread.start()
-
-    def handle_tls(self):
-        while True:
-            try:
-                conn_tmp, client = self.tls_sock.accept()
-                conn = self.context.wrap_socket(conn_tmp, server_side = True)
-            except (ssl.SSLError, OSError) as err:
-                # For correct closing
-                if "Bad file descriptor" in err.__str__():
+                if self.handle_request(conn, client, timer, first) is False:
                     break
-                logging.error(err.__str__())
-            else:
-                logging.info('Connection from '+client[0]+':'+str(client[1]))
-                client_thread = threading.Thread(target=self.handle_client, 
-                                                 args=(conn, client,))
-                client_thread.daemon = True
-                client_thread.start()
+                first = False
+                timer = None
+        finally:
+            self.stats.connection_closed()
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
 
-    def handle_client(self, conn, client):
-        conn.settimeout(60)
+    def wait_request(self, conn):
+        """Wait until the next request of a kept open connection arrives
+
+        Returns False if the client stays idle for keepalive seconds or
+        the server shuts down meanwhile.
+
+        """
+
+        deadline = time.monotonic() + self.keepalive
+        while self.running is True:
+            # Data which was decrypted already doesn't make the socket
+            # readable
+            if isinstance(conn, ssl.SSLSocket) and conn.pending() > 0:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            # The timeout lets the loop notice a shutdown
+            readable = select.select([conn], [], [], min(remaining, 1))[0]
+            if readable:
+                return True
+        return False
+
+    def handle_request(self, conn, client, timer = None, first = True):
+        """Serve one request of a client
+
+        Returns whether the connection may serve another request. It is
+        closed after failed password checks and subscriptions.
+
+        """
+
+        begin = time.perf_counter()
+        if timer is None:
+            timer = Timer()
+        else:
+            begin -= timer.phases.get('handshake', 0.0)
+        self.local.timer = timer
+        cmd = None
+        throttled = False
+        trace_id = None
+        keep = False
+        closed = False
+        busy = False
 
         try:
-            msg = receive(conn)
+            start = time.perf_counter()
+            try:
+                msg = receive(conn)
+            except ConnectionClosed as err:
+                # A kept open connection closed by the client is no
+                # request
+                if first is False and err.received == 0:
+                    closed = True
+                    return False
+                raise
+            timer.add('receive', start)
+            timer.bytes_in = len(msg)
             parts = msg.split(b'\xB2\xEA\xC0')
+            trace_id = split_trace(parts)
             parts.append(client)
             password = parts.pop(0)
             keyfile = parts.pop(0)
             cmd = parts.pop(0)
+            # Subscriptions wait for changes instead of working
+            if cmd != b'SUBSCRIBE':
+                self.stats.request_started()
+                busy = True
+            # The request without credentials, written to the journal
+            self.local.request = [cmd] + parts[:-1]
 
             if password == b'':
                 password = None
@@ -263,55 +704,766 @@ class Server(Daemon):
                 password = password.decode()
             if keyfile == b'':
                 keyfile = None
-            if self.check_password(password, keyfile) is False:
-                sendmsg(conn, b'FAIL: Wrong password')
+            start = time.perf_counter()
+            limited = (self.limiter is not None and
+                       self.limiter.limits(client[0]) is True)
+            if limited is True:
+                wait = self.limiter.allow(client[0])
+                if wait is not None:
+                    throttled = True
+                    self.send(conn, 'FAIL: Too many password checks, try '
+                                    'again in {0:.1f}s'.format(wait).encode())
+                    raise OSError('Throttled password check from ' +
+                                  client[0])
+            authorized = self.check_password(password, keyfile)
+            timer.add('auth', start)
+            if limited is True:
+                self.limiter.result(client[0], authorized)
+            if authorized is False:
+                self.send(conn, b'FAIL: Wrong password')
                 raise OSError("Received wrong password")
+            keep = cmd != b'SUBSCRIBE'
         except OSError as err:
+            timer.error = True
             logging.error(err.__str__())
         else:
+            start = time.perf_counter()
             try:
                 if cmd in self.lookup:
                     self.lookup[cmd](conn, parts)
                 else:
                     logging.error('Received a wrong command')
-                    sendmsg(conn, b'FAIL: Command isn\'t available')
-            except (OSError, ValueError) as err:
+                    self.send(conn, b'FAIL: Command isn\'t available')
+            except ValueError as err:
+                timer.error = True
                 logging.error(err.__str__())
+            except OSError as err:
+                # The connection may be broken
+                timer.error = True
+                keep = False
+                logging.error(err.__str__())
+            except Exception:
+                timer.error = True
+                raise
+            finally:
+                # Only count the time not already spent in another phase
+                inner = sum(timer.phases.get(i, 0.0)
+                            for i in ('lock', 'save', 'send'))
+                timer.phases['handler'] = (time.perf_counter() - start -
+                                           inner)
         finally:
-            conn.shutdown(socket.SHUT_RDWR)
-            conn.close()
+            self.local.timer = None
+            if busy is True:
+                self.stats.request_finished()
+            if closed is False:
+                if throttled is True:
+                    name = 'THROTTLED'
+                elif cmd in self.lookup:
+                    name = cmd.decode()
+                else:
+                    name = 'INVALID'
+                self.account(name, client, timer, begin, trace_id)
+        return keep
+
+    def account(self, name, client, timer, begin, trace_id):
+        """Record a finished request in the statistics and the traces"""
+
+        self.stats.record(name, timer)
+        total = time.perf_counter() - begin
+        if self.tracer is not None:
+            if trace_id is None:
+                trace_id = new_id()
+            end = time.time()
+            self.tracer.request(trace_id, name, end - total, end, timer,
+                                client=client[0])
+        if (self.slow_threshold is not None and
+                total >= self.slow_threshold):
+            self.log_slow(name, client, timer, total, trace_id)
+
+    def log_slow(self, cmd, client, timer, total, trace_id = None):
+        """Write one line with the details of a slow request"""
+
+        phases = ' '.join('{0}_ms={1:.1f}'.format(i, timer.phases[i] * 1000)
+                          for i in PHASES if i in timer.phases)
+        slow_log.warning('slow request: cmd=%s client=%s:%d trace=%s '
+                         'bytes_in=%d bytes_out=%d error=%s total_ms=%.1f %s',
+                         cmd, client[0], client[1], trace_id or '-',
+                         timer.bytes_in, timer.bytes_out, timer.error,
+                         total * 1000, phases)
+
+    def add_time(self, phase, start):
+        """Add the time since start to a phase of the current request"""
+
+        timer = getattr(self.local, 'timer', None)
+        if timer is not None:
+            timer.add(phase, start)
+
+    def send(self, conn, msg):
+        """Send a message and account it to the current request"""
+
+        if conn is None:
+            # Replaying the journal
+            return
+        start = time.perf_counter()
+        sendmsg(conn, msg)
+        timer = getattr(self.local, 'timer', None)
+        if timer is not None:
+            timer.add('send', start)
+            timer.bytes_out += len(msg)
+            if msg[:4] == b'FAIL':
+                timer.error = True
+
+    def render_metrics(self):
+        """Return the metrics of the server in the Prometheus format"""
+
+        try:
+            size = getsize(self.db_path)
+        except OSError:
+            size = 0
+        db = self.db
+        gauges = [
+            ('threads', 'Running threads.', threading.active_count()),
+            ('workers', 'Worker processes, each serving its own '
+             'metrics.', self.workers),
+            ('database_bytes', 'Size of the database file.', size),
+            ('database_entries', 'Entries in the database.',
+             len(db.entries)),
+            ('database_groups', 'Groups in the database.', len(db.groups))]
+        if self.context is not None:
+            sessions = self.context.session_stats()
+            gauges.extend((
+                ('tls_handshakes', 'Completed TLS handshakes.',
+                 sessions['accept_good']),
+                ('tls_resumed_sessions', 'TLS sessions resumed from the '
+                 'cache or a ticket.', sessions['hits'])))
+        if self.follow is not None:
+            if self.replication_lag is not None:
+                gauges.append(('replication_lag_seconds', 'Seconds between '
+                               'the primary saving the database and the '
+                               'follower serving it.',
+                               round(self.replication_lag, 3)))
+            if self.last_contact is not None:
+                gauges.append(('replication_last_contact_seconds', 'Seconds '
+                               'since the last message from the primary.',
+                               round(time.time() - self.last_contact, 3)))
+        counters = [('log_dropped_total', 'Log messages dropped because '
+                     'the log queue was full.', dropped_messages())]
+        if self.limiter is not None:
+            gauges.append(('auth_blocked_addresses', 'Addresses backing off '
+                           'after failed password checks.',
+                           self.limiter.blocked()))
+            counters.extend((
+                ('auth_rate_rejections_total', 'Password checks rejected '
+                 'by the per address rate limit.',
+                 self.limiter.rejected['rate']),
+                ('auth_backoff_rejections_total', 'Password checks '
+                 'rejected during the backoff after a failure.',
+                 self.limiter.rejected['backoff'])))
+        return self.stats.prometheus('keepassc_server', gauges, counters)
+
+    def save_db(self):
+        """Save the database and account the time to the current request"""
+
+        start = time.perf_counter()
+        self.write_db()
+        self.publish()
+        self.add_time('save', start)
+
+    def write_db(self):
+        """Write the database to a new file which replaces the old one
+
+        Readers like other workers or the file watcher see either the
+        old or the new file but never a partly written one, and a crash
+        leaves the old file. db_lock must be held.
+
+        """
+
+        tmp = self.db_path + '.tmp'
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        # kppy creates the file with the umask of the daemon, which is 0
+        os.close(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+        self.db.save(tmp)
+        with open(tmp, 'rb+') as handler:
+            os.fsync(handler.fileno())
+        shutil.copymode(self.db_path, tmp)
+        os.replace(tmp, self.db_path)
+        self.db_ident = file_ident(self.db_path)
+
+    def master_key(self):
+        """Return the key derived from the database password and keyfile"""
+
+        return get_key(self.db.password, self.db.keyfile)
+
+    def commit(self, conn, changed = None):
+        """Make a change durable and answer the client
+
+        Without a journal the database is saved and sent to the client.
+        Otherwise the request is appended to the journal and only
+        acknowledged; the client has to GET the database if it needs it.
+        changed is the group or entry the request created or changed.
+        Its uuid and times are journaled with the request, so that a
+        replay gives it the same uuid and times instead of new ones.
+
+        """
+
+        if self.replaying is True:
+            if changed is not None:
+                self.restore_stamps(changed, self.replayed[0],
+                                    self.replayed[1])
+            return
+        elif self.journal is None:
+            # The write lock is still held, so send_db can't be used
+            self.save_db()
+            self.send(conn, self.read_db())
+        else:
+            start = time.perf_counter()
+            if changed is None:
+                record = [b'', b'']
+            else:
+                record = [getattr(changed, 'uuid', b''),
+                          self.stamps(changed)]
+            self.journal.append(record + self.local.request)
+            self.add_time('save', start)
+            self.send(conn, b'OK: Change journaled')
+
+    def stamps(self, obj):
+        """Return the STAMPS of a group or entry as bytes"""
+
+        return ' '.join('-' if getattr(obj, i) is None
+                        else getattr(obj, i).isoformat()
+                        for i in STAMPS).encode()
+
+    def restore_stamps(self, obj, uuid, stamps):
+        """Give obj the uuid and the STAMPS a journal record holds"""
+
+        if uuid:
+            obj.uuid = uuid
+        for name, value in zip(STAMPS, stamps.decode().split()):
+            if value == '-':
+                setattr(obj, name, None)
+            else:
+                setattr(obj, name, datetime.strptime(value,
+                                                     '%Y-%m-%dT%H:%M:%S'))
+
+    def apply_journal(self, records):
+        """Apply journal records to self.db; db_lock must be held"""
+
+        self.replaying = True
+        try:
+            for record in records:
+                # Read by commit()
+                self.replayed = record
+                cmd = record[2]
+                parts = record[3:] + [('journal', 0)]
+                try:
+                    self.lookup[cmd](None, parts)
+                except (KeyError, IndexError, ValueError, KPError) as err:
+                    logging.error('Skipped journal record: %s', err)
+        finally:
+            self.replaying = False
+            self.replayed = None
+
+    def checkpoint(self, force = False):
+        """Fold the journal into the database file
+
+        A crash leaves either the old database with its journal or the
+        new one, see write_db(). db_lock must be held.
+
+        """
+
+        if force is False and not self.journal.records:
+            return
+        start = time.perf_counter()
+        self.write_db()
+        self.publish()
+        self.journal.reset(self.master_key(), self.db._contents_hash)
+        self.add_time('save', start)
+
+    def run_checkpoints(self):
+        """Checkpoint the journal periodically"""
+
+        while self.running is True:
+            time.sleep(self.checkpoint_interval)
+            with self.db_lock:
+                try:
+                    self.checkpoint()
+                except (KPError, OSError) as err:
+                    logging.error('Checkpoint failed: %s', err)
+
+    def load_db(self, password, keyfile):
+        """Load the database file with the given credentials
+
+        Returns the new database or None if it couldn't be loaded.
+
+        """
+
+        try:
+            db = KPDBv1(self.db_path, password, keyfile)
+            db.load()
+        except (KPError, OSError) as err:
+            logging.error('Could not load changed database: %s', err)
+            return None
+        return db
+
+    def reload_db(self):
+        """Reload the database if another program changed the file
+
+        This is called by the file watcher. The new database is loaded
+        without holding the database lock and swapped in afterwards, so
+        neither readers nor writers wait for the key transformation.
+
+        """
+
+        with self.db_lock:
+            ident = file_ident(self.db_path)
+            if ident is None or ident == self.db_ident:
+                return
+            password = self.db.password
+            keyfile = self.db.keyfile
+
+        db = self.load_db(password, keyfile)
+        if db is None:
+            return
+
+        with self.db_lock:
+            # If the file changed again meanwhile, the watcher reports it
+            # again and the next call loads the newer version
+            if (file_ident(self.db_path) != ident or
+                    self.db.password != password or
+                    self.db.keyfile != keyfile):
+                return
+            self.swap_db(db, ident)
+        logging.info('Reloaded the database after an external change')
+
+    def sync_db(self):
+        """Reload the database before changing it if the file changed
+
+        This prevents that a write overwrites a change made by another
+        program which the file watcher hasn't picked up yet. db_lock
+        must be held.
+
+        """
+
+        ident = file_ident(self.db_path)
+        if ident is None or ident == self.db_ident:
+            return
+        db = self.load_db(self.db.password, self.db.keyfile)
+        if db is not None:
+            self.swap_db(db, ident)
+            logging.info('Reloaded the database after an external change')
+
+    def swap_db(self, db, ident):
+        """Serve db from now on; db_lock must be held
+
+        Journaled changes which aren't in the file yet are applied to
+        the new database and written out immediately.
+
+        """
+
+        self.db = db
+        self.db_ident = ident
+        self.publish()
+        if self.journal is not None and self.journal.records:
+            self.apply_journal(self.journal.records)
+            self.checkpoint(True)
+
+    def index(self):
+        """Return the EntryIndex of the current database
+
+        It is built under db_lock so that no entry changes meanwhile.
+
+        """
+
+        index = self.entry_index
+        if (index is not None and index.db is self.db and
+                index.stale is False):
+            self.stats.cache('index', True)
+            return index
+        with self.db_lock:
+            index = self.entry_index
+            if index is None or index.db is not self.db or index.stale:
+                self.stats.cache('index', False)
+                index = self.entry_index = EntryIndex(self.db, index)
+            else:
+                self.stats.cache('index', True)
+        return index
+
+    def entry_changed(self, entry):
+        """Let the next index pack an entry again before it is changed"""
+
+        index = self.entry_index
+        if index is not None and index.db is self.db:
+            index.mark_changed(entry)
 
     def find(self, conn, parts):
         """Find entries and send them to connection"""
 
-        title = parts.pop(0)
-        msg = ''
-        for i in self.db.entries:
-            if title.decode().lower() in i.title.lower():
-                msg += 'Title: '+i.title+'\n'
-                if i.url is not None:
-                    msg += 'URL: '+i.url+'\n'
-                if i.username is not None:
-                    msg += 'Username: '+i.username+'\n'
-                if i.password is not None:
-                    msg += 'Password: '+i.password+'\n'
-                if i.creation is not None:
-                    msg += 'Creation: '+i.creation.__str__()+'\n'
-                if i.last_access is not None:
-                    msg += 'Access: '+i.last_access.__str__()+'\n'
-                if i.last_mod is not None:
-                    msg += 'Modification: '+i.last_mod.__str__()+'\n'
-                if i.expire is not None:
-                    msg += 'Expiration: '+i.expire.__str__()+'\n'
-                if i.comment is not None:
-                    msg += 'Comment: '+i.comment+'\n'
-                msg += '\n'
-        sendmsg(conn, msg.encode())
+        index = self.index()
+        title = parts.pop(0).decode().lower()
+        msg = [self.format_entry(index.entry(i)) for i in index.search(title)]
+        self.send(conn, ''.join(msg).encode())
+
+    def format_entry(self, entry):
+        """Return an entry as text like FIND sends it"""
+
+        msg = 'Title: '+entry.title+'\n'
+        if entry.url is not None:
+            msg += 'URL: '+entry.url+'\n'
+        if entry.username is not None:
+            msg += 'Username: '+entry.username+'\n'
+        if entry.password is not None:
+            msg += 'Password: '+entry.password+'\n'
+        if entry.creation is not None:
+            msg += 'Creation: '+entry.creation.__str__()+'\n'
+        if entry.last_access is not None:
+            msg += 'Access: '+entry.last_access.__str__()+'\n'
+        if entry.last_mod is not None:
+            msg += 'Modification: '+entry.last_mod.__str__()+'\n'
+        if entry.expire is not None:
+            msg += 'Expiration: '+entry.expire.__str__()+'\n'
+        if entry.comment is not None:
+            msg += 'Comment: '+entry.comment+'\n'
+        return msg + '\n'
+
+    def get_entry(self, uuid):
+        """Return the entry with uuid as IndexedEntry or None
+
+        uuid may be given raw or as hex string.
+
+        """
+
+        index = self.index()
+        if len(uuid) == 32:
+            try:
+                uuid = bytes.fromhex(uuid.decode())
+            except ValueError:
+                pass
+        pos = index.position(uuid)
+        if pos is None:
+            return None
+        return index.entry(pos)
+
+    def send_entry(self, conn, parts):
+        """Send one entry found by its uuid"""
+
+        entry = self.get_entry(parts.pop(0))
+        if entry is None:
+            self.send(conn, b"FAIL: Entry doesn't exist")
+            return
+        msg = 'UUID: '+entry.uuid.hex()+'\n'+self.format_entry(entry)
+        self.send(conn, msg.encode())
+
+    def send_field(self, conn, parts):
+        """Send one attribute of an entry found by its uuid
+
+        The answer is the parts b'OK' and the value, so that a value
+        starting with FAIL can't be taken for an error. Unset attributes
+        are sent as empty value.
+
+        """
+
+        # The uuid, the field and the client address
+        if len(parts) != 3:
+            self.send(conn, b'FAIL: GETF needs a uuid and a field')
+            return
+        entry = self.get_entry(parts.pop(0))
+        field = parts.pop(0).decode()
+        if entry is None:
+            self.send(conn, b"FAIL: Entry doesn't exist")
+            return
+        if field not in FIELDS:
+            self.send(conn, ('FAIL: Unknown field, use one of ' +
+                             ', '.join(FIELDS)).encode())
+            return
+        value = getattr(entry, field)
+        if value is None:
+            value = ''
+        self.send(conn, build_message([b'OK', str(value).encode()]))
+
+    def list_groups(self, conn, parts):
+        """Send the child groups of a group, 0 is the root
+
+        Every group is sent as the parts id, title, image, last
+        modification and the number of its child groups and entries.
+
+        """
+
+        db = self.db
+        group_id = int(parts.pop(0))
+        if group_id == 0:
+            group = db.root_group
+        else:
+            group = self.get_group(db, group_id)
+            if group is None:
+                self.send(conn, b"FAIL: Group doesn't exist anymore. You "
+                                b"should refresh")
+                return
+        rows = []
+        for i in group.children:
+            rows.extend((str(i.id_), i.title, str(i.image),
+                         self.format_date(i.last_mod), str(len(i.children)),
+                         str(len(i.entries))))
+        self.send_rows(conn, rows)
+
+    def list_entries(self, conn, parts):
+        """Send the entries of a group without their passwords
+
+        Every entry is sent as the parts uuid (hex), title, image, URL,
+        username, comment, creation, last access, last modification and
+        expiration. Passwords have to be fetched with GETF.
+
+        """
+
+        index = self.index()
+        group = self.get_group(index.db, int(parts.pop(0)))
+        if group is None:
+            self.send(conn, b"FAIL: Group doesn't exist anymore. You "
+                            b"should refresh")
+            return
+        rows = []
+        for i in group.entries:
+            pos = index.position(i.uuid)
+            # Added after the index was built
+            if pos is not None:
+                rows.extend(self.entry_row(index.entry(pos)))
+        self.send_rows(conn, rows)
+
+    def list_found(self, conn, parts):
+        """Send the entries whose title contains a text
+
+        The entries are sent like by LSE, each preceded by the id and
+        the title of its group.
+
+        """
+
+        index = self.index()
+        title = parts.pop(0).decode().lower()
+        rows = []
+        for i in index.search(title):
+            rows.extend((str(index.group_ids[i]), index.group_title(i) or ''))
+            rows.extend(self.entry_row(index.entry(i)))
+        self.send_rows(conn, rows)
+
+    def get_group(self, db, group_id):
+        """Return the group of db with group_id or None"""
+
+        for i in db.groups:
+            if i.id_ == group_id:
+                return i
+        return None
+
+    def entry_row(self, entry):
+        """Return the parts LSE sends for an entry"""
+
+        return (entry.uuid.hex(), entry.title, str(entry.image),
+                entry.url or '', entry.username or '', entry.comment or '',
+                self.format_date(entry.creation),
+                self.format_date(entry.last_access),
+                self.format_date(entry.last_mod),
+                self.format_date(entry.expire))
+
+    def format_date(self, date):
+        if date is None:
+            return ''
+        return date.strftime('%Y-%m-%d %H:%M:%S')
+
+    def send_rows(self, conn, rows):
+        """Send a list of strings as one message"""
+
+        if rows:
+            self.send(conn, build_message([i.encode() for i in rows]))
+        else:
+            self.send(conn, b'')
 
     def send_db(self, conn, parts):
+        if self.journal is not None and self.journal.records:
+            start = time.perf_counter()
+            with self.db_lock:
+                self.add_time('lock', start)
+                self.checkpoint()
+        self.send(conn, self.read_image())
+
+    def send_version(self, conn, parts):
+        """Send the version of the image GET would send
+
+        Clients with a cached image compare the versions instead of
+        downloading the database. The image is only hashed again after
+        the file changed.
+
+        """
+
+        if self.journal is not None and self.journal.records:
+            start = time.perf_counter()
+            with self.db_lock:
+                self.add_time('lock', start)
+                self.checkpoint()
+        ident = file_ident(self.db_path)
+        cached = self.image_version
+        if cached is None or cached[0] != ident:
+            self.stats.cache('version', False)
+            cached = (ident, image_version(self.read_image()))
+            self.image_version = cached
+        else:
+            self.stats.cache('version', True)
+        self.send(conn, cached[1].encode())
+
+    def read_image(self):
+        """Return the content of the database file once no worker is
+        writing it"""
+
+        if self.write_lock is not None:
+            # A new descriptor is needed because a shared lock on
+            # write_lock would convert an exclusive lock held by another
+            # thread.
+            with open(self.db_path + '.wlock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                return self.read_db()
+        return self.read_db()
+
+    def read_db(self):
+        """Return the content of the database file"""
+
         with open(self.db_path, 'rb') as handler:
-            buf = handler.read()
-        sendmsg(conn, buf)
+            return handler.read()
+
+    def publish(self):
+        """Wake up the subscriptions after the database file changed"""
+
+        with self.db_changed:
+            self.db_version += 1
+            self.db_changed.notify_all()
+
+    def subscribe(self, conn, parts):
+        """Stream the database file to a follower
+
+        The current file is sent first and again after every change as
+        IMAGE message with its modification time and the time it was
+        sent, so the follower can tell the lag without comparing clocks
+        with the primary. Without a change a
+        PING with the current time is sent every HEARTBEAT seconds.
+        This only returns when the follower is gone or the server stops.
+
+        Changes written to the journal are only sent after the next
+        checkpoint.
+
+        """
+
+        logging.info('Follower subscribed from %s:%d', parts[-1][0],
+                     parts[-1][1])
+        sent = None
+        while self.running is True:
+            with self.db_changed:
+                version = self.db_version
+            ident = file_ident(self.db_path)
+            if ident is not None and ident != sent:
+                buf = self.read_image()
+                self.send(conn, build_message(
+                    [b'IMAGE', str(ident[2] / 1e9).encode(),
+                     str(time.time()).encode(), buf]))
+                sent = ident
+            else:
+                self.send(conn, build_message(
+                    [b'PING', str(time.time()).encode()]))
+            with self.db_changed:
+                self.db_changed.wait_for(
+                    lambda: (self.db_version != version or
+                             self.running is False), HEARTBEAT)
+
+    def read_only(self, conn, parts):
+        """Refuse a change on a follower"""
+
+        self.send(conn, 'FAIL: This server is a read-only replica of '
+                        '{0}:{1}'.format(*self.follow).encode())
+
+    def write_image(self, buf):
+        """Replace the database file of a follower with buf"""
+
+        tmp = self.db_path + '.tmp'
+        with open(tmp, 'wb') as handler:
+            handler.write(buf)
+            handler.flush()
+            os.fsync(handler.fileno())
+        os.chmod(tmp, 0o600)
+        os.replace(tmp, self.db_path)
+        self.image_hash = sha256(buf).digest()
+
+    def run_follower(self):
+        """Apply the database images the primary streams
+
+        The subscription is renewed with an increasing delay if the
+        connection to the primary fails.
+
+        """
+
+        failures = 0
+        while self.running is True:
+            try:
+                for parts in self.upstream.subscribe():
+                    failures = 0
+                    self.last_contact = time.time()
+                    if parts[0] == b'IMAGE':
+                        self.apply_image(float(parts[1]), float(parts[2]),
+                                         parts[3])
+                    elif parts[0] == b'PING' and self.image_hash is not None:
+                        # Nothing changed, so the replica is current
+                        self.replication_lag = 0.0
+            except (OSError, ValueError, IndexError) as err:
+                if self.running is True:
+                    logging.error('Lost the connection to the primary: %s',
+                                  err)
+            if self.running is True:
+                time.sleep(min(2 ** failures, 60))
+                failures += 1
+
+    def apply_image(self, saved, sent, buf):
+        """Serve the database image buf which the primary saved at the
+        time saved and sent at the time sent
+
+        The lag is the time the primary took to send the change, by its
+        clock, and the time it took to apply it here, by this one. An
+        image which is already served, e.g. the first one after
+        subscribing again, means the replica is current.
+
+        """
+
+        if sha256(buf).digest() == self.image_hash:
+            self.replication_lag = 0.0
+            return
+        received = time.time()
+        self.write_image(buf)
+        self.reload_db()
+        self.replication_lag = (max(sent - saved, 0.0) +
+                                time.time() - received)
+
+    def send_stats(self, conn, parts):
+        """Send the request statistics, only allowed from localhost"""
+
+        client_add = parts[-1][0]
+        if client_add != "localhost" and client_add != "127.0.0.1":
+            self.send(conn, b'FAIL: Statistics are only available from '
+                            b'localhost')
+            return
+        report = self.stats.report()
+        if self.follow is not None:
+            report += self.replication_report() + '\n'
+        self.send(conn, report.encode())
+
+    def replication_report(self):
+        """Return the replication state of a follower as one line"""
+
+        if self.last_contact is None:
+            contact = 'never'
+        else:
+            contact = '{0:.1f}s ago'.format(time.time() - self.last_contact)
+        if self.replication_lag is None:
+            lag = 'unknown'
+        else:
+            lag = '{0:.3f}s'.format(self.replication_lag)
+        return 'Replication: primary={0}:{1} lag={2} last_contact={3}'.format(
+            self.follow[0], self.follow[1], lag, contact)
 
     @waitDecorator
     def create_group(self, conn, parts):
@@ -319,26 +1471,30 @@ class Server(Daemon):
         root = int(parts.pop(0))
         if root == 0:
             self.db.create_group(title)
+            parent = self.db.root_group
         else:
             for i in self.db.groups:
                 if i.id_ == root:
                     self.db.create_group(title, i)
+                    parent = i
                     break
                 elif i is self.db.groups[-1]:
-                    sendmsg(conn, b"FAIL: Parent doesn't exist anymore. "
-                                       b"You should refresh")
+                    self.send(conn, b"FAIL: Parent doesn't exist anymore. "
+                                    b"You should refresh")
                     return
-        self.db.save()
-        self.send_db(conn, [])
+        self.commit(conn, parent.children[-1])
 
     @waitDecorator
     def change_password(self, conn, parts):
         client_add = parts[-1][0]
         if client_add != "localhost" and client_add != "127.0.0.1":
-            sendmsg(conn, b'Password change from remote is not allowed')
+            self.send(conn, b'Password change from remote is not allowed')
 
         new_password = parts.pop(0).decode()
         new_keyfile = parts.pop(0).decode()
+        if self.journal is not None:
+            # The journal is encrypted with a key from the old password
+            self.checkpoint()
         if new_password == '':
             self.db.password = None
         else:
@@ -349,8 +1505,11 @@ class Server(Daemon):
         else:
             self.db.keyfile = realpath(expanduser(new_keyfile))
 
-        self.db.save()
-        sendmsg(conn, b"Password changed")
+        if self.journal is not None:
+            self.checkpoint(True)
+        else:
+            self.save_db()
+        self.send(conn, b"Password changed")
 
     @waitDecorator
     def create_entry(self, conn, parts):
@@ -370,12 +1529,11 @@ class Server(Daemon):
                                      comment, y, mon, d)
                 break
             elif i is self.db.groups[-1]:
-                sendmsg(conn, b"FAIL: Group for entry doesn't exist "
-                                   b"anymore. You should refresh")
+                self.send(conn, b"FAIL: Group for entry doesn't exist "
+                                b"anymore. You should refresh")
                 return
 
-        self.db.save()
-        self.send_db(conn, [])
+        self.commit(conn, self.db.entries[-1])
     
     @waitDecorator
     def delete_group(self, conn, parts):
@@ -387,19 +1545,18 @@ class Server(Daemon):
         for i in self.db.groups:
             if i.id_ == group_id:
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Group was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to delete this group try it again.")
+                    self.send(conn, b"FAIL: Group was modified. You should "
+                                    b"refresh and if you're sure you want "
+                                    b"to delete this group try it again.")
                     return
                 i.remove_group()
                 break
             elif i is self.db.groups[-1]:
-                sendmsg(conn, b"FAIL: Group doesn't exist "
-                                   b"anymore. You should refresh")
+                self.send(conn, b"FAIL: Group doesn't exist "
+                                b"anymore. You should refresh")
                 return
 
-        self.db.save()
-        self.send_db(conn, [])
+        self.commit(conn)
 
     @waitDecorator
     def delete_entry(self, conn, parts):
@@ -410,20 +1567,20 @@ class Server(Daemon):
        
         for i in self.db.entries:
             if i.uuid == uuid:
+                self.entry_changed(i)
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Entry was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to delete this entry try it again.")
+                    self.send(conn, b"FAIL: Entry was modified. You should "
+                                    b"refresh and if you're sure you want "
+                                    b"to delete this entry try it again.")
                     return
                 i.remove_entry()
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
+                self.send(conn, b"FAIL: Entry doesn't exist "
+                                b"anymore. You should refresh")
                 return
 
-        self.db.save()
-        self.send_db(conn, [])
+        self.commit(conn)
 
     @waitDecorator
     def move_group(self, conn, parts):
@@ -440,18 +1597,17 @@ class Server(Daemon):
                             i.move_group(j)
                             break
                         elif j is self.db.groups[-1]:
-                            sendmsg(conn, b"FAIL: New parent doesn't "
-                                               b"exist anymore. You should "
-                                               b"refresh")
+                            self.send(conn, b"FAIL: New parent doesn't "
+                                            b"exist anymore. You should "
+                                            b"refresh")
                             return
                 break
             elif i is self.db.groups[-1]:
-                sendmsg(conn, b"FAIL: Group doesn't exist "
-                                   b"anymore. You should refresh")
+                self.send(conn, b"FAIL: Group doesn't exist "
+                                b"anymore. You should refresh")
                 return
 
-        self.db.save()
-        self.send_db(conn, [])
+        self.commit(conn, i)
 
     @waitDecorator
     def move_entry(self, conn, parts):
@@ -465,17 +1621,16 @@ class Server(Daemon):
                         i.move_entry(j)
                         break
                     elif j is self.db.groups[-1]:
-                        sendmsg(conn, b"FAIL: New parent doesn't exist "
-                                           b"anymore. You should refresh")
+                        self.send(conn, b"FAIL: New parent doesn't exist "
+                                        b"anymore. You should refresh")
                         return
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
+                self.send(conn, b"FAIL: Entry doesn't exist "
+                                b"anymore. You should refresh")
                 return
 
-        self.db.save()
-        self.send_db(conn, [])
+        self.commit(conn)
         
     @waitDecorator
     def set_g_title(self, conn, parts):
@@ -488,19 +1643,18 @@ class Server(Daemon):
         for i in self.db.groups:
             if i.id_ == group_id:
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Group was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to edit this group try it again.")
+                    self.send(conn, b"FAIL: Group was modified. You should "
+                                    b"refresh and if you're sure you want "
+                                    b"to edit this group try it again.")
                     return
                 i.set_title(title)
                 break
             elif i is self.db.groups[-1]:
-                sendmsg(conn, b"FAIL: Group doesn't exist "
-                                   b"anymore. You should refresh")
+                self.send(conn, b"FAIL: Group doesn't exist "
+                                b"anymore. You should refresh")
                 return
 
-        self.db.save()
-        self.send_db(conn, [])
+        self.commit(conn, i)
 
     @waitDecorator
     def set_e_title(self, conn, parts):
@@ -512,20 +1666,20 @@ class Server(Daemon):
 
         for i in self.db.entries:
             if i.uuid == uuid:
+                self.entry_changed(i)
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Entry was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to edit this entry try it again.")
+                    self.send(conn, b"FAIL: Entry was modified. You should "
+                                    b"refresh and if you're sure you want "
+                                    b"to edit this entry try it again.")
                     return
                 i.set_title(title)
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
+                self.send(conn, b"FAIL: Entry doesn't exist "
+                                b"anymore. You should refresh")
                 return
 
-        self.db.save()
-        self.send_db(conn, [])
+        self.commit(conn, i)
 
     @waitDecorator
     def set_e_user(self, conn, parts):
@@ -537,20 +1691,20 @@ class Server(Daemon):
 
         for i in self.db.entries:
             if i.uuid == uuid:
+                self.entry_changed(i)
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Entry was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to edit this entry try it again.")
+                    self.send(conn, b"FAIL: Entry was modified. You should "
+                                    b"refresh and if you're sure you want "
+                                    b"to edit this entry try it again.")
                     return
                 i.set_username(username)
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
+                self.send(conn, b"FAIL: Entry doesn't exist "
+                                b"anymore. You should refresh")
                 return
 
-        self.db.save()
-        self.send_db(conn, [])
+        self.commit(conn, i)
 
     @waitDecorator
     def set_e_url(self, conn, parts):
@@ -562,20 +1716,20 @@ class Server(Daemon):
 
         for i in self.db.entries:
             if i.uuid == uuid:
+                self.entry_changed(i)
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Entry was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to edit this entry try it again.")
+                    self.send(conn, b"FAIL: Entry was modified. You should "
+                                    b"refresh and if you're sure you want "
+                                    b"to edit this entry try it again.")
                     return
                 i.set_url(url)
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
+                self.send(conn, b"FAIL: Entry doesn't exist "
+                                b"anymore. You should refresh")
                 return
 
-        self.db.save()
-        self.send_db(conn, [])
+        self.commit(conn, i)
 
     @waitDecorator
     def set_e_comment(self, conn, parts):
@@ -587,20 +1741,20 @@ class Server(Daemon):
 
         for i in self.db.entries:
             if i.uuid == uuid:
+                self.entry_changed(i)
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Entry was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to edit this entry try it again.")
+                    self.send(conn, b"FAIL: Entry was modified. You should "
+                                    b"refresh and if you're sure you want "
+                                    b"to edit this entry try it again.")
                     return
                 i.set_comment(comment)
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
+                self.send(conn, b"FAIL: Entry doesn't exist "
+                                b"anymore. You should refresh")
                 return
 
-        self.db.save()
-        self.send_db(conn, [])
+        self.commit(conn, i)
 
     @waitDecorator
     def set_e_pass(self, conn, parts):
@@ -612,20 +1766,20 @@ class Server(Daemon):
 
         for i in self.db.entries:
             if i.uuid == uuid:
+                self.entry_changed(i)
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Entry was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to edit this entry try it again.")
+                    self.send(conn, b"FAIL: Entry was modified. You should "
+                                    b"refresh and if you're sure you want "
+                                    b"to edit this entry try it again.")
                     return
                 i.set_password(password)
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
+                self.send(conn, b"FAIL: Entry doesn't exist "
+                                b"anymore. You should refresh")
                 return
 
-        self.db.save()
-        self.send_db(conn, [])
+        self.commit(conn, i)
 
     @waitDecorator
     def set_e_exp(self, conn, parts):
@@ -639,32 +1793,73 @@ class Server(Daemon):
 
         for i in self.db.entries:
             if i.uuid == uuid:
+                self.entry_changed(i)
                 if self.check_last_mod(i, time) is True:
-                    sendmsg(conn, b"FAIL: Entry was modified. You should "
-                                       b"refresh and if you're sure you want "
-                                       b"to edit this entry try it again.")
+                    self.send(conn, b"FAIL: Entry was modified. You should "
+                                    b"refresh and if you're sure you want "
+                                    b"to edit this entry try it again.")
                     return
                 i.set_expire(y, mon, d)
                 break
             elif i is self.db.entries[-1]:
-                sendmsg(conn, b"FAIL: Entry doesn't exist "
-                                   b"anymore. You should refresh")
+                self.send(conn, b"FAIL: Entry doesn't exist "
+                                b"anymore. You should refresh")
                 return
 
-        self.db.save()
-        self.send_db(conn, [])
+        self.commit(conn, i)
 
     def check_last_mod(self, obj, time):
+       # A journaled change was checked when it was made and its replay
+       # sets newer modification times than the client saw
+       if self.replaying is True:
+           return False
        return obj.last_mod.timetuple() > time 
 
     def handle_sigterm(self, signum, frame):
-        self.db.lock()
-        if self.sock is not None:
-            self.sock.shutdown(socket.SHUT_RDWR)
-            self.sock.close()
-        if self.net_sock is not None:
-            self.net_sock.shutdown(socket.SHUT_RDWR)
-            self.net_sock.close()
-        if self.tls_sock is not None:
-            self.tls_sock.shutdown(socket.SHUT_RDWR)
-            self.tls_sock.close()
+        """Stop accepting, let running requests finish and shut down
+
+        Requests still running after drain_timeout seconds are cut off.
+        Journaled changes are checkpointed before the database is
+        locked.
+
+        """
+
+        # Daemon.stop() repeats SIGTERM until the process is gone
+        if self.running is False:
+            return
+        self.running = False
+        if self.children:
+            for pid in self.children:
+                os.kill(pid, signal.SIGTERM)
+            return
+
+        start = time.perf_counter()
+        for sock in (self.sock, self.net_sock, self.tls_sock):
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self.close_sockets()
+        self.watcher.stop()
+        # Ends the subscriptions of followers
+        self.publish()
+        if self.stats.wait_idle(self.drain_timeout) is False:
+            logging.error('%d connections still open after %ss, closing '
+                          'them', self.stats.active, self.drain_timeout)
+        drained = time.perf_counter() - start
+
+        # Waits for a change in progress
+        with self.db_lock:
+            if self.journal is not None:
+                try:
+                    self.checkpoint()
+                except (KPError, OSError) as err:
+                    logging.error('Checkpoint failed: %s', err)
+                self.journal.close()
+            self.db.lock()
+        if self.metrics is not None:
+            self.metrics.stop()
+        logging.info('Shut down after draining requests for %.3fs and '
+                     'flushing changes for %.3fs', drained,
+                     time.perf_counter() - start - drained)
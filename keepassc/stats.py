@@ -0,0 +1,365 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+"""This module implements request statistics for the daemons.
+
+Everything is kept in fixed size counters and bucketed histograms so
+that recording a request costs a few additions under one lock and the
+statistics can stay enabled all the time.
+
+Classes:
+    Histogram(object)
+    Timer(object)
+    CommandStats(object)
+    Stats(object)
+    MetricsHandler(BaseHTTPRequestHandler)
+    MetricsServer(HTTPServer)
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Upper bounds of the latency buckets in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0)
+
+# The phases of a request in the order they happen
+PHASES = ('handshake', 'receive', 'auth', 'lock', 'handler', 'save', 'send')
+
+
+class Histogram(object):
+    """A latency histogram with fixed buckets"""
+
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        # The last bucket catches everything above BUCKETS[-1]
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """Add a value in seconds"""
+
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Estimate the q-quantile by interpolating inside its bucket"""
+
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, num in enumerate(self.counts):
+            if seen + num >= rank and num > 0:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / num,
+                           self.max)
+            seen += num
+        return self.max
+
+
+class Timer(object):
+    """Collect the phase durations and sizes of a single request"""
+
+    __slots__ = ('phases', 'bytes_in', 'bytes_out', 'error')
+
+    def __init__(self):
+        self.phases = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.error = False
+
+    def add(self, phase, start):
+        """Add the time since start (a perf_counter value) to phase"""
+
+        self.phases[phase] = (self.phases.get(phase, 0.0) +
+                              time.perf_counter() - start)
+
+
+class CommandStats(object):
+    """Counters and phase histograms of one command"""
+
+    __slots__ = ('count', 'errors', 'bytes_in', 'bytes_out', 'phases')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.phases = {}
+
+
+class Stats(object):
+    """Per-command counters and latency histograms of a daemon"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Notified when the last open connection is closed
+        self.idle = threading.Condition(self.lock)
+        self.started = time.time()
+        self.commands = {}
+        self.connections = 0
+        self.active = 0
+        # Requests being handled right now
+        self.busy = 0
+        # Cache name -> [hits, misses]
+        self.caches = {}
+
+    def connection_opened(self):
+        """Count a new client connection"""
+
+        with self.lock:
+            self.connections += 1
+            self.active += 1
+
+    def connection_closed(self):
+        """Count a closed client connection"""
+
+        with self.lock:
+            self.active -= 1
+            if self.active == 0:
+                self.idle.notify_all()
+
+    def request_started(self):
+        """Count a request the daemon started to handle"""
+
+        with self.lock:
+            self.busy += 1
+
+    def request_finished(self):
+        """Count a request the daemon finished"""
+
+        with self.lock:
+            self.busy -= 1
+
+    def cache(self, name, hit):
+        """Count a lookup in the cache name, hit tells whether it was used"""
+
+        with self.lock:
+            counts = self.caches.get(name)
+            if counts is None:
+                counts = self.caches[name] = [0, 0]
+            counts[0 if hit is True else 1] += 1
+
+    def wait_idle(self, timeout):
+        """Wait up to timeout seconds until no connection is open
+
+        Return False if connections are still open afterwards.
+
+        """
+
+        with self.lock:
+            return self.idle.wait_for(lambda: self.active == 0, timeout)
+
+    def record(self, cmd, timer):
+        """Account a finished request
+
+        cmd is the command name as string, timer a finished Timer
+
+        """
+
+        with self.lock:
+            stats = self.commands.get(cmd)
+            if stats is None:
+                stats = self.commands[cmd] = CommandStats()
+            stats.count += 1
+            if timer.error is True:
+                stats.errors += 1
+            stats.bytes_in += timer.bytes_in
+            stats.bytes_out += timer.bytes_out
+            for phase, value in timer.phases.items():
+                hist = stats.phases.get(phase)
+                if hist is None:
+                    hist = stats.phases[phase] = Histogram()
+                hist.observe(value)
+
+    def report(self):
+        """Return all statistics as human readable text"""
+
+        lines = ['Uptime: {0:.0f}s'.format(time.time() - self.started)]
+        with self.lock:
+            for cmd in sorted(self.commands):
+                stats = self.commands[cmd]
+                lines.append('{0}: count={1} errors={2} bytes_in={3} '
+                             'bytes_out={4}'.format(cmd, stats.count,
+                                                    stats.errors,
+                                                    stats.bytes_in,
+                                                    stats.bytes_out))
+                for phase in PHASES:
+                    hist = stats.phases.get(phase)
+                    if hist is None:
+                        continue
+                    lines.append('    {0}: count={1} mean={2:.3f}ms '
+                                 'p50={3:.3f}ms p95={4:.3f}ms '
+                                 'p99={5:.3f}ms max={6:.3f}ms'.format(
+                                     phase, hist.count,
+                                     hist.sum / hist.count * 1000,
+                                     hist.quantile(0.5) * 1000,
+                                     hist.quantile(0.95) * 1000,
+                                     hist.quantile(0.99) * 1000,
+                                     hist.max * 1000))
+        return '\n'.join(lines) + '\n'
+
+    def prometheus(self, prefix, gauges = (), counters = ()):
+        """Return all statistics in the Prometheus text format
+
+        prefix is prepended to every metric name, gauges and counters
+        are sequences of (name, help, value) tuples with additional
+        values of the daemon
+
+        """
+
+        out = []
+
+        def header(name, help_, type_):
+            out.append('# HELP {0}_{1} {2}'.format(prefix, name, help_))
+            out.append('# TYPE {0}_{1} {2}'.format(prefix, name, type_))
+
+        def sample(name, labels, value):
+            if labels:
+                labels = '{' + ','.join('{0}="{1}"'.format(k, v)
+                                        for k, v in labels) + '}'
+            else:
+                labels = ''
+            out.append('{0}_{1}{2} {3}'.format(prefix, name, labels, value))
+
+        header('uptime_seconds', 'Seconds since the daemon started.', 'gauge')
+        sample('uptime_seconds', (), round(time.time() - self.started, 3))
+        with self.lock:
+            header('connections_total', 'Accepted client connections.',
+                   'counter')
+            sample('connections_total', (), self.connections)
+            header('connections_active', 'Currently open client '
+                   'connections.', 'gauge')
+            sample('connections_active', (), self.active)
+            header('requests_in_flight', 'Requests being handled, each '
+                   'by its own thread.', 'gauge')
+            sample('requests_in_flight', (), self.busy)
+
+            caches = sorted(self.caches.items())
+            header('cache_hits_total', 'Lookups answered from a cache.',
+                   'counter')
+            for cache, counts in caches:
+                sample('cache_hits_total', (('cache', cache),), counts[0])
+            header('cache_misses_total', 'Lookups a cache could not '
+                   'answer.', 'counter')
+            for cache, counts in caches:
+                sample('cache_misses_total', (('cache', cache),), counts[1])
+            header('cache_hit_ratio', 'Share of the lookups since the '
+                   'start answered from a cache.', 'gauge')
+            for cache, counts in caches:
+                sample('cache_hit_ratio', (('cache', cache),),
+                       round(counts[0] / (counts[0] + counts[1]), 4))
+
+            commands = sorted(self.commands.items())
+            for name, attr, help_ in (
+                    ('requests_total', 'count', 'Handled requests.'),
+                    ('request_errors_total', 'errors', 'Failed requests.'),
+                    ('received_bytes_total', 'bytes_in',
+                     'Payload bytes received.'),
+                    ('sent_bytes_total', 'bytes_out', 'Payload bytes sent.')):
+                header(name, help_, 'counter')
+                for cmd, stats in commands:
+                    sample(name, (('command', cmd),), getattr(stats, attr))
+
+            header('request_phase_seconds', 'Time spent in each phase of '
+                   'a request.', 'histogram')
+            for cmd, stats in commands:
+                for phase in PHASES:
+                    hist = stats.phases.get(phase)
+                    if hist is None:
+                        continue
+                    labels = (('command', cmd), ('phase', phase))
+                    total = 0
+                    for bound, num in zip(BUCKETS, hist.counts):
+                        total += num
+                        sample('request_phase_seconds_bucket',
+                               labels + (('le', bound),), total)
+                    sample('request_phase_seconds_bucket',
+                           labels + (('le', '+Inf'),), hist.count)
+                    sample('request_phase_seconds_sum', labels,
+                           round(hist.sum, 6))
+                    sample('request_phase_seconds_count', labels, hist.count)
+
+        for name, help_, value in gauges:
+            header(name, help_, 'gauge')
+            sample(name, (), value)
+        for name, help_, value in counters:
+            header(name, help_, 'counter')
+            sample(name, (), value)
+        return '\n'.join(out) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Answer GET /metrics with the output of the server's render()"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info('Metrics request from %s: ' + format,
+                     self.client_address[0], *args)
+
+
+class MetricsServer(HTTPServer):
+    """A HTTP listener on localhost that serves metrics
+
+    render is called for every scrape and has to return the metrics as
+    text. The listener is bound on creation but only serves after
+    start() was called, so it can be created before daemonizing.
+
+    """
+
+    def __init__(self, port, render):
+        HTTPServer.__init__(self, ('localhost', port), MetricsHandler)
+        self.render = render
+        self.thread = None
+
+    def start(self):
+        """Serve in a background thread"""
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving and close the socket"""
+
+        if self.thread is not None:
+            self.shutdown()
+        self.server_close()
@@ -0,0 +1,142 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+"""This module implements tracing requests across client, agent and
+server.
+
+A traced request carries its trace ID as an additional last part
+
+    b'\\xffTRACE=' + 16 hex digits
+
+of the message. \\xff never occurs in UTF-8 and the part has a length no
+uuid has, so it can't be mistaken for an argument. Receivers strip it
+before the command is handled, so peers without tracing just ignore
+it.
+
+Every hop appends its spans as JSON lines to the trace file in the
+keepassc data directory, e.g.
+
+    {"trace": "...", "process": "server", "pid": 42, "name": "FIND",
+     "start": 1376611200.1, "end": 1376611200.7, "duration_ms": 600.0,
+     "phases_ms": {"auth": 590.2, ...}}
+
+so grepping for an ID shows where the time of a request went.
+
+Functions:
+    new_id()
+    trace_part(trace_id)
+    split_trace(parts)
+
+Classes:
+    Tracer(object)
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+TRACE_PREFIX = b'\xffTRACE='
+TRACE_LENGTH = len(TRACE_PREFIX) + 16
+
+
+def new_id():
+    """Return a new random trace ID as hex string"""
+
+    return os.urandom(8).hex()
+
+
+def trace_part(trace_id):
+    """Return the message part carrying trace_id"""
+
+    return TRACE_PREFIX + trace_id.encode()
+
+
+def split_trace(parts):
+    """Remove a trace part from the end of parts
+
+    Return the trace ID or None if the message isn't traced.
+
+    """
+
+    if (parts and len(parts[-1]) == TRACE_LENGTH and
+            parts[-1][:len(TRACE_PREFIX)] == TRACE_PREFIX):
+        try:
+            return parts.pop()[len(TRACE_PREFIX):].decode()
+        except UnicodeDecodeError:
+            return None
+    return None
+
+
+class Tracer(object):
+    """Append spans of one process to a trace file
+
+    process names the hop, e.g. 'client', 'agent' or 'server'. Several
+    processes may share the file, every span is written with a single
+    append.
+
+    """
+
+    def __init__(self, path, process):
+        self.path = path
+        self.process = process
+        self.lock = threading.Lock()
+        self.handler = None
+
+    def span(self, trace_id, name, start, end, **attrs):
+        """Record that name took from start to end (time.time() values)"""
+
+        record = {'trace': trace_id,
+                  'process': self.process,
+                  'pid': os.getpid(),
+                  'name': name,
+                  'start': start,
+                  'end': end,
+                  'duration_ms': round((end - start) * 1000, 3)}
+        record.update(attrs)
+        line = (json.dumps(record, sort_keys=True) + '\n').encode()
+        with self.lock:
+            try:
+                if self.handler is None:
+                    fd = os.open(self.path, os.O_WRONLY | os.O_APPEND |
+                                 os.O_CREAT, 0o600)
+                    self.handler = os.fdopen(fd, 'ab', buffering=0)
+                self.handler.write(line)
+            except OSError as err:
+                logging.error('Could not write the trace: %s', err)
+
+    def request(self, trace_id, name, start, end, timer, **attrs):
+        """Record a request with the phase durations of its stats.Timer"""
+
+        attrs['error'] = timer.error
+        attrs['phases_ms'] = {i: round(timer.phases[i] * 1000, 3)
+                              for i in timer.phases}
+        self.span(trace_id, name, start, end, **attrs)
+
+    def since(self, trace_id, name, start, **attrs):
+        """Record a span from start until now"""
+
+        self.span(trace_id, name, start, time.time(), **attrs)
+
+    def close(self):
+        with self.lock:
+            if self.handler is not None:
+                self.handler.close()
+                self.handler = None
@@ -0,0 +1,161 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+"""This module implements watching a file for changes.
+
+inotify is used if the C library provides it, otherwise the file is
+polled.
+
+Functions:
+    file_ident(path)
+
+Classes:
+    FileWatcher(object)
+"""
+
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from os.path import basename, dirname
+
+try:
+    import ctypes
+    import ctypes.util
+
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_uint32)
+except (ImportError, OSError, AttributeError, TypeError):
+    _inotify_init1 = None
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without the name
+EVENT = struct.Struct('iIII')
+
+
+def file_ident(path):
+    """Return a tuple that changes whenever the file is rewritten
+
+    None is returned if the file doesn't exist.
+
+    """
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class FileWatcher(object):
+    """Call a function from a background thread when a file changes
+
+    The directory is watched instead of the file itself, so files
+    replaced by renaming (like most editors and sync tools do) are
+    noticed, too. callback is called without arguments and has to
+    decide itself whether the change is relevant.
+
+    """
+
+    def __init__(self, path, callback, interval = 2):
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Start watching in a daemon thread"""
+
+        fd = None
+        if _inotify_init1 is not None:
+            fd = _inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+                if _inotify_add_watch(fd, dirname(self.path).encode(),
+                                      mask) < 0:
+                    os.close(fd)
+                    fd = None
+            else:
+                fd = None
+
+        self.running = True
+        if fd is not None:
+            logging.info('Watching %s with inotify', self.path)
+            self.thread = threading.Thread(target=self.run_inotify,
+                                           args=(fd,))
+        else:
+            logging.info('Polling %s every %ds', self.path, self.interval)
+            self.thread = threading.Thread(target=self.run_poll)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop watching"""
+
+        self.running = False
+
+    def run_inotify(self, fd):
+        name = basename(self.path).encode()
+        try:
+            while self.running:
+                ready = select.select([fd], [], [], self.interval)[0]
+                if not ready:
+                    continue
+                try:
+                    buf = os.read(fd, 4096)
+                except BlockingIOError:
+                    continue
+                changed = False
+                offset = 0
+                while offset < len(buf):
+                    length = EVENT.unpack_from(buf, offset)[3]
+                    start = offset + EVENT.size
+                    if buf[start:start + length].rstrip(b'\0') == name:
+                        changed = True
+                    offset = start + length
+                if changed is True:
+                    self.notify()
+        finally:
+            os.close(fd)
+
+    def run_poll(self):
+        last = file_ident(self.path)
+        while self.running:
+            time.sleep(self.interval)
+            current = file_ident(self.path)
+            if current != last:
+                last = current
+                self.notify()
+
+    def notify(self):
+        try:
+            self.callback()
+        except Exception as err:
+            logging.error('File watcher callback failed: %s', err)
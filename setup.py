@@ -28,7 +28,8 @@ setup(name = "keepassc",
       download_url = "https://github.com/raymontag/keepassc/tarball/master",
       description = "A password manager that is fully compatible to KeePass v.1.x and KeePassX",
       packages = ['keepassc'],
-      scripts = ['bin/keepassc', 'bin/keepassc-server', 'bin/keepassc-agent'],
+      scripts = ['bin/keepassc', 'bin/keepassc-server', 'bin/keepassc-agent',
+                 'bin/keepassc-bench'],
       install_requires = ['kppy', 'PyCrypto'],
       classifiers = [
           'Programming Language :: Python :: 3.3',
@@ -37,6 +38,7 @@ setup(name = "keepassc",
           'Development Status :: 5 - Production/Stable',
           'Environment :: Console :: Curses'],
       license = "GPL v3 or later, MIT",
-      data_files = [('share/man/man1', ['keepassc.1', 'keepassc-server.1', 'keepassc-agent.1']),
+      data_files = [('share/man/man1', ['keepassc.1', 'keepassc-server.1', 'keepassc-agent.1',
+                                        'keepassc-bench.1']),
                     ('share/doc/keepassc', ['README', 'COPYING', 'CHANGELOG'])]
 )
@@ -0,0 +1,217 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import asyncio
+import logging
+import socket
+import threading
+import unittest
+from unittest import mock
+
+from keepassc import client
+from keepassc.asyncclient import AsyncClient
+from keepassc.client import Client, ConnectionPool, field_value
+from keepassc.conn import receive, sendmsg
+
+
+class FakeServer(object):
+    """Answer every request with b'OK' and record the commands
+
+    A connection is closed without an answer to the commands in drop,
+    a command in drop_once only the first time.
+
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        self.commands = []
+        self.drop = set()
+        self.drop_once = set()
+        self.lock = threading.Lock()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                conn, client = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,),
+                             daemon=True).start()
+
+    def handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    cmd = receive(conn).split(b'\xB2\xEA\xC0')[2]
+                except OSError:
+                    return
+                with self.lock:
+                    self.commands.append(cmd)
+                    drop = cmd in self.drop or cmd in self.drop_once
+                    self.drop_once.discard(cmd)
+                if drop is True:
+                    return
+                sendmsg(conn, b'OK')
+
+    def close(self):
+        self.sock.close()
+
+
+class TestFieldValue(unittest.TestCase):
+
+    def test_value(self):
+        self.assertEqual(field_value(b'OK\xB2\xEA\xC0FAIL: secret'),
+                         b'FAIL: secret')
+        self.assertEqual(field_value(b'OK\xB2\xEA\xC0'), b'')
+
+    def test_error(self):
+        self.assertRaises(OSError, field_value, b"FAIL: Entry doesn't exist")
+        self.assertRaises(OSError, field_value, b'OK')
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.peers = []
+        self.pool = ConnectionPool(self.connect, size=2, idle_timeout=10)
+        self.now = 1000.0
+        patch = mock.patch.object(client.time, 'monotonic',
+                                  lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.pool.close()
+        for peer in self.peers:
+            peer.close()
+
+    def connect(self):
+        conn, peer = socket.socketpair()
+        self.peers.append(peer)
+        return conn
+
+    def test_reuse(self):
+        conn, reused = self.pool.acquire()
+        self.assertIs(reused, False)
+        self.pool.release(conn)
+        self.assertEqual(self.pool.acquire(), (conn, True))
+
+    def test_not_reused(self):
+        conn = self.pool.acquire()[0]
+        self.pool.release(conn, reuse=False)
+        self.assertEqual(conn.fileno(), -1)
+        self.assertIs(self.pool.acquire()[1], False)
+
+    def test_evict_idle(self):
+        first = self.pool.acquire()[0]
+        self.pool.release(first)
+        self.now += 10
+        second = self.pool.acquire()[0]
+        self.assertIsNot(second, first)
+        self.assertEqual(first.fileno(), -1)
+        # Releasing evicts the connections idle for too long
+        third = self.pool.acquire()[0]
+        self.pool.release(third)
+        self.now += 10
+        self.pool.release(second)
+        self.assertEqual(third.fileno(), -1)
+        self.assertEqual(self.pool.idle, [(second, self.now)])
+
+    def test_closed_by_server(self):
+        conn = self.pool.acquire()[0]
+        self.pool.release(conn)
+        self.peers[0].close()
+        self.assertIs(self.pool.acquire()[1], False)
+        self.assertEqual(conn.fileno(), -1)
+
+    def test_size(self):
+        self.pool.acquire()
+        self.pool.acquire()
+        self.assertRaises(OSError, self.pool.acquire, 0.01)
+
+
+class TestRetry(unittest.TestCase):
+    """A request failed on a reused connection is only sent again if it
+    doesn't change the database"""
+
+    def setUp(self):
+        self.server = FakeServer()
+        self.client = Client(logging.ERROR, 'test.log', '127.0.0.1',
+                             self.server.port, 'pw')
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_write_not_sent_twice(self):
+        self.assertEqual(self.client.get_version(), 'OK')
+        self.server.drop.add(b'NEWE')
+        answer = self.client.create_entry(b'title', b'url', b'user', b'pw',
+                                          b'', b'2999', b'12', b'28', b'1')
+        self.assertIs(type(answer), str)
+        self.assertEqual(self.server.commands, [b'VER', b'NEWE'])
+
+    def test_read_sent_again(self):
+        self.assertEqual(self.client.get_version(), 'OK')
+        self.server.drop_once.add(b'FIND')
+        self.assertEqual(self.client.find(b'title'), 'OK')
+        self.assertEqual(self.server.commands, [b'VER', b'FIND', b'FIND'])
+
+    def test_new_connection_not_retried(self):
+        self.server.drop_once.add(b'FIND')
+        self.assertIs(type(self.client.find(b'title')), str)
+        self.assertEqual(self.server.commands, [b'FIND'])
+
+
+class TestAsyncRetry(unittest.TestCase):
+    """Like TestRetry for AsyncClient"""
+
+    def setUp(self):
+        self.server = FakeServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def run_client(self, *cmd):
+        async def run():
+            client = AsyncClient(logging.ERROR, 'test.log', '127.0.0.1',
+                                 self.server.port, 'pw')
+            try:
+                self.assertEqual(await client.get_version(), 'OK')
+                self.server.drop_once.add(cmd[0])
+                return await client.get_bytes(*cmd)
+            finally:
+                await client.close()
+
+        return asyncio.run(run())
+
+    def test_write_not_sent_twice(self):
+        answer = self.run_client(b'DELE', b'uuid', b'2013', b'1', b'1',
+                                 b'0', b'0', b'0')
+        self.assertIs(type(answer), str)
+        self.assertEqual(self.server.commands, [b'VER', b'DELE'])
+
+    def test_read_sent_again(self):
+        self.assertEqual(self.run_client(b'LSG', b'0'), b'OK')
+        self.assertEqual(self.server.commands, [b'VER', b'LSG', b'LSG'])
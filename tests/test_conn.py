@@ -0,0 +1,103 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import asyncio
+import unittest
+
+from keepassc.asyncclient import read_message, read_messages
+from keepassc.conn import ConnectionClosed, receive, receive_messages
+
+END = b'\xDE\xAD\xE1\x1D'
+
+
+class Chunks(object):
+    """A socket whose recv() returns the given chunks, then b''"""
+
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    def getpeername(self):
+        return ('127.0.0.1', 50000)
+
+    def recv(self, size):
+        if self.chunks:
+            return self.chunks.pop(0)
+        return b''
+
+
+def split(data):
+    """Return every way to split data into two reads"""
+
+    return [(data[:i], data[i:]) for i in range(1, len(data))]
+
+
+class AsyncChunks(Chunks):
+    """A StreamReader whose read() returns the given chunks, then b''"""
+
+    async def read(self, size):
+        return self.recv(size)
+
+
+class TestReceive(unittest.TestCase):
+
+    def test_end_split(self):
+        for chunks in split(b'message' + END):
+            self.assertEqual(receive(Chunks(*chunks)), b'message')
+
+    def test_end_byte_by_byte(self):
+        data = b'ab' + END
+        self.assertEqual(receive(Chunks(*[data[i:i + 1]
+                                          for i in range(len(data))])),
+                         b'ab')
+
+    def test_closed(self):
+        with self.assertRaises(ConnectionClosed) as ctx:
+            receive(Chunks(b'mess', b'age\xDE\xAD'))
+        self.assertEqual(ctx.exception.received, 9)
+
+
+class TestReceiveMessages(unittest.TestCase):
+
+    def test_end_split(self):
+        data = b'first' + END + b'second' + END + b'third' + END
+        for chunks in split(data):
+            self.assertEqual(list(receive_messages(Chunks(*chunks))),
+                             [b'first', b'second', b'third'])
+
+    def test_incomplete_dropped(self):
+        self.assertEqual(list(receive_messages(
+            Chunks(b'first' + END + b'sec', b'ond'))), [b'first'])
+
+
+class TestAsyncFraming(unittest.TestCase):
+
+    def test_read_message(self):
+        async def run(chunks):
+            return await read_message(AsyncChunks(*chunks))
+
+        for chunks in split(b'message' + END):
+            self.assertEqual(asyncio.run(run(chunks)), b'message')
+
+    def test_read_messages(self):
+        async def run(chunks):
+            return [i async for i in read_messages(AsyncChunks(*chunks))]
+
+        for chunks in split(b'first' + END + b'second' + END):
+            self.assertEqual(asyncio.run(run(chunks)), [b'first', b'second'])
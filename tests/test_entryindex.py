@@ -0,0 +1,99 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from kppy.database import KPDBv1
+
+from keepassc import entryindex
+from keepassc.entryindex import EntryIndex, pack, unpack, PACKED
+
+
+def make_db(count):
+    """Return a new database with count entries in one group"""
+
+    db = KPDBv1(new=True)
+    group = db.groups[0]
+    for i in range(count):
+        db.create_entry(group, 'Entry {0}'.format(i), 1, 'url', 'user',
+                        'pass {0}'.format(i), 'comment', 2999, 12, 28)
+    return db
+
+
+class TestPack(unittest.TestCase):
+
+    def test_round_trip(self):
+        entry = make_db(1).entries[0]
+        entry.comment = None
+        entry.binary = b'\x00\xff'
+        fields = unpack(b'xx' + pack(entry), 2)
+        self.assertEqual(fields, tuple(getattr(entry, i) for i in PACKED))
+
+
+class TestEntryIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_db(5)
+        self.index = EntryIndex(self.db)
+
+    def test_entries_intact(self):
+        for entry in self.db.entries:
+            for name in PACKED:
+                getattr(entry, name)
+
+    def test_lookup(self):
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.index.search('entry 3'), [3])
+        entry = self.db.entries[2]
+        pos = self.index.position(entry.uuid)
+        self.assertEqual(self.index.entry(pos).password, 'pass 2')
+        self.assertEqual(self.index.group_title(pos), self.db.groups[0].title)
+
+    def test_snapshot(self):
+        self.db.entries[0].set_password('changed')
+        self.assertEqual(self.index.entry(0).password, 'pass 0')
+
+    def test_reuse_after_save(self):
+        changed = self.db.entries[1]
+        self.index.mark_changed(changed)
+        changed.set_password('changed')
+        with tempfile.TemporaryDirectory() as tmp:
+            self.db.password = 'pw'
+            self.db.save(os.path.join(tmp, 'test.kdb'))
+        with mock.patch.object(entryindex, 'pack',
+                               wraps=entryindex.pack) as packer:
+            index = EntryIndex(self.db, self.index)
+        self.assertEqual(packer.call_args_list, [mock.call(changed)])
+        self.assertEqual(index.entry(1).password, 'changed')
+        self.assertEqual(index.entry(0).password, 'pass 0')
+
+    def test_new_and_deleted(self):
+        self.db.entries[0].remove_entry()
+        self.db.create_entry(self.db.groups[0], 'New', 1, '', '', 'new', '',
+                             2999, 12, 28)
+        with mock.patch.object(entryindex, 'pack',
+                               wraps=entryindex.pack) as packer:
+            index = EntryIndex(self.db, self.index)
+        self.assertEqual(packer.call_count, 1)
+        self.assertIsNone(index.position(self.index.uuids[0]))
+        self.assertEqual(index.entry(index.search('new')[0]).password, 'new')
@@ -0,0 +1,151 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import logging
+import os
+import signal
+import socket
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from kppy.database import KPDBv1
+
+from keepassc import server
+from keepassc.conn import build_message, receive, sendmsg
+from keepassc.journal import Journal
+
+KEY = b'k' * 32
+BASE = b'b' * 32
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'test.kdb.journal')
+        self.journal = Journal(self.path)
+        self.journal.reset(KEY, BASE)
+
+    def tearDown(self):
+        self.journal.close()
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        records = [[b'', b'NEWG', b'title', b'0'],
+                   [b'\x00' * 16, b'PASS', b'\xff' * 100, b'']]
+        for i in records:
+            self.journal.append(i)
+        self.assertEqual(self.journal.records, records)
+        self.assertEqual(Journal(self.path).read(KEY, BASE), records)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_other_base_or_key(self):
+        self.journal.append([b'NEWG'])
+        self.assertEqual(Journal(self.path).read(KEY, b'c' * 32), [])
+        self.assertEqual(Journal(self.path).read(b'x' * 32, BASE), [])
+
+    def test_torn_record(self):
+        self.journal.append([b'first'])
+        self.journal.append([b'second'])
+        self.journal.close()
+        with open(self.path, 'rb+') as handler:
+            handler.truncate(os.path.getsize(self.path) - 1)
+        self.assertEqual(Journal(self.path).read(KEY, BASE), [[b'first']])
+
+    def test_bad_mac(self):
+        self.journal.append([b'first'])
+        size = os.path.getsize(self.path)
+        self.journal.append([b'second'])
+        self.journal.append([b'third'])
+        self.journal.close()
+        # Flip a byte of the ciphertext of the second record
+        with open(self.path, 'rb+') as handler:
+            handler.seek(size + 10)
+            byte = handler.read(1)
+            handler.seek(size + 10)
+            handler.write(bytes([byte[0] ^ 1]))
+        self.assertEqual(Journal(self.path).read(KEY, BASE), [[b'first']])
+
+
+class TestReplay(unittest.TestCase):
+    """Changes journaled by a server which crashed are replayed with
+    their original uuids and times"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'test.kdb')
+        db = KPDBv1(new=True)
+        db.create_entry(db.groups[0], 'old', 1, '', '', 'old', '',
+                        2999, 12, 28)
+        db.save(self.path, 'pw')
+        self.sigterm = signal.getsignal(signal.SIGTERM)
+        patches = [mock.patch.object(server, 'chdir'),
+                   mock.patch.object(server.Server, 'create_sockets')]
+        for i in patches:
+            i.start()
+            self.addCleanup(i.stop)
+
+    def tearDown(self):
+        signal.signal(signal.SIGTERM, self.sigterm)
+        self.tmp.cleanup()
+
+    def start_server(self):
+        return server.Server(os.path.join(self.tmp.name, 'pid'),
+                             logging.ERROR, 'test.log', db=self.path,
+                             password='pw', auth_rate=0, journal=True)
+
+    def request(self, srv, *cmd):
+        """Let srv handle one request and return the answer"""
+
+        with socket.socket() as listener:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            with socket.create_connection(listener.getsockname()) as client:
+                conn, address = listener.accept()
+                with conn:
+                    sendmsg(client, build_message([b'pw', b''] + list(cmd)))
+                    srv.handle_request(conn, address)
+                    return receive(client)
+
+    def test_replay_keeps_times(self):
+        srv = self.start_server()
+        old = srv.db.entries[0]
+        stamp = old.last_mod.timetuple()[:6]
+        self.assertEqual(self.request(
+            srv, b'NEWE', b'new', b'url', b'user', b'pass', b'', b'2999',
+            b'12', b'28', str(srv.db.groups[0].id_).encode()),
+            b'OK: Change journaled')
+        self.assertEqual(self.request(
+            srv, b'PASS', b'changed', old.uuid,
+            *[str(i).encode() for i in stamp]), b'OK: Change journaled')
+        journaled = {i.uuid: (i.password, i.creation, i.last_mod,
+                              i.last_access) for i in srv.db.entries}
+        srv.journal.close()
+
+        # The replay happens at another time
+        time.sleep(1.1)
+        self.start_server().journal.close()
+        db = KPDBv1(self.path, 'pw', read_only=True)
+        db.load()
+        self.assertEqual({i.uuid: (i.password, i.creation, i.last_mod,
+                                   i.last_access) for i in db.entries},
+                         journaled)
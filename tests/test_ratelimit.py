@@ -0,0 +1,87 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import unittest
+from unittest import mock
+
+from keepassc import ratelimit
+from keepassc.ratelimit import AuthLimiter, is_loopback
+
+
+class Clock(object):
+    """A time.monotonic() which only moves when told"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestAuthLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patch = mock.patch.object(ratelimit.time, 'monotonic', self.clock)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_token_bucket(self):
+        limiter = AuthLimiter(2, 3, 60)
+        for i in range(3):
+            self.assertIsNone(limiter.allow('192.0.2.1'))
+        self.assertAlmostEqual(limiter.allow('192.0.2.1'), 0.5)
+        # Other addresses have buckets of their own
+        self.assertIsNone(limiter.allow('192.0.2.2'))
+        self.clock.now += 0.5
+        self.assertIsNone(limiter.allow('192.0.2.1'))
+        self.assertIsNotNone(limiter.allow('192.0.2.1'))
+        self.assertEqual(limiter.rejected['rate'], 2)
+
+    def test_backoff(self):
+        limiter = AuthLimiter(100, 100, 3)
+        for delay in (0.5, 1, 2, 3, 3):
+            self.assertIsNone(limiter.allow('192.0.2.1'))
+            limiter.result('192.0.2.1', False)
+            self.assertAlmostEqual(limiter.allow('192.0.2.1'), delay)
+            self.assertEqual(limiter.blocked(), 1)
+            self.clock.now += delay
+        self.assertIsNone(limiter.allow('192.0.2.1'))
+        limiter.result('192.0.2.1', True)
+        self.assertIsNone(limiter.allow('192.0.2.1'))
+        self.assertEqual(limiter.blocked(), 0)
+
+    def test_loopback_limited_by_default(self):
+        limiter = AuthLimiter(1, 1, 60)
+        self.assertTrue(limiter.limits('127.0.0.1'))
+        self.assertIsNone(limiter.allow('127.0.0.1'))
+        self.assertIsNotNone(limiter.allow('127.0.0.1'))
+
+    def test_skip_loopback(self):
+        limiter = AuthLimiter(1, 1, 60, skip_loopback=True)
+        for address in ('127.0.0.1', '127.1.2.3', '::1', 'localhost'):
+            self.assertFalse(limiter.limits(address))
+        for address in ('192.0.2.1', '::ffff:192.0.2.1', 'example.org'):
+            self.assertTrue(limiter.limits(address))
+
+    def test_is_loopback(self):
+        self.assertTrue(is_loopback('127.0.0.1'))
+        self.assertFalse(is_loopback('10.0.0.1'))
+        self.assertFalse(is_loopback('not an address'))
@@ -0,0 +1,51 @@
+'''
+Copyright (C) 2012-2013 Karsten-Kai König <kkoenig@posteo.de>
+
+This file is part of keepassc.
+
+keepassc is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or at your
+option) any later version.
+
+keepassc is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with keepassc.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import unittest
+
+from keepassc.stats import Stats
+
+
+class TestStats(unittest.TestCase):
+
+    def test_cache_metrics(self):
+        stats = Stats()
+        stats.cache('key', True)
+        stats.cache('key', True)
+        stats.cache('key', True)
+        stats.cache('key', False)
+        stats.cache('index', False)
+        text = stats.prometheus('test')
+        self.assertIn('test_cache_hits_total{cache="key"} 3\n', text)
+        self.assertIn('test_cache_misses_total{cache="key"} 1\n', text)
+        self.assertIn('test_cache_hit_ratio{cache="key"} 0.75\n', text)
+        self.assertIn('test_cache_hit_ratio{cache="index"} 0.0\n', text)
+
+    def test_requests_in_flight(self):
+        stats = Stats()
+        stats.request_started()
+        stats.request_started()
+        stats.request_finished()
+        self.assertIn('test_requests_in_flight 1\n',
+                      stats.prometheus('test'))
+        stats.request_finished()
+        self.assertIn('test_requests_in_flight 0\n',
+                      stats.prometheus('test'))
+